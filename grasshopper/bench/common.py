@@ -0,0 +1,137 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import json
+import math
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from grasshopper.tracker import create_app
+from grasshopper.tracker.model.db import get_shard_db, init_db
+
+
+@contextmanager
+def temp_app(**config):
+    """
+    Yield a tracker app backed by a fresh database in a temporary
+    directory, with its app context pushed.
+    """
+    with tempfile.TemporaryDirectory() as instance:
+        app = create_app(dict({
+            'TESTING': True,
+            'SERVER_NAME': None,
+            'DATABASE': os.path.join(instance, 'bench.sqlite'),
+        }, **config))
+        with app.app_context():
+            init_db()
+            yield app
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+@contextmanager
+def serve(app):
+    """
+    Serve app over HTTP from a background thread and yield its URL.
+    """
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_port}'
+    finally:
+        server.shutdown()
+        thread.join()
+
+
+def create_user(username='bench', password='bench'):
+    from grasshopper.tracker.model.user import User
+
+    User.create(username, f'{username}@localhost', password)
+    return User.find_by_username(username)
+
+
+def synthetic_samples(count, start=None, interval=0.5, seed=0):
+    """
+    Yield count (timestamp, usage) pairs, one every interval seconds,
+    shaped like a test suite: a noisy baseline with periodic bursts.
+    """
+    rng = random.Random(seed)
+    start = start or datetime(2024, 1, 1)
+    step = timedelta(seconds=interval)
+    for i in range(count):
+        burst = 60 if math.sin(i / 50) > 0.8 else 0
+        usage = min(100.0, max(0.0, 20 + burst + rng.gauss(0, 5)))
+        yield start + i * step, usage
+
+
+def insert_samples(test_run_id, samples, chunk_size=100000):
+    """
+    Bulk load (timestamp, usage) pairs straight into cpu_usage. The stats
+    of the run are dropped, to be rebuilt from the samples on next read.
+    """
+    db = get_shard_db(test_run_id)
+    chunk = []
+    for timestamp, usage in samples:
+        chunk.append((test_run_id, timestamp.isoformat(sep=' '), usage))
+        if len(chunk) == chunk_size:
+            db.executemany('INSERT INTO cpu_usage (test_run_id, time, usage) '
+                           'VALUES (?, ?, ?)', chunk)
+            chunk = []
+    if chunk:
+        db.executemany('INSERT INTO cpu_usage (test_run_id, time, usage) '
+                       'VALUES (?, ?, ?)', chunk)
+    db.execute('DELETE FROM test_run_stats WHERE test_run_id = ?',
+               (test_run_id,))
+    db.commit()
+
+
+def measure(fn, repeat=5):
+    """
+    Call fn repeat times and return the median and best wall time in ms.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {'median_ms': timings[len(timings) // 2], 'best_ms': timings[0]}
+
+
+def git_revision():
+    """
+    Commit of the working tree the benchmark runs from, if any, so that
+    results can be compared across commits.
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(__file__), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(name, results, output=None, **parameters):
+    """
+    Print the results of a benchmark as JSON, and write them to output if
+    given.
+    """
+    document = json.dumps({'benchmark': name,
+                           'commit': git_revision(),
+                           'date': datetime.now().isoformat(),
+                           'parameters': parameters,
+                           'results': results}, indent=2, default=str)
+    print(document)
+    if output is not None:
+        with open(output, 'w') as f:
+            f.write(document + '\n')
@@ -0,0 +1,113 @@
+"""
+Ingest throughput of the tracker for a growing number of storage shards,
+1 being the single file sqlite backend. Several tracker processes, each
+with its own ingest queues, store batches of samples of their runs at
+once, as when the service runs with several workers:
+
+    python -m grasshopper.bench.ingest_shards --shards 1 2 4 --processes 4
+"""
+import argparse
+from concurrent.futures import wait
+from datetime import datetime, timedelta
+import multiprocessing
+import time
+
+from grasshopper.bench.common import (
+    create_user, report, synthetic_samples, temp_app
+)
+from grasshopper.tracker import create_app
+from grasshopper.tracker.model.ingest import (
+    get_ingest_queue, get_ingest_queues
+)
+from grasshopper.tracker.model.storage import get_storage
+from grasshopper.tracker.model.testrun import TestRun
+
+
+def worker(config, run_ids, samples, batch_size, barrier, results):
+    """
+    Submit the samples of run_ids in batches to the ingest queues of a
+    tracker process of its own, and report when it started and when every
+    sample was committed.
+    """
+    app = create_app(config)
+    # One batch after the other, as a run uploads them, so that the
+    # samples of a run follow each other instead of sharing timestamps
+    interval = 0.5
+    step = timedelta(seconds=batch_size * interval)
+    batches = [[{'usage': usage, 'timestamp': timestamp.isoformat()}
+                for timestamp, usage in synthetic_samples(
+                    batch_size, datetime(2024, 1, 1) + index * step,
+                    interval, seed=index)]
+               for index in range(samples // batch_size)]
+    with app.app_context():
+        runs = [TestRun.find_by_id(run_id) for run_id in run_ids]
+        barrier.wait()
+        start = time.time()
+        futures = [get_ingest_queue(test_run.id).submit(test_run, batch)
+                   for batch in batches for test_run in runs]
+        wait(futures)
+        end = time.time()
+        for queue in get_ingest_queues():
+            queue.close()
+    results.put((start, end))
+
+
+def ingest(config, run_ids, samples, batch_size, processes):
+    """
+    Return the seconds it takes processes workers to store the samples of
+    the runs, shared out between them.
+    """
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(processes)
+    results = context.Queue()
+    workers = [context.Process(target=worker,
+                               args=(config, run_ids[index::processes],
+                                     samples, batch_size, barrier, results))
+               for index in range(processes)]
+    for process in workers:
+        process.start()
+    times = [results.get() for _ in workers]
+    for process in workers:
+        process.join()
+    return max(end for _, end in times) - min(start for start, _ in times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=16)
+    parser.add_argument('--samples', type=int, default=20000,
+                        help='Samples per run.')
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    results = []
+    for shards in args.shards:
+        config = {'INGEST_QUEUE_ROWS': args.runs * args.samples}
+        if shards > 1:
+            config.update(STORAGE='sharded-sqlite', STORAGE_SHARDS=shards)
+        with temp_app(**config) as app:
+            user = create_user()
+            run_ids = [TestRun.create(user.id, f'run {index}', '', 50)['id']
+                       for index in range(args.runs)]
+            config.update(TESTING=True, SERVER_NAME=None,
+                          DATABASE=app.config['DATABASE'])
+            seconds = ingest(config, run_ids, args.samples,
+                             args.batch_size, args.processes)
+            stored = sum(db.execute('SELECT COUNT(*) FROM cpu_usage')
+                         .fetchone()[0]
+                         for db in get_storage().connections())
+        results.append({
+            'shards': shards,
+            'seconds': seconds,
+            'samples_per_second': stored / seconds,
+            'stored': stored,
+        })
+
+    report('ingest_shards', results, processes=args.processes,
+           runs=args.runs, samples=args.samples, batch_size=args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+Load test of the tracker over HTTP. The app is served from a temporary
+database and clients concurrent grasshopper clients, each with its own
+TrackerClient, create a run and report a sample every poll interval, one
+at a time or in batches, for duration seconds before stopping their run.
+
+Reports the ingest throughput, the p50/p99 latency of each endpoint, the
+growth of the database and the latency of the stats queries as the runs
+get longer. The clients run in the same process as the tracker.
+
+    python -m grasshopper.bench.load --clients 50 --poll-interval 0.1 \\
+        --duration 30 --output load.json
+"""
+import argparse
+from collections import defaultdict
+from contextlib import contextmanager
+import os
+import random
+import threading
+import time
+
+import numpy as np
+import requests
+
+from grasshopper.bench.common import create_user, report, serve, temp_app
+from grasshopper.grasshopper import TrackerClient
+from grasshopper.reporter import TrackerBusyError
+from grasshopper.sampler import Sample
+from grasshopper.tracker.model.ingest import get_ingest_queues
+from grasshopper.tracker.model.storage import get_storage
+
+
+class Timings:
+    """
+    Wall time of the calls to each endpoint, and how many of them failed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    @contextmanager
+    def record(self, endpoint):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            with self.lock:
+                self.errors[endpoint] += 1
+            raise
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.seconds[endpoint].append(elapsed)
+
+    def summary(self):
+        with self.lock:
+            return {
+                endpoint: {
+                    'calls': len(seconds),
+                    'errors': self.errors[endpoint],
+                    'p50_ms': np.percentile(seconds, 50) * 1000,
+                    'p99_ms': np.percentile(seconds, 99) * 1000,
+                    'max_ms': max(seconds) * 1000,
+                }
+                for endpoint, seconds in self.seconds.items()
+            }
+
+
+def simulate_client(url, token, args, index, timings, runs, stop):
+    """
+    Report samples the way grasshopper does until stop is set, then stop
+    the run.
+    """
+    rng = random.Random(index)
+    tracker = TrackerClient(token, url, timeout=60)
+    with timings.record('create'):
+        test_run = tracker.create_testrun(f'load {index}', '', 50)
+    runs[index] = test_run.id
+
+    pending = []
+    due = time.monotonic()
+    while not stop.is_set():
+        sample = Sample(usage=rng.uniform(0, 100),
+                        rss=rng.randrange(1 << 30),
+                        threads=rng.randrange(1, 64))
+        try:
+            if args.batch_size == 1:
+                with timings.record('usage'):
+                    tracker.record_usage(sample)
+            else:
+                pending.append((sample, time.time()))
+                if len(pending) >= args.batch_size:
+                    with timings.record('usage_batch'):
+                        tracker.record_usage_batch(pending)
+                    pending = []
+        except TrackerBusyError:
+            # Kept pending, retried with the next batch as grasshopper does
+            pass
+
+        due += args.poll_interval
+        time.sleep(max(0.0, due - time.monotonic()))
+
+    if pending:
+        with timings.record('usage_batch'):
+            tracker.record_usage_batch(pending)
+    with timings.record('stop'):
+        tracker.stop_testrun()
+    tracker.close()
+
+
+def database_size(app):
+    with app.app_context():
+        paths = get_storage().paths()
+    return sum(os.path.getsize(path + suffix)
+               for path in paths for suffix in ('', '-wal')
+               if os.path.exists(path + suffix))
+
+
+def probe(app, url, token, runs, interval, stop, growth, stats_latency):
+    """
+    Every interval seconds, record the size of the database and the time
+    the stats of the first run take, from the stored aggregates and
+    recomputed from the samples, along with its length.
+    """
+    tracker = TrackerClient(token, url, timeout=60)
+    start = time.monotonic()
+    while not stop.wait(interval):
+        growth.append({'seconds': time.monotonic() - start,
+                       'bytes': database_size(app)})
+        if runs[0] is None:
+            continue
+        tracker.test_run_id = runs[0]
+        started = time.perf_counter()
+        stats = tracker.get_testrun_stats()
+        stored_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        tracker.get(f'/{runs[0]}/stats')
+        recomputed_ms = (time.perf_counter() - started) * 1000
+        stats_latency.append({'samples': stats.get('measurements'),
+                              'stats_ms': stored_ms,
+                              'recompute_ms': recomputed_ms})
+    tracker.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Samples per upload, 1 to use /usage.')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Seconds of reporting.')
+    parser.add_argument('--probe-interval', type=float, default=2)
+    parser.add_argument('--storage', default='sqlite')
+    parser.add_argument('--shards', type=int, default=4)
+    parser.add_argument('--output', help='Also write the results here.')
+    args = parser.parse_args()
+
+    config = {'STORAGE': args.storage, 'STORAGE_SHARDS': args.shards}
+    with temp_app(**config) as app:
+        create_user('load', 'load')
+        empty = database_size(app)
+        with serve(app) as url:
+            token = requests.post(f'{url}/v1/api/auth',
+                                  json={'username': 'load',
+                                        'password': 'load'}).json()['token']
+
+            timings = Timings()
+            runs = [None] * args.clients
+            stop = threading.Event()
+            growth, stats_latency = [], []
+            threads = [threading.Thread(
+                target=simulate_client,
+                args=(url, token, args, index, timings, runs, stop))
+                for index in range(args.clients)]
+            prober = threading.Thread(
+                target=probe, args=(app, url, token, runs,
+                                    args.probe_interval, stop, growth,
+                                    stats_latency))
+
+            start = time.perf_counter()
+            for thread in [*threads, prober]:
+                thread.start()
+            time.sleep(args.duration)
+            stop.set()
+            for thread in [*threads, prober]:
+                thread.join()
+            for queue in get_ingest_queues():
+                queue.flush()
+            elapsed = time.perf_counter() - start
+
+        storage = get_storage()
+        stored = sum(storage.shard(index).execute(
+            'SELECT COALESCE(SUM(samples), 0) FROM test_run_stats'
+        ).fetchone()[0] for index in range(storage.shards))
+        results = {
+            'seconds': elapsed,
+            'samples': stored,
+            'samples_per_second': stored / elapsed,
+            'offered_samples_per_second': args.clients / args.poll_interval,
+            'endpoints': timings.summary(),
+            'database_bytes': database_size(app) - empty,
+            'database_growth': growth,
+            'stats_latency': stats_latency,
+        }
+
+    report('load', results, output=args.output, clients=args.clients,
+           poll_interval=args.poll_interval, batch_size=args.batch_size,
+           duration=args.duration, storage=args.storage,
+           shards=args.shards if args.storage != 'sqlite' else None)
+
+
+if __name__ == '__main__':
+    main()
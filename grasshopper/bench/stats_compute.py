@@ -0,0 +1,76 @@
+"""
+Recomputing the stats of a run from its raw samples: the original Python
+loop over CPUUsage objects against the streaming, vectorized computation,
+in time and peak memory, for growing run lengths:
+
+    python -m grasshopper.bench.stats_compute --sizes 10000 1000000
+"""
+import argparse
+import time
+import tracemalloc
+
+from grasshopper.bench.common import (
+    create_user, insert_samples, report, synthetic_samples, temp_app
+)
+from grasshopper.tracker.model.testrun import TestRun, calculate_duration
+
+
+def python_loop(test_run):
+    """
+    Time above threshold as get_test_execution_stats used to compute it.
+    """
+    time_series = test_run.fetch_current_cpu_usage()
+    total_time = 0
+    for periods in zip(time_series, time_series[1:]):
+        period_duration = calculate_duration(periods[0].timestamp,
+                                             periods[1].timestamp)
+        if periods[0].usage > test_run.threshold:
+            total_time += period_duration
+    return total_time
+
+
+def vectorized(test_run, chunk_size):
+    stats = test_run.recompute_stats(chunk_size=chunk_size)
+    return stats['time_above_threshold']
+
+
+def profile(fn, test_run):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(test_run)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': elapsed, 'peak_memory_bytes': peak,
+            'time_above_threshold': result}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000],
+                        help='Samples of the runs whose stats are computed.')
+    parser.add_argument('--chunk-size', type=int, default=65536,
+                        help='Samples per chunk read by the vectorized path.')
+    args = parser.parse_args()
+
+    results = []
+    with temp_app():
+        user = create_user()
+        for size in args.sizes:
+            run_id = TestRun.create(user.id, f'run {size}', '', 50)['id']
+            insert_samples(run_id, synthetic_samples(size))
+            test_run = TestRun.find_by_id(run_id)
+            test_run.fetch_stats()
+            results.append({
+                'samples': size,
+                'python_loop': profile(python_loop, test_run),
+                'vectorized': profile(
+                    lambda run: vectorized(run, args.chunk_size), test_run),
+            })
+
+    report('stats_compute', results, chunk_size=args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Latency of the stats queries of one run while the sample history of the
+other runs in the database grows, e.g. from 1k to 10M samples:
+
+    python -m grasshopper.bench.stats_latency --sizes 1000 10000000
+
+With the per run indexes in place the latency should stay flat; pass
+--drop-indexes to compare against full table scans.
+"""
+import argparse
+
+from grasshopper.bench.common import (
+    create_user, insert_samples, measure, report, synthetic_samples,
+    temp_app
+)
+from grasshopper.tracker.model.db import get_db
+from grasshopper.tracker.model.testrun import TestRun
+
+INDEXES = ('cpu_usage_test_run_time', 'cpu_usage_test_run_usage')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000, 10000000],
+                        help='Total samples in the database at which the '
+                             'stats latency is measured.')
+    parser.add_argument('--run-samples', type=int, default=1000,
+                        help='Samples of the run whose stats are queried.')
+    parser.add_argument('--history-run-samples', type=int, default=100000,
+                        help='Samples per run of the background history.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--drop-indexes', action='store_true')
+    args = parser.parse_args()
+
+    results = []
+    with temp_app():
+        db = get_db()
+        if args.drop_indexes:
+            for index in INDEXES:
+                db.execute(f'DROP INDEX {index}')
+
+        user = create_user()
+        run_id = TestRun.create(user.id, 'probe', '', 50)['id']
+        insert_samples(run_id, synthetic_samples(args.run_samples))
+        test_run = TestRun.find_by_id(run_id)
+
+        total = args.run_samples
+        for size in sorted(args.sizes):
+            while total < size:
+                count = min(args.history_run_samples, size - total)
+                history_id = TestRun.create(user.id, 'history', '', 50)['id']
+                insert_samples(history_id,
+                               synthetic_samples(count, seed=history_id))
+                total += count
+
+            results.append({
+                'total_samples': total,
+                'has_passed_threshold': measure(
+                    test_run.has_passed_threshold, args.repeat),
+                'get_test_execution_stats': measure(
+                    test_run.get_test_execution_stats, args.repeat),
+            })
+
+    report('stats_latency', results, run_samples=args.run_samples,
+           drop_indexes=args.drop_indexes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Bytes per sample of a finished run before and after its samples are
+compacted, with their indexes, on a synthetic 1M sample run:
+
+    python -m grasshopper.bench.storage_size --samples 1000000
+"""
+import argparse
+import os
+import time
+
+from flask import current_app
+
+from grasshopper.bench.common import (
+    create_user, insert_samples, report, synthetic_samples, temp_app
+)
+from grasshopper.tracker.model.db import get_db
+from grasshopper.tracker.model.testrun import TestRun
+
+
+def database_size():
+    db = get_db()
+    db.execute('VACUUM')
+    db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return os.path.getsize(current_app.config['DATABASE'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--samples', type=int, default=1000000)
+    args = parser.parse_args()
+
+    with temp_app():
+        user = create_user()
+        run_id = TestRun.create(user.id, 'storage', '', 50)['id']
+        empty = database_size()
+
+        insert_samples(run_id, synthetic_samples(args.samples))
+        test_run = TestRun.find_by_id(run_id)
+        test_run.fetch_stats()
+        raw = database_size() - empty
+
+        start = time.perf_counter()
+        test_run.finish()
+        compact_seconds = time.perf_counter() - start
+        compacted = database_size() - empty
+
+        start = time.perf_counter()
+        test_run.fetch_current_cpu_usage()
+        decode_seconds = time.perf_counter() - start
+
+    report('storage_size', {
+        'raw_bytes': raw,
+        'raw_bytes_per_sample': raw / args.samples,
+        'compacted_bytes': compacted,
+        'compacted_bytes_per_sample': compacted / args.samples,
+        'reduction': raw / compacted,
+        'compact_seconds': compact_seconds,
+        'fetch_current_cpu_usage_seconds': decode_seconds,
+    }, samples=args.samples)
+
+
+if __name__ == '__main__':
+    main()
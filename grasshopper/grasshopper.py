@@ -1,40 +1,95 @@
 #!/usr/bin/python3
 import argparse
 import asyncio
-import os
 from collections import namedtuple
 from contextlib import contextmanager
-import psutil
+import copy
+import json
+import shlex
 import requests
-from signal import SIGINT, SIGTERM, signal, getsignal
+from requests.adapters import HTTPAdapter
+from grasshopper.reporter import (
+    BufferedReporter, SpillingBuffer, TrackerBusyError, call_tracker
+)
+from grasshopper.sampler import (
+    ChangeFilter, ProcessTreeSampler, SharedSampler, SystemSampler
+)
+from grasshopper.spool import Spool, SpoolTracker, read_spool, remove_spool
+from grasshopper.transport import AsyncHTTPTransport
+from grasshopper import wire
+from signal import SIGINT, SIGTERM
+import os
+import sys
 import time
+import traceback
 import warnings
 
 BASE_PATH = '/v1/api/testrun'
 
+# Result of tracking a command: the stats of its testrun, None when it was
+# spooled, the return code of the command and the alert it was aborted on,
+# if any
+Outcome = namedtuple('Outcome', ['stats', 'returncode', 'aborted'])
+
+# Exit status of grasshopper once --abort-on-alert stopped a command
+ABORTED_EXIT_STATUS = 99
+
 
-class TrackerClient:
+class TrackerUnreachable(Exception):
+    pass
 
-    def __init__(self, jwt, server_url):
+
+class BaseTrackerClient:
+    """
+    State and response handling shared by the sync and async clients.
+    """
+
+    def __init__(self, jwt, server_url, timeout=5.0, wire_format='json',
+                 compress=False):
         self.jwt = jwt
         self.tracker_url = f"{server_url}"
+        self.testrun_url = f'{self.tracker_url}{BASE_PATH}'
         self.test_run_id = None
+        # The alert that made the tracker ask to abort the run, if any
+        self.abort = None
+        self.timeout = timeout
+        self.wire_format = wire_format
+        self.compress = compress
 
         if not self.jwt:
             raise Exception('No JWT token provided')
 
-        try:
-            requests.head(f'{self.tracker_url}{BASE_PATH}', timeout=1)
-        except requests.exceptions.ConnectionError:
-            raise Exception(f'Tracker unreachable {self.tracker_url}')
-
-    def create_testrun(self, name, description, threshold):
-        r = requests.post(f'{self.tracker_url}{BASE_PATH}', json={
+    def fork(self):
+        """
+        Return a client for another testrun, sharing the connections of
+        this one. Only this one is to be closed.
+        """
+        client = copy.copy(self)
+        client.test_run_id = None
+        client.abort = None
+        return client
+
+    @property
+    def default_headers(self):
+        return {'Authorization': f'Bearer {self.jwt}'}
+
+    @staticmethod
+    def testrun(name, description, threshold, start_time=None):
+        testrun = {
             'name': name,
             'description': description,
             'threshold': threshold
-        }, headers={'Authorization': f'Bearer {self.jwt}'})
+        }
+        # Runs uploaded from a spool started earlier
+        if start_time is not None:
+            testrun['start_time'] = start_time
+        return testrun
 
+    @staticmethod
+    def testrun_end(end_time=None):
+        return {'end_time': end_time} if end_time is not None else None
+
+    def testrun_created(self, r):
         if r.status_code != 201:
             raise Exception(f'Error creating testrun: {r.text}')
 
@@ -43,94 +98,705 @@ class TrackerClient:
                           ['id', 'start_time'])(self.test_run_id,
                                                 r.json().get('start_time'))
 
-    def record_usage(self, usage):
-        r = requests.post(
-            f'{self.tracker_url}{BASE_PATH}/{self.test_run_id}/usage',
-            json={'usage': usage},
-            headers={'Authorization': f'Bearer {self.jwt}'})
-
-    def stop_testrun(self):
-        stop_url = f'{self.tracker_url}{BASE_PATH}/{self.test_run_id}/stop'
-        r = requests.post(stop_url,
-                          headers={'Authorization': f'Bearer {self.jwt}'})
+    @staticmethod
+    def usage(sample, timestamp=None):
+        usage = sample.as_dict()
+        if timestamp is not None:
+            usage['timestamp'] = timestamp
+        return usage
+
+    @staticmethod
+    def usage_batch(samples):
+        return [dict(sample.as_dict(), timestamp=timestamp)
+                for sample, timestamp in samples]
+
+    def usage_batch_body(self, samples):
+        """
+        Return the arguments posting samples in the wire format of the
+        client, as JSON when they do not fit the binary one.
+        """
+        if self.wire_format == 'binary':
+            body = wire.encode_batch(samples, self.compress)
+            if body is not None:
+                headers = {'Content-Type': wire.CONTENT_TYPE}
+                if self.compress:
+                    headers['Content-Encoding'] = 'gzip'
+                return {'data': body, 'headers': headers}
+        return {'json': self.usage_batch(samples)}
+
+    @staticmethod
+    def check_available(r):
+        if r.status_code == 429:
+            retry_after = r.headers.get('retry-after')
+            raise TrackerBusyError(
+                f'Tracker busy: {r.status_code}',
+                float(retry_after) if retry_after and
+                retry_after.isdigit() else None)
+        if r.status_code >= 500:
+            raise Exception(f'Tracker unavailable: {r.status_code}')
+
+    def usage_recorded(self, r):
+        self.check_available(r)
+        if r.status_code not in (201, 202):
+            warnings.warn(f'Could not record usage: {r.text}')
+            return
+        self.check_abort(r.json())
+
+    def usage_batch_recorded(self, r):
+        self.check_available(r)
+        # 202 when the tracker queued the samples to commit them later
+        if r.status_code not in (201, 202):
+            warnings.warn(f'Could not record usage: {r.text}')
+            return None
+
+        result = r.json()
+        if result.get('rejected'):
+            warnings.warn(f'Tracker rejected samples: {result["rejected"]}')
+        self.check_abort(result)
+        return result
+
+    def check_abort(self, result):
+        if result.get('abort') and self.abort is None:
+            self.abort = result['abort']
+
+    @staticmethod
+    def testrun_stopped(r):
         if r.status_code != 200:
             warnings.warn(f'Could not stop testrun: {r.text}')
 
-    def get_testrun_stats(self):
-        r = requests.get(f'{self.tracker_url}{BASE_PATH}/{self.test_run_id}',
-                         headers={'Authorization': f'Bearer {self.jwt}'})
+    @staticmethod
+    def stats_received(r):
         if r.status_code != 200:
             warnings.warn(f'Could not get testrun stats: {r.text}')
         return r.json()
 
 
+class TrackerClient(BaseTrackerClient):
+
+    def __init__(self, jwt, server_url, pool_size=10, timeout=5.0,
+                 wire_format='json', compress=False):
+        super().__init__(jwt, server_url, timeout, wire_format, compress)
+
+        # One keep-alive session for the lifetime of the client, so that
+        # samples reuse pooled connections instead of opening a new one
+        # (and doing a new TLS handshake) per request.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update(self.default_headers)
+
+        try:
+            self.session.head(self.testrun_url, timeout=1)
+        except requests.exceptions.ConnectionError:
+            raise TrackerUnreachable(f'Tracker unreachable {self.tracker_url}')
+
+    def close(self):
+        self.session.close()
+
+    def post(self, path, **kwargs):
+        return self.session.post(f'{self.testrun_url}{path}',
+                                 timeout=self.timeout, **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.session.get(f'{self.testrun_url}{path}',
+                                timeout=self.timeout, **kwargs)
+
+    def create_testrun(self, name, description, threshold,
+                       start_time=None):
+        r = self.post('', json=self.testrun(name, description, threshold,
+                                            start_time))
+        return self.testrun_created(r)
+
+    def record_usage(self, sample, timestamp=None):
+        r = self.post(f'/{self.test_run_id}/usage',
+                      json=self.usage(sample, timestamp))
+        self.usage_recorded(r)
+
+    def record_usage_batch(self, samples):
+        """
+        Upload a list of (sample, timestamp) pairs. Raise an exception if
+        the tracker is temporarily unable to take them so they are retried.
+        """
+        r = self.post(f'/{self.test_run_id}/usage/batch',
+                      **self.usage_batch_body(samples))
+        return self.usage_batch_recorded(r)
+
+    def stop_testrun(self, end_time=None):
+        r = self.post(f'/{self.test_run_id}/stop',
+                      json=self.testrun_end(end_time))
+        self.testrun_stopped(r)
+
+    def get_testrun_stats(self):
+        r = self.get(f'/{self.test_run_id}')
+        return self.stats_received(r)
+
+
+class AsyncTrackerClient(BaseTrackerClient):
+    """
+    Non-blocking counterpart of TrackerClient, for use inside the event
+    loop. Call open() before any other method.
+    """
+
+    def __init__(self, jwt, server_url, pool_size=10, timeout=5.0,
+                 wire_format='json', compress=False):
+        super().__init__(jwt, server_url, timeout, wire_format, compress)
+        self.transport = AsyncHTTPTransport(self.testrun_url,
+                                            self.default_headers,
+                                            pool_size, timeout)
+
+    async def open(self):
+        try:
+            await self.transport.head('', timeout=1)
+        except (OSError, asyncio.TimeoutError):
+            raise TrackerUnreachable(f'Tracker unreachable {self.tracker_url}')
+
+    async def close(self):
+        await self.transport.close()
+
+    async def create_testrun(self, name, description, threshold,
+                             start_time=None):
+        r = await self.transport.post('', json=self.testrun(
+            name, description, threshold, start_time))
+        return self.testrun_created(r)
+
+    async def record_usage(self, sample, timestamp=None):
+        r = await self.transport.post(f'/{self.test_run_id}/usage',
+                                      json=self.usage(sample, timestamp))
+        self.usage_recorded(r)
+
+    async def record_usage_batch(self, samples):
+        r = await self.transport.post(f'/{self.test_run_id}/usage/batch',
+                                      **self.usage_batch_body(samples))
+        return self.usage_batch_recorded(r)
+
+    async def stop_testrun(self, end_time=None):
+        r = await self.transport.post(f'/{self.test_run_id}/stop',
+                                      json=self.testrun_end(end_time))
+        self.testrun_stopped(r)
+
+    async def get_testrun_stats(self):
+        r = await self.transport.get(f'/{self.test_run_id}')
+        return self.stats_received(r)
+
+
 class Runner:
     def __init__(self, tracker_client,
                  name=None, description=None, threshold=2,
-                 command=None, poll_interval=0.5):
+                 command=None, poll_interval=0.5, buffered_reporter=None,
+                 per_cpu=False, spool=None, shared_sampler=None,
+                 change_filter=None, abort_on_alert=False, max_uploads=10):
         self.tracker = tracker_client
         self.name = name
         self.description = description
         self.threshold = threshold
         self.command = command
         self.poll_interval = poll_interval
+        self.per_cpu = per_cpu
         self.runner = None
+        self.process = None
+        self.sampler = None
+        # Sampled by a MultiRunner along with the commands of other runners
+        self.shared_sampler = shared_sampler
+        # Reports only the samples that matter out of fast paced ones
+        self.change_filter = change_filter
+        self.abort_on_alert = abort_on_alert
+        self.aborted = None
         self.reporter = None
+        self.buffered_reporter = buffered_reporter
+        self.spool = spool
+        self.stopped = False
+        self.flusher = None
+        # Unbuffered samples are dropped while max_uploads are in flight,
+        # rather than piling up while the tracker is slow
+        self.uploads = set()
+        self.max_uploads = max_uploads
+        self.dropped = 0
         self.testrun_id = None
+        self.terminated = False
+
+    @property
+    def returncode(self):
+        """
+        The return code of the command once it ended, None before or
+        without a command.
+        """
+        return self.process.returncode if self.process is not None else None
+
+    def interrupt(self):
+        if self.runner is not None:
+            self.runner.cancel()
+
+    async def terminate_runner(self):
+        if self.terminated:
+            return
+        self.terminated = True
+        end_time = time.time()
+        if self.shared_sampler is not None:
+            self.shared_sampler.remove(self)
+
+        tasks = [t for t in (self.reporter, self.flusher, self.runner) if t]
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait(tasks)
+
+        if self.change_filter is not None:
+            last = self.change_filter.flush()
+            if last is not None:
+                self.emit(*last)
+        if self.uploads:
+            await asyncio.wait(self.uploads)
+        if self.dropped:
+            warnings.warn(f'Dropped {self.dropped} samples while the tracker '
+                          f'was slow')
+        if self.buffered_reporter is not None:
+            await self.buffered_reporter.drain()
+        if self.spool is None:
+            await call_tracker(self.tracker.stop_testrun)
+            self.stopped = True
+            return
+
+        # grasshopper upload stops the run once the rest of its samples
+        # made it to the tracker
+        self.spool.end(end_time)
+        if len(self.spool):
+            return
+        try:
+            await call_tracker(self.tracker.stop_testrun, end_time)
+        except Exception as e:
+            warnings.warn(f'Could not stop testrun: {e}')
+        else:
+            self.stopped = True
 
-    def terminate_runner(self, signum, frame):
-        self.reporter.cancel()
-        self.runner.cancel()
-        self.tracker.stop_testrun()
+    async def record_usage(self, sample, timestamp):
+        try:
+            await call_tracker(self.tracker.record_usage, sample, timestamp)
+        except Exception as e:
+            warnings.warn(f'Could not upload sample: {e}')
+
+    def upload_usage(self, sample, timestamp):
+        if len(self.uploads) >= self.max_uploads:
+            self.dropped += 1
+            return
+        upload = asyncio.create_task(self.record_usage(sample, timestamp))
+        self.uploads.add(upload)
+        upload.add_done_callback(self.uploads.discard)
+
+    def check_abort(self):
+        alert = getattr(self.tracker, 'abort', None)
+        if alert is None or self.aborted is not None:
+            return
+        self.aborted = alert
+        print(f"Grasshopper: alert {alert['rule']} fired for testrun "
+              f"{alert['test_run_id']}, aborting the command")
+        self.interrupt()
+
+    def report(self, sample):
+        if self.abort_on_alert:
+            self.check_abort()
+        timestamp = time.time()
+        if self.change_filter is not None:
+            sample = self.change_filter.offer(sample, timestamp)
+            if sample is None:
+                return
+        self.emit(sample, timestamp)
+
+    def emit(self, sample, timestamp):
+        if self.buffered_reporter is not None:
+            self.buffered_reporter.record(sample, timestamp)
+        else:
+            self.upload_usage(sample, timestamp)
 
     async def report_cpu_usage(self):
-        if self.testrun_id:
-            while True:
-                usage = psutil.cpu_percent()
-                self.tracker.record_usage(usage)
-                await asyncio.sleep(self.poll_interval)
-        else:
+        if not self.testrun_id:
             raise Exception("No testrun id to report usage")
 
-    def run_command(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            self.report(self.sampler.sample())
+
+            # Schedule against the loop clock rather than sleeping a fixed
+            # amount so the time spent sampling does not add up as drift.
+            next_tick = max(next_tick + self.poll_interval, loop.time())
+            await asyncio.sleep(next_tick - loop.time())
+
+    async def start_command(self):
         if self.command:
-            os.system(self.command)
+            self.process = await asyncio.create_subprocess_exec(
+                *self.command
+            )
+            if self.shared_sampler is not None:
+                self.shared_sampler.add(self, self.process.pid)
+            else:
+                self.sampler = ProcessTreeSampler(self.process.pid,
+                                                  self.per_cpu)
         else:
-            while True:
-                time.sleep(30)
+            self.sampler = SystemSampler(self.per_cpu)
 
-    @contextmanager
-    def terminate_runner_on_signal(self):
-        signals = [SIGINT, SIGTERM]
-        original_handlers = []
-        for sig in signals:
-            original_handlers.append(getsignal(sig))
-            signal(sig, self.terminate_runner)
+    async def run_command(self):
+        if self.process is None:
+            await asyncio.Future()
 
         try:
-            yield
-        finally:
-            for sig, original_handler in zip(signals, original_handlers):
-                signal(sig, original_handler)
+            await self.process.wait()
+        except asyncio.CancelledError:
+            await self.stop_command()
+            raise
+
+    async def stop_command(self, grace_period=5):
+        if self.process.returncode is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), grace_period)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+
+    def terminate_runner_on_signal(self):
+        return interrupt_on_signal(self.interrupt)
 
     async def run(self):
         with self.terminate_runner_on_signal():
-            self.testrun_id = self.tracker.create_testrun(self.name,
-                                                          self.description,
-                                                          self.threshold)
+            await self.execute()
+
+    async def execute(self):
+        self.testrun_id = await call_tracker(self.tracker.create_testrun,
+                                             self.name,
+                                             self.description,
+                                             self.threshold)
 
-            print(f"Grasshopper: registered testrun id: {self.testrun_id}")
+        print(f"Grasshopper: registered testrun id: {self.testrun_id}")
+        if self.spool is not None:
+            self.spool.begin(self.name, self.description, self.threshold,
+                             time.time(), self.testrun_id.id)
 
+        try:
+            await self.start_command()
+        except OSError:
+            await call_tracker(self.tracker.stop_testrun)
+            raise
+
+        if self.shared_sampler is None:
             self.reporter = asyncio.create_task(self.report_cpu_usage())
-            self.runner = asyncio.create_task(
-                asyncio.to_thread(self.run_command)
+        if self.buffered_reporter is not None:
+            self.flusher = asyncio.create_task(
+                self.buffered_reporter.run()
             )
+        self.runner = asyncio.create_task(self.run_command())
+
+        await asyncio.wait([self.runner])
+        await self.terminate_runner()
+
 
-            await asyncio.wait([self.runner, self.reporter],
-                               return_when=asyncio.ALL_COMPLETED)
+class MultiRunner:
+    """
+    Runs the commands of several runners at once, each in its own
+    testrun, sampling all of them every tick with the SharedSampler they
+    were given. Return the result of every runner, or the exception it
+    failed with, without failing the others.
+    """
+
+    def __init__(self, runners, sampler, poll_interval=0.5):
+        self.runners = runners
+        self.sampler = sampler
+        self.poll_interval = poll_interval
+
+    def interrupt(self):
+        for runner in self.runners:
+            runner.interrupt()
+
+    async def report_cpu_usage(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            for runner, sample in self.sampler.sample_all().items():
+                runner.report(sample)
+
+            next_tick = max(next_tick + self.poll_interval, loop.time())
+            await asyncio.sleep(next_tick - loop.time())
+
+    async def run(self):
+        with interrupt_on_signal(self.interrupt):
+            reporter = asyncio.create_task(self.report_cpu_usage())
+            try:
+                return await asyncio.gather(
+                    *(runner.execute() for runner in self.runners),
+                    return_exceptions=True)
+            finally:
+                reporter.cancel()
+                await asyncio.wait([reporter])
+
+
+@contextmanager
+def interrupt_on_signal(interrupt):
+    loop = asyncio.get_running_loop()
+    signals = [SIGINT, SIGTERM]
+    for sig in signals:
+        loop.add_signal_handler(sig, interrupt)
+
+    try:
+        yield
+    finally:
+        for sig in signals:
+            loop.remove_signal_handler(sig)
+
+
+async def open_tracker_client(args):
+    if args.transport == 'sync':
+        return TrackerClient(args.jwt, args.server,
+                             args.pool_size, args.timeout,
+                             args.wire_format, args.compress)
+
+    tracker_client = AsyncTrackerClient(args.jwt, args.server,
+                                        args.pool_size, args.timeout,
+                                        args.wire_format, args.compress)
+    await tracker_client.open()
+    return tracker_client
+
+
+def sampling_interval(args):
+    return args.sample_interval if args.adaptive else args.poll_interval
+
+
+def change_filter(args, threshold):
+    if not args.adaptive:
+        return None
+    return ChangeFilter(args.tolerance, threshold, args.heartbeat)
+
+
+async def track(args):
+    spool = Spool(args.spool, create=True) if args.spool else None
+    if args.offline:
+        tracker_client = SpoolTracker(spool)
+    else:
+        try:
+            tracker_client = await open_tracker_client(args)
+        except TrackerUnreachable as e:
+            if spool is None:
+                raise
+            print(f"Grasshopper: {e}, spooling the run to {spool.path}")
+            tracker_client = SpoolTracker(spool)
+    offline = isinstance(tracker_client, SpoolTracker)
+
+    buffered_reporter = None
+    if args.buffered or (spool is not None and not offline):
+        buffered_reporter = BufferedReporter(
+            tracker_client, args.flush_interval, args.max_batch,
+            args.buffer_size,
+            buffer=SpillingBuffer(args.buffer_size, spool)
+            if spool is not None and not offline else None)
+    runner = Runner(tracker_client, args.name, args.description,
+                    args.threshold, args.command,
+                    sampling_interval(args), buffered_reporter, args.per_cpu,
+                    None if offline else spool,
+                    change_filter=change_filter(args, args.threshold),
+                    abort_on_alert=args.abort_on_alert,
+                    max_uploads=args.pool_size)
+
+    await runner.run()
+
+    if spool is not None and (offline or len(spool) or not runner.stopped):
+        print(f"Grasshopper: {len(spool) if not offline else spool.samples} "
+              f"samples spooled to {spool.path}, upload them with: "
+              f"grasshopper upload {spool.path}")
+        await call_tracker(tracker_client.close)
+        spool.close()
+        return Outcome(None, runner.returncode, runner.aborted)
+
+    stats = await call_tracker(tracker_client.get_testrun_stats)
+    await call_tracker(tracker_client.close)
+    if spool is not None:
+        # Everything made it to the tracker
+        remove_spool(spool)
+    return Outcome(stats, runner.returncode, runner.aborted)
+
+
+async def track_many(args, commands):
+    """
+    Run commands, dicts of the command, name, description and threshold
+    of their testrun, concurrently. The testruns share the connections of
+    one tracker client and the samples of one SharedSampler. Return the
+    Outcome of every command, or the exception it failed with.
+    """
+    tracker_client = await open_tracker_client(args)
+    sampler = SharedSampler(args.per_cpu)
+    runners = []
+    for command in commands:
+        client = tracker_client.fork()
+        buffered_reporter = BufferedReporter(
+            client, args.flush_interval, args.max_batch, args.buffer_size
+        ) if args.buffered else None
+        runners.append(Runner(client, command['name'],
+                              command['description'], command['threshold'],
+                              command['command'], sampling_interval(args),
+                              buffered_reporter, args.per_cpu,
+                              shared_sampler=sampler,
+                              change_filter=change_filter(
+                                  args, command['threshold']),
+                              abort_on_alert=args.abort_on_alert,
+                              max_uploads=args.pool_size))
+
+    results = await MultiRunner(runners, sampler,
+                                sampling_interval(args)).run()
+
+    outcomes = []
+    for runner, result in zip(runners, results):
+        if isinstance(result, BaseException):
+            outcomes.append(result)
+        else:
+            stats = await call_tracker(runner.tracker.get_testrun_stats)
+            outcomes.append(Outcome(stats, runner.returncode,
+                                    runner.aborted))
+    await call_tracker(tracker_client.close)
+    return outcomes
+
+
+def read_manifest(path):
+    """
+    Return the commands of a manifest, a JSON list of commands, each a
+    list of arguments or a string split like a shell would, or an object
+    with the command and the name, description and threshold of its
+    testrun.
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    if not isinstance(manifest, list):
+        raise Exception(f'{path} is not a list of commands')
+    return [entry if isinstance(entry, dict) else {'command': entry}
+            for entry in manifest]
+
+
+def command_testrun(command, threshold):
+    """
+    Fill the testrun of a command of a manifest or of --cmd, named after
+    the command by default.
+    """
+    arguments = command['command']
+    if isinstance(arguments, str):
+        arguments = shlex.split(arguments)
+    if not arguments:
+        raise Exception(f'Empty command in {command}')
+    return {
+        'command': arguments,
+        'name': command.get('name') or arguments[0],
+        'description': command.get('description')
+        or ' '.join(arguments[1:]),
+        'threshold': command.get('threshold', threshold),
+    }
+
+
+def exit_status(returncode):
+    """
+    Exit status passing on the return code of a command, 128 plus the
+    signal number for one killed by a signal, as shells do.
+    """
+    if returncode is None:
+        return 0
+    return 128 - returncode if returncode < 0 else returncode
+
+
+def upload(tracker_client, path, max_batch=1000, max_retries=5):
+    """
+    Replay the run of a spool that is not on the tracker yet, resuming
+    from the last acknowledged sample, and stop it. Return its stats, or
+    None if it was uploaded before.
+    """
+    contents = read_spool(path)
+    if contents.uploaded:
+        return None
+    if contents.run is None:
+        raise Exception(f'No testrun in {path}')
+
+    spool = Spool(path, end=contents.end)
+    try:
+        run = contents.run
+        if contents.test_run_id is None:
+            test_run = tracker_client.create_testrun(
+                run['name'], run['description'], run['threshold'],
+                run['start_time'])
+            spool.created(test_run.id)
+        else:
+            tracker_client.test_run_id = contents.test_run_id
+
+        samples = contents.samples
+        for start in range(0, len(samples), max_batch):
+            batch = samples[start:start + max_batch]
+            for attempt in range(max_retries + 1):
+                try:
+                    result = tracker_client.record_usage_batch(
+                        [(sample, timestamp) for _, sample, timestamp
+                         in batch])
+                    break
+                except TrackerBusyError as e:
+                    if attempt == max_retries:
+                        raise
+                    time.sleep(e.retry_after or 2 ** attempt)
+            if result is None:
+                raise Exception(f'Could not upload the samples of {path}')
+            spool.acknowledge(batch[-1][0])
+
+        end_time = contents.end_time
+        if end_time is None:
+            # The run was interrupted, it ended with its last sample
+            end_time = samples[-1][2] if samples else run['start_time']
+        tracker_client.stop_testrun(end_time)
+        spool.uploaded()
+    finally:
+        spool.close()
+    return tracker_client.get_testrun_stats()
+
+
+def upload_cli(argv):
+    parser = argparse.ArgumentParser(
+        prog='grasshopper upload',
+        description='Upload the runs spooled by grasshopper --spool.')
+    parser.add_argument('--jwt', type=str,
+                        help='The JWT token to authenticate with the API')
+    parser.add_argument('--server', type=str, default='http://127.0.0.1:5000',
+                        help='The URL of the server to connect to.')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='The timeout in seconds of every request to '
+                             'the server.')
+    parser.add_argument('--max-batch', type=int, default=1000,
+                        help='The number of samples uploaded at once.')
+    parser.add_argument('--wire-format', choices=['json', 'binary'],
+                        default='json',
+                        help='Upload batches of samples as JSON or in the '
+                             'compact binary format.')
+    parser.add_argument('--compress', action='store_true',
+                        help='Gzip the batches uploaded in the binary '
+                             'format.')
+    parser.add_argument('--debug', action='store_true',
+                        help='Run grasshopper in debug mode.')
+    parser.add_argument('spool', nargs='+', help='The spools to upload.')
+    args = parser.parse_args(argv)
+
+    try:
+        tracker_client = TrackerClient(args.jwt, args.server,
+                                       timeout=args.timeout,
+                                       wire_format=args.wire_format,
+                                       compress=args.compress)
+        for path in args.spool:
+            stats = upload(tracker_client, path, args.max_batch)
+            if stats is None:
+                print(f"{path}: already uploaded")
+            else:
+                print(f"{path}: testrun stats: {stats}")
+        tracker_client.close()
+    except Exception as e:
+        if args.debug:
+            raise e
+        else:
+            print(f"An error occurred: {e}")
+        exit(1)
 
 
 def grasshopper_cli():
+    if sys.argv[1:2] == ['upload']:
+        return upload_cli(sys.argv[2:])
+
     parser = argparse.ArgumentParser(description='''
                         Grasshopper tracks the cpu usage of your tests
                         suites, programs, or any other command you want
@@ -145,11 +811,79 @@ def grasshopper_cli():
                         help='The threshold for the testrun.')
     parser.add_argument('--poll-interval', type=float, default=0.5,
                         help='The interval in seconds to poll the CPU usage.')
+    parser.add_argument('--per-cpu', action='store_true',
+                        help='Also report the usage of every CPU core.')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Sample every --sample-interval but only '
+                             'report the usage when it changes by more '
+                             'than --tolerance, crosses the threshold, or '
+                             'every --heartbeat seconds. Replaces '
+                             '--poll-interval.')
+    parser.add_argument('--sample-interval', type=float, default=0.05,
+                        help='The interval in seconds to sample the CPU '
+                             'usage with --adaptive.')
+    parser.add_argument('--tolerance', type=float, default=5.0,
+                        help='The change in percentage points of the CPU '
+                             'usage that is reported with --adaptive.')
+    parser.add_argument('--heartbeat', type=float, default=5.0,
+                        help='The longest time in seconds without a report '
+                             'with --adaptive.')
     parser.add_argument('--server', type=str, default='http://127.0.0.1:5000',
                         help='The URL of the server to connect to.')
+    parser.add_argument('--timeout', type=float, default=5.0,
+                        help='The timeout in seconds of every request to '
+                             'the server.')
+    parser.add_argument('--pool-size', type=int, default=10,
+                        help='The number of keep-alive connections kept '
+                             'open to the server, and of samples uploading '
+                             'at a time without --buffered.')
+    parser.add_argument('--transport', choices=['async', 'sync'],
+                        default='async',
+                        help='Talk to the server from the event loop '
+                             '(async) or from worker threads using '
+                             'requests (sync).')
     parser.add_argument('--no-command', action='store_true',
                         help='Run grasshopper to just listen for the cpu '
                              'usage until is terminated.')
+    parser.add_argument('--buffered', action='store_true',
+                        help='Buffer samples in memory and upload them in '
+                             'batches from a background task.')
+    parser.add_argument('--flush-interval', type=float, default=5.0,
+                        help='The maximum age in seconds of a buffered '
+                             'sample before it is uploaded.')
+    parser.add_argument('--max-batch', type=int, default=100,
+                        help='The number of buffered samples that triggers '
+                             'an upload.')
+    parser.add_argument('--buffer-size', type=int, default=10000,
+                        help='The maximum number of samples kept in memory '
+                             'while the tracker is unreachable.')
+    parser.add_argument('--wire-format', choices=['json', 'binary'],
+                        default='json',
+                        help='Upload batches of samples as JSON or in the '
+                             'compact binary format.')
+    parser.add_argument('--compress', action='store_true',
+                        help='Gzip the batches uploaded in the binary '
+                             'format.')
+    parser.add_argument('--abort-on-alert', action='store_true',
+                        help='Stop the command when an alert rule of the '
+                             'tracker asks to abort its testrun, and exit '
+                             f'with status {ABORTED_EXIT_STATUS}.')
+    parser.add_argument('--spool', type=str,
+                        help='A new file to keep the samples the tracker '
+                             'cannot take in, instead of dropping them. The '
+                             'run is spooled there entirely if the tracker '
+                             'is unreachable. Implies --buffered.')
+    parser.add_argument('--offline', action='store_true',
+                        help='Do not contact the tracker, spool the run for '
+                             'grasshopper upload.')
+    parser.add_argument('--cmd', action='append', default=[],
+                        help='A command to run and measure in its own '
+                             'testrun, concurrently with the other --cmd. '
+                             'May be repeated.')
+    parser.add_argument('--manifest', type=str,
+                        help='A JSON file listing the commands to run and '
+                             'measure concurrently, each in its own '
+                             'testrun.')
     parser.add_argument('--debug', action='store_true',
                         help='Run grasshopper in debug mode.')
     parser.add_argument('command', nargs='*',
@@ -157,6 +891,17 @@ def grasshopper_cli():
 
     args = parser.parse_args()
 
+    if args.cmd or args.manifest:
+        return track_many_cli(args)
+
+    if args.offline and not args.spool:
+        print("The --offline flag needs a --spool file")
+        exit(1)
+    if args.spool and os.path.exists(args.spool):
+        print(f"The spool {args.spool} already exists, upload it with "
+              f"grasshopper upload first")
+        exit(1)
+
     if args.no_command and args.command:
         print("The --no-command flag cannot be used with a command")
         exit(1)
@@ -176,15 +921,36 @@ def grasshopper_cli():
                 args.description = "No description"
 
     try:
-        tracker_client = TrackerClient(args.jwt, args.server)
-        runner = Runner(tracker_client, args.name, args.description,
-                        args.threshold, args.command,
-                        args.poll_interval)
+        outcome = asyncio.run(track(args))
+        if outcome.stats is not None:
+            print(f"Testrun stats: {outcome.stats}")
+    except Exception as e:
+        if args.debug:
+            raise e
+        else:
+            print(f"An error occurred: {e}")
+        exit(1)
+    if outcome.aborted is not None:
+        exit(ABORTED_EXIT_STATUS)
+    exit(exit_status(outcome.returncode))
 
-        asyncio.get_event_loop().run_until_complete(runner.run())
 
-        stats = tracker_client.get_testrun_stats()
-        print(f"Testrun stats: {stats}")
+def track_many_cli(args):
+    if args.command or args.no_command:
+        print("The --cmd and --manifest options cannot be used with a "
+              "command or the --no-command flag")
+        exit(1)
+    if args.spool or args.offline:
+        print("The --spool and --offline flags track a single command")
+        exit(1)
+
+    try:
+        commands = [{'command': command} for command in args.cmd]
+        if args.manifest:
+            commands += read_manifest(args.manifest)
+        commands = [command_testrun(command, args.threshold)
+                    for command in commands]
+        results = asyncio.run(track_many(args, commands))
     except Exception as e:
         if args.debug:
             raise e
@@ -192,6 +958,21 @@ def grasshopper_cli():
             print(f"An error occurred: {e}")
         exit(1)
 
+    # The worst of the commands, 1 for the ones that could not be run
+    status = 0
+    aborted = False
+    for command, result in zip(commands, results):
+        if isinstance(result, BaseException):
+            status = max(status, 1)
+            if args.debug:
+                traceback.print_exception(result)
+            print(f"{command['name']}: an error occurred: {result}")
+        else:
+            status = max(status, exit_status(result.returncode))
+            aborted = aborted or result.aborted is not None
+            print(f"{command['name']}: testrun stats: {result.stats}")
+    exit(ABORTED_EXIT_STATUS if aborted else status)
+
 
 if __name__ == '__main__':
     grasshopper_cli()
@@ -0,0 +1,214 @@
+import asyncio
+from collections import deque
+import inspect
+import time
+import warnings
+
+
+class TrackerBusyError(Exception):
+    """
+    The tracker cannot take more samples for now. retry_after is the delay
+    it asked for, in seconds, if any.
+    """
+
+    def __init__(self, msg, retry_after=None):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+async def call_tracker(method, *args):
+    """
+    Call a tracker client method without blocking the event loop, whether
+    it belongs to the async client or to the requests based one.
+    """
+    if inspect.iscoroutinefunction(method):
+        return await method(*args)
+    return await asyncio.to_thread(method, *args)
+
+
+class SampleBuffer:
+    """
+    Bounded FIFO of (sample, timestamp) pairs. When full, the oldest
+    samples are discarded to make room for new ones.
+    """
+    # Whether the samples left in it outlive grasshopper
+    durable = False
+
+    def __init__(self, maxsize):
+        self.samples = deque(maxlen=maxsize)
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def append(self, sample, timestamp):
+        if len(self.samples) == self.samples.maxlen:
+            self.dropped += 1
+        self.samples.append((sample, timestamp))
+
+    def take(self, count):
+        return [self.samples.popleft()
+                for _ in range(min(count, len(self.samples)))]
+
+    def put_back(self, batch):
+        """
+        Return a batch that could not be delivered to the front of the
+        buffer, dropping its oldest samples if there is no room left.
+        """
+        room = self.samples.maxlen - len(self.samples)
+        if len(batch) > room:
+            self.dropped += len(batch) - room
+            batch = batch[len(batch) - room:]
+        self.samples.extendleft(reversed(batch))
+
+    def oldest_timestamp(self):
+        if not self.samples:
+            return None
+        return self.samples[0][1]
+
+
+class SpillingBuffer(SampleBuffer):
+    """
+    SampleBuffer that moves its samples to a spool on disk instead of
+    dropping them, once it is full or their upload failed, and keeps
+    appending new ones there until the spool is replayed, so that the
+    samples are uploaded in order.
+    """
+    durable = True
+
+    def __init__(self, maxsize, spool):
+        super().__init__(maxsize)
+        self.spool = spool
+        self.from_spool = False
+
+    def __len__(self):
+        return len(self.samples) + len(self.spool)
+
+    def spill(self, batch=()):
+        self.spool.extend([*batch, *self.samples])
+        self.samples.clear()
+
+    def append(self, sample, timestamp):
+        if len(self.spool) or len(self.samples) == self.samples.maxlen:
+            self.spill()
+            self.spool.append(sample, timestamp)
+        else:
+            self.samples.append((sample, timestamp))
+
+    def take(self, count):
+        self.from_spool = bool(len(self.spool))
+        if self.from_spool:
+            return self.spool.take(count)
+        self.spool.acknowledge()
+        return super().take(count)
+
+    def put_back(self, batch):
+        if self.from_spool:
+            self.spool.put_back(batch)
+        else:
+            self.spill(batch)
+
+    def oldest_timestamp(self):
+        if len(self.spool):
+            return self.spool.oldest_timestamp()
+        return super().oldest_timestamp()
+
+
+class BufferedReporter:
+    """
+    Collects samples in memory and ships them to the tracker in batches,
+    either when max_batch samples are pending or when the oldest pending
+    sample is older than flush_interval seconds.
+    """
+
+    def __init__(self, tracker, flush_interval=5.0, max_batch=100,
+                 buffer_size=10000, retry_backoff=0.5, max_backoff=30.0,
+                 drain_retries=3, buffer=None):
+        self.tracker = tracker
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.buffer = buffer if buffer is not None \
+            else SampleBuffer(buffer_size)
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.drain_retries = drain_retries
+        self.retry_after = None
+        self.batch_ready = asyncio.Event()
+        self.in_flight = None
+
+    def record(self, sample, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self.buffer.append(sample, timestamp)
+        if len(self.buffer) >= self.max_batch:
+            self.batch_ready.set()
+
+    def next_flush_delay(self):
+        oldest = self.buffer.oldest_timestamp()
+        if oldest is None:
+            return self.flush_interval
+        return max(0, oldest + self.flush_interval - time.time())
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.batch_ready.wait(),
+                                       timeout=self.next_flush_delay())
+            except asyncio.TimeoutError:
+                pass
+            self.batch_ready.clear()
+            await self.flush()
+
+    async def flush(self, max_retries=None):
+        failures = 0
+        while self.buffer:
+            batch = self.buffer.take(self.max_batch)
+            # Shielded so that cancelling the flusher lets an upload that
+            # is already on the wire finish, see drain().
+            self.in_flight = asyncio.ensure_future(self.upload(batch))
+            delivered = await asyncio.shield(self.in_flight)
+            self.in_flight = None
+            if delivered:
+                failures = 0
+                continue
+
+            failures += 1
+            if max_retries is not None and failures > max_retries:
+                break
+            delay = min(self.retry_backoff * 2 ** (failures - 1),
+                        self.max_backoff)
+            if self.retry_after is not None:
+                delay = max(delay, self.retry_after)
+            warnings.warn(f'Retrying upload in {delay:.1f}s')
+            await asyncio.sleep(delay)
+
+    async def upload(self, batch):
+        self.retry_after = None
+        try:
+            await call_tracker(self.tracker.record_usage_batch, batch)
+        except TrackerBusyError as e:
+            self.buffer.put_back(batch)
+            self.retry_after = e.retry_after
+            warnings.warn(f'Could not upload {len(batch)} samples: {e}')
+            return False
+        except Exception as e:
+            self.buffer.put_back(batch)
+            warnings.warn(f'Could not upload {len(batch)} samples: {e}')
+            return False
+        return True
+
+    async def drain(self):
+        """
+        Upload every pending sample once the flusher has been cancelled,
+        giving up after a few failed attempts.
+        """
+        if self.in_flight is not None:
+            await self.in_flight
+            self.in_flight = None
+        await self.flush(self.drain_retries)
+
+        lost = self.buffer.dropped
+        if not self.buffer.durable:
+            lost += len(self.buffer)
+        if lost:
+            warnings.warn(f'Lost {lost} samples that could not be uploaded')
@@ -0,0 +1,242 @@
+from collections import defaultdict, namedtuple
+
+import psutil
+
+
+class Sample(namedtuple('Sample',
+                        ['usage', 'rss', 'threads', 'io_read', 'io_write',
+                         'per_cpu'],
+                        defaults=(None, None, None, None, None))):
+    """
+    A single measurement. Only usage is mandatory, the process metrics are
+    left as None when sampling the whole system and per_cpu is only set
+    when per core sampling is enabled.
+    """
+
+    def as_dict(self):
+        return {k: v for k, v in self._asdict().items() if v is not None}
+
+
+def per_cpu_usage():
+    return psutil.cpu_percent(percpu=True)
+
+
+class SystemSampler:
+    """
+    Samples the CPU usage of the whole system, and of each core if
+    per_cpu is set.
+    """
+
+    def __init__(self, per_cpu=False):
+        self.per_cpu = per_cpu
+
+    def sample(self):
+        if self.per_cpu:
+            cores = per_cpu_usage()
+            return Sample(sum(cores) / len(cores), per_cpu=cores)
+        return Sample(psutil.cpu_percent())
+
+
+class SharedSampler:
+    """
+    Samples the process trees of several commands at once, every tick
+    returning a sample per command added with add(). The processes of the
+    system are listed once per tick to find the descendants of all the
+    commands and the per core usage, if per_cpu is set, is read once for
+    all of them, so the cost of a tick grows with the number of processes
+    measured rather than with the number of commands.
+
+    The CPU usage is reported as a percentage of the whole machine, like
+    SystemSampler does, so the same thresholds apply in both modes. I/O
+    counters are the bytes read and written since the previous sample. Per
+    core usage is the one of the whole system since psutil cannot
+    attribute it to processes.
+
+    psutil.Process handles are kept across samples: they are what makes
+    cpu_percent() meaningful and saves looking processes up every tick.
+    """
+
+    def __init__(self, per_cpu=False):
+        self.per_cpu = per_cpu
+        self.cpu_count = psutil.cpu_count() or 1
+        self.roots = {}
+        self.processes = {}
+        self.io_counters = {}
+
+    def add(self, key, pid):
+        self.roots[key] = pid
+
+    def remove(self, key):
+        self.roots.pop(key, None)
+
+    def children(self):
+        """
+        Return the children of every process, or None when there is a
+        single tree to sample and psutil can walk it on its own.
+        """
+        if len(self.roots) < 2:
+            return None
+        children = defaultdict(list)
+        for process in psutil.process_iter(['ppid']):
+            children[process.info['ppid']].append(process)
+        return children
+
+    def process_tree(self, pid, children):
+        root = self.processes.get(pid) or psutil.Process(pid)
+        if children is None:
+            descendants = root.children(recursive=True)
+        elif not root.is_running():
+            raise psutil.NoSuchProcess(pid)
+        else:
+            descendants = []
+            parents = [pid]
+            while parents:
+                for child in children.get(parents.pop(), ()):
+                    descendants.append(child)
+                    parents.append(child.pid)
+
+        tree = [root]
+        for child in descendants:
+            cached = self.processes.get(child.pid)
+            # Same pid and creation time, otherwise the pid was reused
+            tree.append(cached if cached == child else child)
+        return tree
+
+    def sample_all(self):
+        children = self.children()
+        per_cpu = per_cpu_usage() if self.per_cpu else None
+        samples = {}
+        processes = {}
+        io_counters = {}
+        for key, pid in self.roots.items():
+            try:
+                tree = self.process_tree(pid, children)
+            except psutil.NoSuchProcess:
+                samples[key] = Sample(0.0, 0, 0, 0, 0)
+                continue
+            samples[key] = self.measure(tree, processes, io_counters,
+                                        per_cpu)
+
+        self.processes = processes
+        self.io_counters = io_counters
+        return samples
+
+    def measure(self, tree, processes, io_counters, per_cpu):
+        usage = 0.0
+        rss = threads = io_read = io_write = 0
+        for process in tree:
+            try:
+                with process.oneshot():
+                    usage += process.cpu_percent()
+                    rss += process.memory_info().rss
+                    threads += process.num_threads()
+                    io = process.io_counters() \
+                        if hasattr(process, 'io_counters') else None
+            except psutil.AccessDenied:
+                io = None
+            except psutil.NoSuchProcess:
+                continue
+
+            processes[process.pid] = process
+            if io is not None:
+                last_read, last_write = self.io_counters.get(process.pid,
+                                                             (0, 0))
+                io_read += max(0, io.read_bytes - last_read)
+                io_write += max(0, io.write_bytes - last_write)
+                io_counters[process.pid] = (io.read_bytes, io.write_bytes)
+
+        return Sample(usage / self.cpu_count, rss, threads, io_read,
+                      io_write, per_cpu)
+
+
+class ProcessTreeSampler(SharedSampler):
+    """
+    Samples a process and all its descendants, see SharedSampler.
+    """
+
+    def __init__(self, pid, per_cpu=False):
+        super().__init__(per_cpu)
+        self.pid = pid
+        self.add(pid, pid)
+
+    def sample(self):
+        return self.sample_all()[self.pid]
+
+
+def above(usage, threshold):
+    return threshold is not None and usage > threshold
+
+
+def add_io(sample, earlier):
+    """
+    Add the I/O of an earlier sample to the one of sample, where both are
+    known.
+    """
+    return sample._replace(**{
+        counter: getattr(sample, counter) + getattr(earlier, counter)
+        for counter in ('io_read', 'io_write')
+        if getattr(sample, counter) is not None
+        and getattr(earlier, counter) is not None
+    })
+
+
+class ChangeFilter:
+    """
+    Picks the samples worth reporting out of the ones taken at a fast
+    pace: the first one, the ones whose usage moved by more than tolerance
+    percentage points from the last one reported, the ones where the usage
+    or the usage of the hottest core crossed threshold, and one every
+    heartbeat seconds otherwise.
+
+    The tracker holds every sample until the next one, so in between the
+    usage stays within tolerance of the reported one and the time above
+    threshold is the one seen at the fast pace. The I/O of the samples
+    left out is added to the next one reported, so no bytes are lost.
+    """
+
+    def __init__(self, tolerance=5.0, threshold=None, heartbeat=5.0):
+        self.tolerance = tolerance
+        self.threshold = threshold
+        self.heartbeat = heartbeat
+        self.last = None
+        self.last_time = None
+        # The last sample left out, with its timestamp
+        self.pending = None
+
+    def changed(self, sample, timestamp):
+        last = self.last
+        if last is None or timestamp - self.last_time >= self.heartbeat:
+            return True
+        if abs(sample.usage - last.usage) > self.tolerance:
+            return True
+        if above(sample.usage, self.threshold) != \
+                above(last.usage, self.threshold):
+            return True
+        return bool(sample.per_cpu) and bool(last.per_cpu) and \
+            above(max(sample.per_cpu), self.threshold) != \
+            above(max(last.per_cpu), self.threshold)
+
+    def offer(self, sample, timestamp):
+        """
+        Return the sample, with the I/O of the ones left out before it, if
+        it is to be reported, None otherwise.
+        """
+        if self.pending is not None:
+            sample = add_io(sample, self.pending[0])
+        if not self.changed(sample, timestamp):
+            self.pending = (sample, timestamp)
+            return None
+        self.pending = None
+        self.last, self.last_time = sample, timestamp
+        return sample
+
+    def flush(self):
+        """
+        Return the last (sample, timestamp) taken if it was left out, to be
+        reported when sampling stops, so that the run does not end with the
+        last change. None otherwise.
+        """
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            self.last, self.last_time = pending
+        return pending
@@ -0,0 +1,288 @@
+"""
+Append-only, on disk log of a run, for the samples the tracker could not
+take and for runs made without a tracker at all.
+
+A spool starts with MAGIC and is followed by records, each a kind byte
+and the length of its payload:
+
+    R  the run: JSON of its name, description, threshold, start_time and
+       id, the latter None until the run exists on the tracker
+    I  JSON of the id the run got when it was uploaded
+    S  a sample, packed as SAMPLE followed by its per core usages
+    A  offset in the spool up to which the samples were uploaded
+    E  JSON of the end_time of the run
+    U  the run is stopped on the tracker, nothing left to upload
+
+Records are flushed as they are written. A record cut short by a crash
+is ignored, along with everything after it, and cut off when the spool
+is opened again to append to it.
+"""
+from collections import namedtuple
+import json
+import os
+import struct
+import time
+
+from grasshopper.sampler import Sample
+
+MAGIC = b'GHSPOOL1'
+RECORD = struct.Struct('<cI')
+# timestamp, usage, rss, threads, io_read, io_write, number of cores
+SAMPLE = struct.Struct('<ddqqqqH')
+ACK = struct.Struct('<Q')
+MISSING = -1
+
+TestRun = namedtuple('TestRun', ['id', 'start_time'])
+
+
+class SpoolError(Exception):
+    pass
+
+
+def encode_sample(sample, timestamp):
+    per_cpu = sample.per_cpu or []
+    return SAMPLE.pack(
+        timestamp, sample.usage,
+        *(MISSING if value is None else value
+          for value in (sample.rss, sample.threads,
+                        sample.io_read, sample.io_write)),
+        len(per_cpu),
+    ) + struct.pack(f'<{len(per_cpu)}f', *per_cpu)
+
+
+def decode_sample(payload):
+    """
+    Return the (sample, timestamp) pair packed in a S record.
+    """
+    timestamp, usage, *metrics, cores = SAMPLE.unpack_from(payload)
+    per_cpu = struct.unpack_from(f'<{cores}f', payload, SAMPLE.size)
+    metrics = [None if value == MISSING else value for value in metrics]
+    return Sample(usage, *metrics, list(per_cpu) if cores else None), \
+        timestamp
+
+
+def iter_records(f):
+    """
+    Yield the (kind, payload, offset after it) of the records of a spool
+    open for reading, from its current position.
+    """
+    while True:
+        header = f.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return
+        kind, length = RECORD.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length:
+            return
+        yield kind, payload, f.tell()
+
+
+def records_end(f):
+    """
+    Return the offset after the last complete record of a spool open for
+    reading, from its current position.
+    """
+    end = f.tell()
+    for _, _, end in iter_records(f):
+        pass
+    return end
+
+
+class Spool:
+    """
+    Writer of a spool file, which also replays its samples in order, as a
+    queue: take() returns the next ones and put_back() the ones that could
+    not be uploaded. A batch taken and not put back is acknowledged on the
+    next take() or on close().
+    """
+
+    def __init__(self, path, create=False, end=None):
+        self.path = path
+        self.file = open(path, 'xb' if create else 'r+b')
+        if create:
+            self.file.write(MAGIC)
+            self.file.flush()
+        elif self.file.read(len(MAGIC)) != MAGIC:
+            self.file.close()
+            raise SpoolError(f'{path} is not a grasshopper spool')
+        else:
+            # Records appended after one cut short would be read as its
+            # payload. end, if known, is where the complete records end.
+            if end is None:
+                end = records_end(self.file)
+            self.file.truncate(end)
+            self.file.seek(end)
+        self.reader = open(path, 'rb')
+        self.offset = len(MAGIC)
+        self.pending = 0
+        self.taken = None
+        self.samples = 0
+        if self.reader.read(len(MAGIC)) != MAGIC:
+            self.close()
+            raise SpoolError(f'{path} is not a grasshopper spool')
+
+    def __len__(self):
+        return self.pending
+
+    def write(self, kind, payload=b''):
+        self.file.write(RECORD.pack(kind, len(payload)) + payload)
+        self.file.flush()
+
+    def begin(self, name, description, threshold, start_time,
+              test_run_id=None):
+        self.write(b'R', json.dumps({
+            'name': name,
+            'description': description,
+            'threshold': threshold,
+            'start_time': start_time,
+            'id': test_run_id,
+        }).encode())
+
+    def created(self, test_run_id):
+        self.write(b'I', json.dumps({'id': test_run_id}).encode())
+
+    def end(self, end_time):
+        self.write(b'E', json.dumps({'end_time': end_time}).encode())
+
+    def uploaded(self):
+        self.write(b'U')
+
+    def acknowledge(self, offset=None):
+        """
+        Record that the samples up to offset, by default the ones taken
+        last, were uploaded.
+        """
+        if offset is None:
+            if self.taken is None:
+                return
+            offset = self.offset
+        self.taken = None
+        self.write(b'A', ACK.pack(offset))
+
+    def append(self, sample, timestamp):
+        self.extend([(sample, timestamp)])
+
+    def extend(self, samples):
+        self.file.write(b''.join(
+            RECORD.pack(b'S', len(payload)) + payload
+            for payload in (encode_sample(sample, timestamp)
+                            for sample, timestamp in samples)))
+        self.file.flush()
+        self.pending += len(samples)
+        self.samples += len(samples)
+
+    def read(self, count):
+        """
+        Return up to count of the samples waiting to be replayed, and the
+        offset after the last one, without consuming them.
+        """
+        self.reader.seek(self.offset)
+        samples = []
+        offset = self.offset
+        for kind, payload, end in iter_records(self.reader):
+            if len(samples) == count:
+                break
+            if kind == b'S':
+                samples.append(decode_sample(payload))
+                offset = end
+        return samples, offset
+
+    def take(self, count):
+        self.acknowledge()
+        batch, offset = self.read(min(count, self.pending))
+        self.taken = self.offset
+        self.offset = offset
+        self.pending -= len(batch)
+        return batch
+
+    def put_back(self, batch):
+        self.offset = self.taken
+        self.taken = None
+        self.pending += len(batch)
+
+    def oldest_timestamp(self):
+        if not self.pending:
+            return None
+        batch, _ = self.read(1)
+        return batch[0][1]
+
+    def close(self):
+        if not self.file.closed:
+            self.acknowledge()
+        self.file.close()
+        self.reader.close()
+
+
+SpoolContents = namedtuple('SpoolContents', [
+    'run', 'test_run_id', 'samples', 'end_time', 'uploaded', 'end'
+])
+
+
+def read_spool(path):
+    """
+    Return the contents of a spool, with the samples still to upload as
+    (offset after it, sample, timestamp) triples, and the offset after its
+    last complete record.
+    """
+    run = test_run_id = end_time = None
+    uploaded = False
+    acknowledged = 0
+    samples = []
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise SpoolError(f'{path} is not a grasshopper spool')
+        end = len(MAGIC)
+        for kind, payload, end in iter_records(f):
+            if kind == b'R':
+                run = json.loads(payload)
+                test_run_id = run['id']
+            elif kind == b'I':
+                test_run_id = json.loads(payload)['id']
+            elif kind == b'S':
+                samples.append((end, *decode_sample(payload)))
+            elif kind == b'A':
+                acknowledged = max(acknowledged, ACK.unpack(payload)[0])
+            elif kind == b'E':
+                end_time = json.loads(payload)['end_time']
+            elif kind == b'U':
+                uploaded = True
+    return SpoolContents(
+        run, test_run_id,
+        [sample for sample in samples if sample[0] > acknowledged],
+        end_time, uploaded, end)
+
+
+class SpoolTracker:
+    """
+    Stand-in for a tracker client that writes the run to a spool, to be
+    uploaded later with grasshopper upload.
+    """
+
+    def __init__(self, spool):
+        self.spool = spool
+        self.test_run_id = None
+
+    async def create_testrun(self, name, description, threshold):
+        self.spool.begin(name, description, threshold, time.time())
+        return TestRun(None, None)
+
+    async def record_usage(self, sample, timestamp=None):
+        self.spool.append(sample, timestamp or time.time())
+
+    async def record_usage_batch(self, samples):
+        self.spool.extend(samples)
+        return {'accepted': len(samples), 'rejected': []}
+
+    async def stop_testrun(self):
+        self.spool.end(time.time())
+
+    async def get_testrun_stats(self):
+        return {'spool': self.spool.path, 'measurements': self.spool.samples}
+
+    async def close(self):
+        self.spool.close()
+
+
+def remove_spool(spool):
+    spool.close()
+    os.remove(spool.path)
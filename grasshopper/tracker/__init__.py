@@ -12,6 +12,37 @@ def create_app(test_config=None):
         DATABASE=os.path.join(app.instance_path, 'grasshopper-tracker-database.sqlite'),
         JWT_SECRET_KEY='super-secret',
         JWT_TOKEN_LOCATION='headers',
+        DATABASE_CACHE_KB=65536,
+        STORAGE='sqlite',
+        STORAGE_SHARDS=4,
+        SHARD_POOL_SIZE=4,
+        MAX_BATCH_SIZE=10000,
+        USER_CACHE_SIZE=1024,
+        USER_CACHE_TTL=60,
+        TESTRUN_CACHE_SIZE=4096,
+        TESTRUN_CACHE_TTL=60,
+        INGEST_QUEUE_ROWS=100000,
+        INGEST_COMMIT_ROWS=5000,
+        INGEST_COMMIT_INTERVAL_MS=50,
+        INGEST_COMMIT_TIMEOUT=30,
+        INGEST_DURABLE=False,
+        INGEST_RETRY_AFTER=1,
+        USAGE_MAX_POINTS=2000,
+        RAW_RETENTION_DAYS=None,
+        COMPACT_QUEUE_SIZE=1000,
+        LIVE_MAX_SUBSCRIBERS=100,
+        LIVE_BUFFER_SAMPLES=1000,
+        LIVE_HEARTBEAT=15,
+        METRICS=False,
+        METRICS_TOKEN=None,
+        PROFILE_SLOW_REQUEST_MS=None,
+        PROFILE_INTERVAL_MS=5,
+        PROFILE_DIR=None,
+        ALERT_RULES=[],
+        ALERT_SINKS=[],
+        ALERT_WINDOW_SAMPLES=10000,
+        ALERT_QUEUE_SIZE=1000,
+        ALERT_RUN_TTL=3600,
     )
 
     if test_config is None:
@@ -25,8 +56,15 @@ def create_app(test_config=None):
         pass
 
     # Register the database
-    from .model import db
+    from .model import alerts, columnar, db, ingest, live, rollup
+    from . import metrics
     db.init_app(app)
+    metrics.init_app(app)
+    columnar.init_app(app)
+    ingest.init_app(app)
+    live.init_app(app)
+    alerts.init_app(app)
+    rollup.init_app(app)
 
     JWTManager(app)
 
@@ -36,6 +74,7 @@ def create_app(test_config=None):
     app.register_blueprint(dashboard.bp)
     app.register_blueprint(index.bp)
     app.register_blueprint(api.bp)
+    app.register_blueprint(metrics.bp)
 
     app.before_request(auth.load_logged_in_user)
 
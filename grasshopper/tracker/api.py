@@ -1,13 +1,226 @@
-from flask import Blueprint, jsonify, request
+from concurrent import futures
+from itertools import islice
+import csv
+import io
+import json
+import logging
+import math
+
+import numpy as np
+from flask import (
+    Blueprint, Response, current_app, jsonify, request, stream_with_context
+)
 from flask_jwt_extended import (
-    create_access_token, get_jwt_identity, jwt_required
+    create_access_token, get_jwt, get_jwt_identity, jwt_required
+)
+from grasshopper.tracker.model.alerts import get_alert_engine
+from grasshopper.tracker.model.columnar import get_compactor
+from grasshopper.tracker.model.ingest import (
+    IngestQueueFull, TestRunStopped, get_ingest_queue, get_ingest_queues,
+    merge_metrics
+)
+from grasshopper.tracker.model.live import (
+    TooManySubscribers, get_live_broker
 )
+from grasshopper.tracker.model.rollup import (
+    format_resolution, parse_resolution
+)
+from grasshopper import wire
 from grasshopper.tracker.model.user import User
-from grasshopper.tracker.model.testrun import TestRun
+from grasshopper.tracker.model.testrun import (
+    PROCESS_METRICS, TestRun, parse_timestamp
+)
+from datetime import datetime
 from uuid import UUID
 
 bp = Blueprint('v1', __name__, url_prefix='/v1/api')
 
+logger = logging.getLogger(__name__)
+
+MAX_CPUS = 4096
+# The timestamps datetime can hold
+TIMESTAMP_RANGE = (np.datetime64(datetime.min, "us"),
+                   np.datetime64(datetime.max, "us"))
+
+
+def parse_sample(sample):
+    """
+    Validate a {usage, timestamp, rss, threads, io_read, io_write, per_cpu}
+    sample, where all but usage are optional, and return it as a dict.
+    Raise a ValueError describing the problem otherwise.
+    """
+    if not isinstance(sample, dict):
+        raise ValueError("Sample must be an object")
+
+    try:
+        usage = float(sample.get("usage"))
+    except (TypeError, ValueError):
+        raise ValueError("Invalid usage value")
+    if not math.isfinite(usage):
+        raise ValueError("Invalid usage value")
+
+    try:
+        timestamp = parse_timestamp(sample.get("timestamp"))
+    except (TypeError, ValueError, OverflowError, OSError):
+        raise ValueError("Invalid timestamp value")
+
+    parsed = {"usage": usage, "timestamp": timestamp}
+    for metric in PROCESS_METRICS:
+        value = sample.get(metric)
+        if value is not None and (
+                not isinstance(value, int) or isinstance(value, bool)
+                or value < 0):
+            raise ValueError(f"Invalid {metric} value")
+        parsed[metric] = value
+
+    per_cpu = sample.get("per_cpu")
+    if per_cpu is not None:
+        if not isinstance(per_cpu, list) or len(per_cpu) > MAX_CPUS or \
+                not all(isinstance(v, (int, float))
+                        and not isinstance(v, bool)
+                        and math.isfinite(v) for v in per_cpu):
+            raise ValueError("Invalid per_cpu value")
+    parsed["per_cpu"] = per_cpu
+
+    return parsed
+
+
+def parse_binary_samples(body):
+    """
+    Decode a batch in the compact wire format into samples as returned by
+    parse_sample, but with their per core usages left packed, and return
+    them with the rejected ones. The columns of the batch are validated
+    as a whole. Raise a WireFormatError if the batch itself is invalid.
+    """
+    max_samples = current_app.config["MAX_BATCH_SIZE"]
+    if request.content_encoding == "gzip":
+        body = wire.decompress(body, max_samples)
+    base, deltas, usages, metrics, per_cpu = wire.decode_batch(body,
+                                                               max_samples)
+    usages = np.asarray(usages, dtype=np.float64)
+    count = len(usages)
+    try:
+        times = np.datetime64(round(base * 1e6), "us") + \
+            np.asarray(deltas, dtype="timedelta64[ms]")
+    except OverflowError:
+        raise wire.WireFormatError("Invalid timestamp value")
+    if count and (times.min() < TIMESTAMP_RANGE[0]
+                  or times.max() > TIMESTAMP_RANGE[1]):
+        raise wire.WireFormatError("Invalid timestamp value")
+    times = np.datetime_as_string(times, unit="us").tolist()
+
+    errors = np.where(~np.isfinite(usages), "Invalid usage value", "")
+    values = {}
+    if metrics:
+        columns = np.stack([np.asarray(metrics[metric])
+                            for metric in PROCESS_METRICS])
+        errors = np.where(((columns < wire.MISSING).any(axis=0))
+                          & (errors == ""),
+                          "Invalid process metric value", errors)
+        values = dict(zip(PROCESS_METRICS, columns.tolist()))
+    rows = None
+    if per_cpu is not None:
+        cores = np.ascontiguousarray(per_cpu, dtype="<f4") \
+            .reshape(count, -1)
+        if cores.shape[1] > MAX_CPUS:
+            raise wire.WireFormatError("Too many cores")
+        errors = np.where(~np.isfinite(cores).all(axis=1) & (errors == ""),
+                          "Invalid per_cpu value", errors)
+        # Stored as they came, a slice of the request body
+        size = cores.shape[1] * 4
+        blob = memoryview(cores).cast("B")
+        rows = [blob[start:start + size]
+                for start in range(0, count * size, size)]
+
+    accepted = []
+    rejected = []
+    for index, (usage, time, error) in enumerate(
+            zip(usages.tolist(), times, errors.tolist())):
+        if error:
+            rejected.append({"index": index, "msg": error})
+            continue
+        sample = {
+            "usage": usage,
+            # As parse_timestamp formats them
+            "timestamp": time.replace("T", " ").removesuffix(".000000"),
+            "per_cpu": rows[index] if rows else None,
+        }
+        for metric in PROCESS_METRICS:
+            value = values[metric][index] if values else wire.MISSING
+            sample[metric] = value if value != wire.MISSING else None
+        accepted.append(sample)
+    return accepted, rejected
+
+
+def current_user_id():
+    """
+    Return the id of the user of the request's token, from its uid claim,
+    or looking the user up for tokens issued without one. None if the
+    user does not exist.
+    """
+    user_id = get_jwt().get("uid")
+    if user_id is not None:
+        return user_id
+
+    user = User.find_by_username(get_jwt_identity())
+    return user.id if user else None
+
+
+def is_true(value):
+    return value.lower() in ("1", "true", "yes")
+
+
+def store_samples(test_run, samples):
+    """
+    Hand samples over to the ingest queue and return whether they are
+    already committed. Waits for the commit if the request asks for it
+    with ?durable=true, or by default with INGEST_DURABLE. Raise
+    IngestQueueFull if the queue has no room for them, TestRunStopped if the
+    run is being stopped, futures.TimeoutError if they are not committed
+    within INGEST_COMMIT_TIMEOUT, or the error storing them failed with.
+    """
+    queue = get_ingest_queue(test_run.id)
+    if queue is None:
+        test_run.record_cpu_usage_batch(samples)
+        return True
+
+    future = queue.submit(test_run, samples)
+    durable = request.args.get("durable", type=is_true)
+    if durable is None:
+        durable = current_app.config["INGEST_DURABLE"]
+    if durable:
+        future.result(current_app.config["INGEST_COMMIT_TIMEOUT"])
+    return durable
+
+
+def abort_signal(test_run):
+    """
+    Tell the client to abort the run once an alert rule asked for it.
+    """
+    engine = get_alert_engine()
+    event = engine.abort_event(test_run.id) if engine is not None else None
+    return {"abort": event} if event is not None else {}
+
+
+def retry_later(msg, status):
+    response = jsonify({"msg": msg})
+    response.headers["Retry-After"] = \
+        str(current_app.config["INGEST_RETRY_AFTER"])
+    return response, status
+
+
+def queue_full():
+    return retry_later("Too many samples pending, retry later", 429)
+
+
+def commit_pending():
+    return retry_later("Samples queued but not committed in time", 503)
+
+
+def store_failed(test_run):
+    logger.exception(f"Could not store the samples of testrun {test_run.id}")
+    return jsonify({"msg": "Could not store the samples"}), 500
+
 
 @bp.route("/auth", methods=["POST"])
 def auth():
@@ -21,20 +234,29 @@ def auth():
     if not user.check_password(password):
         return jsonify({"msg": "Bad username or password"}), 401
 
-    access_token = create_access_token(identity=username)
+    access_token = create_access_token(identity=username,
+                                       additional_claims={"uid": user.id})
     return jsonify(token=access_token), 200
 
 
 @bp.route("/testrun", methods=["POST"])
 @jwt_required()
 def testrun():
-    current_user = get_jwt_identity()
+    user_id = current_user_id()
+    if user_id is None:
+        return jsonify({"msg": "No user found"}), 404
 
-    user = User.find_by_username(current_user)
-    res = TestRun.create(user.id,
+    # Runs recorded offline are uploaded with the time they started at
+    try:
+        start_time = parse_timestamp(request.json.get("start_time"))
+    except (TypeError, ValueError, OverflowError, OSError):
+        return jsonify({"msg": "Invalid start_time value"}), 400
+
+    res = TestRun.create(user_id,
                          request.json.get("name"),
                          request.json.get("description"),
-                         request.json.get("threshold"))
+                         request.json.get("threshold"),
+                         start_time)
 
     return jsonify(id=res['id'], start_time=res['start_time']), 201
 
@@ -42,53 +264,139 @@ def testrun():
 @bp.route("/testrun/<testrun_id>/usage", methods=["POST"])
 @jwt_required()
 def testrun_record_usage(testrun_id):
-    current_user = get_jwt_identity()
-
-    user = User.find_by_username(current_user)
-    test_run = TestRun.find_by_id(testrun_id)
+    user_id = current_user_id()
+    test_run = TestRun.find_cached(testrun_id)
     if not test_run:
         return jsonify({"msg": "No testrun found"}), 404
 
-    if test_run.user_id != user.id:
+    if test_run.user_id != user_id:
         return jsonify({"msg": "Forbidden"}), 403
 
+    if not test_run.is_active:
+        return jsonify({"msg": "Testrun already finished"}), 409
+
+    try:
+        sample = parse_sample(request.json)
+    except ValueError as e:
+        return jsonify({"msg": str(e)}), 400
+
     try:
-        usage = float(request.json.get("usage"))
-    except ValueError:
-        return jsonify({"msg": "Invalid usage value"}), 400
+        committed = store_samples(test_run, [sample])
+    except IngestQueueFull:
+        return queue_full()
+    except TestRunStopped:
+        return jsonify({"msg": "Testrun already finished"}), 409
+    except futures.TimeoutError:
+        return commit_pending()
+    except Exception:
+        return store_failed(test_run)
+
+    if committed:
+        return jsonify(msg="Usage recorded", **abort_signal(test_run)), 201
+    return jsonify(msg="Usage accepted", **abort_signal(test_run)), 202
+
+
+@bp.route("/testrun/<testrun_id>/usage/batch", methods=["POST"])
+@jwt_required()
+def testrun_record_usage_batch(testrun_id):
+    user_id = current_user_id()
+    test_run = TestRun.find_cached(testrun_id)
+    if not test_run:
+        return jsonify({"msg": "No testrun found"}), 404
+
+    if test_run.user_id != user_id:
+        return jsonify({"msg": "Forbidden"}), 403
+
+    if not test_run.is_active:
+        return jsonify({"msg": "Testrun already finished"}), 409
+
+    if request.mimetype == wire.CONTENT_TYPE:
+        if request.content_encoding not in (None, "gzip"):
+            return jsonify({"msg": "Unsupported content encoding"}), 415
+        try:
+            accepted, rejected = parse_binary_samples(request.get_data())
+        except wire.BatchTooLarge:
+            return jsonify({"msg": "Too many samples in batch"}), 413
+        except wire.WireFormatError as e:
+            return jsonify({"msg": str(e)}), 400
+    else:
+        samples = request.json
+        if not isinstance(samples, list):
+            return jsonify({"msg": "Expected an array of samples"}), 400
+
+        if len(samples) > current_app.config['MAX_BATCH_SIZE']:
+            return jsonify({"msg": "Too many samples in batch"}), 413
+
+        accepted = []
+        rejected = []
+        for index, sample in enumerate(samples):
+            try:
+                accepted.append(parse_sample(sample))
+            except ValueError as e:
+                rejected.append({"index": index, "msg": str(e)})
 
-    test_run.record_cpu_usage(usage)
-    return jsonify({"msg": "Usage recorded"}, 201)
+    committed = True
+    if accepted:
+        try:
+            committed = store_samples(test_run, accepted)
+        except IngestQueueFull:
+            return queue_full()
+        except TestRunStopped:
+            return jsonify({"msg": "Testrun already finished"}), 409
+        except futures.TimeoutError:
+            return commit_pending()
+        except Exception:
+            return store_failed(test_run)
+
+    return jsonify(accepted=len(accepted), rejected=rejected,
+                   **abort_signal(test_run)), 201 if committed else 202
 
 
 @bp.route("/testrun/<testrun_id>/stop", methods=["POST"])
 @jwt_required()
 def testrun_stop(testrun_id):
-    current_user = get_jwt_identity()
-
-    user = User.find_by_username(current_user)
+    user_id = current_user_id()
     test_run = TestRun.find_by_id(testrun_id)
     if not test_run:
         return jsonify({"msg": "No testrun found"}), 404
 
-    if test_run.user_id != user.id:
+    if test_run.user_id != user_id:
         return jsonify({"msg": "Forbidden"}), 403
 
-    test_run.finish()
+    body = request.get_json(silent=True) or {}
+    try:
+        end_time = parse_timestamp(body.get("end_time"))
+    except (TypeError, ValueError, OverflowError, OSError):
+        return jsonify({"msg": "Invalid end_time value"}), 400
+
+    # Samples still queued have to make it into the run before it ends,
+    # and none may be queued after
+    queue = get_ingest_queue(test_run.id)
+    if queue is not None:
+        try:
+            queue.stop_run(test_run.id,
+                           current_app.config["INGEST_COMMIT_TIMEOUT"])
+        except (IngestQueueFull, futures.TimeoutError):
+            return retry_later(
+                "Samples of the testrun still pending, retry later", 503)
+
+    # Compacting a long run takes a while, the client need not wait
+    test_run.finish(compact=False,
+                    end_time=datetime.fromisoformat(end_time)
+                    if end_time is not None else None)
+    get_compactor().submit(test_run)
     return jsonify({"msg": "Testrun finished"}), 200
 
 
 @bp.route("/testrun/<testrun_id>", methods=["GET"])
 @jwt_required()
 def testrun_get(testrun_id):
-    current_user = get_jwt_identity()
-
-    user = User.find_by_username(current_user)
+    user_id = current_user_id()
     test_run = TestRun.find_by_id(testrun_id)
     if not test_run:
         return jsonify({"msg": "No testrun found"}), 404
 
-    if test_run.user_id != user.id:
+    if test_run.user_id != user_id:
         return jsonify({"msg": "Forbidden"}), 403
 
     stats = test_run.get_test_execution_stats()
@@ -96,4 +404,203 @@ def testrun_get(testrun_id):
                    time_above_threshold=stats["time_above_threshold"],
                    start_time=test_run.start_time,
                    end_time=test_run.end_time,
-                   duration=stats["total_time"]), 200
+                   duration=stats["total_time"],
+                   measurements=stats["measurements"],
+                   usage=stats["usage"],
+                   per_cpu=stats["per_cpu"]), 200
+
+
+@bp.route("/testrun/<testrun_id>/stats", methods=["GET"])
+@jwt_required()
+def testrun_recompute_stats(testrun_id):
+    user_id = current_user_id()
+    test_run = TestRun.find_by_id(testrun_id)
+    if not test_run:
+        return jsonify({"msg": "No testrun found"}), 404
+
+    if test_run.user_id != user_id:
+        return jsonify({"msg": "Forbidden"}), 403
+
+    threshold = request.args.get("threshold", type=float)
+    stats = test_run.recompute_stats(threshold)
+    if stats is None:
+        return jsonify({"msg": "No CPU usage data found"}), 404
+
+    return jsonify(id=test_run.id, **stats), 200
+
+
+@bp.route("/testrun/<testrun_id>/usage", methods=["GET"])
+@jwt_required()
+def testrun_usage(testrun_id):
+    user_id = current_user_id()
+    test_run = TestRun.find_by_id(testrun_id)
+    if not test_run:
+        return jsonify({"msg": "No testrun found"}), 404
+
+    if test_run.user_id != user_id:
+        return jsonify({"msg": "Forbidden"}), 403
+
+    try:
+        start, end = (datetime.fromisoformat(parse_timestamp(value))
+                      if value is not None else None
+                      for value in (request.args.get("from"),
+                                    request.args.get("to")))
+    except (TypeError, ValueError, OverflowError, OSError):
+        return jsonify({"msg": "Invalid from or to value"}), 400
+
+    export_format = request.args.get("format", "json")
+    if export_format not in ("json", *EXPORT_FORMATS):
+        return jsonify({"msg": "Invalid format, expected json, ndjson "
+                               "or csv"}), 400
+
+    max_points = current_app.config["USAGE_MAX_POINTS"]
+    if "resolution" in request.args:
+        try:
+            resolution = parse_resolution(request.args["resolution"])
+        except ValueError as e:
+            return jsonify({"msg": str(e)}), 400
+    elif export_format != "json":
+        resolution = None
+    else:
+        resolution = test_run.auto_resolution(start, end, max_points)
+
+    if resolution is not None:
+        if export_format != "json":
+            return jsonify({"msg": "Only raw samples can be exported "
+                                   f"as {export_format}"}), 400
+        return jsonify(id=test_run.id,
+                       resolution=format_resolution(resolution),
+                       points=test_run.fetch_usage(resolution, start,
+                                                   end)), 200
+
+    try:
+        if export_format != "json":
+            samples = test_run.iter_samples(start, end,
+                                            request.args.get("after"))
+            return export_samples(test_run, samples, export_format)
+
+        limit = request.args.get("limit", max_points, type=int)
+        if limit <= 0:
+            return jsonify({"msg": "Invalid limit value"}), 400
+        points, next_page = test_run.fetch_samples(
+            min(limit, max_points), start, end, request.args.get("after"))
+    except ValueError as e:
+        return jsonify({"msg": str(e)}), 400
+
+    return jsonify(id=test_run.id,
+                   resolution=format_resolution(None),
+                   points=points,
+                   next=next_page), 200
+
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_COLUMNS = ("time", "usage", *PROCESS_METRICS, "per_cpu")
+# Samples written to the response at once
+EXPORT_BATCH = 1000
+
+
+def export_samples(test_run, samples, export_format):
+    """
+    Stream (key, sample) pairs from TestRun.iter_samples as NDJSON or CSV,
+    reading them as the response is sent.
+    """
+    def lines():
+        if export_format == "csv":
+            yield ",".join(EXPORT_COLUMNS) + "\r\n"
+        while batch := list(islice(samples, EXPORT_BATCH)):
+            if export_format == "ndjson":
+                yield "".join(json.dumps(sample) + "\n"
+                              for _, sample in batch)
+            else:
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                for _, sample in batch:
+                    per_cpu = sample["per_cpu"]
+                    writer.writerow(
+                        [sample[column] for column in EXPORT_COLUMNS[:-1]]
+                        + [" ".join(map(str, per_cpu)) if per_cpu else ""])
+                yield buffer.getvalue()
+
+    return Response(
+        stream_with_context(lines()),
+        mimetype=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": "attachment; filename="
+                 f"testrun-{test_run.id}.{export_format}"},
+    )
+
+
+@bp.route("/testrun/<testrun_id>/live", methods=["GET"])
+@jwt_required(locations=["headers", "query_string"])
+def testrun_live(testrun_id):
+    user_id = current_user_id()
+    test_run = TestRun.find_cached(testrun_id)
+    if not test_run:
+        return jsonify({"msg": "No testrun found"}), 404
+
+    if test_run.user_id != user_id:
+        return jsonify({"msg": "Forbidden"}), 403
+
+    broker = get_live_broker()
+    if broker is None:
+        return jsonify({"msg": "Live updates disabled"}), 404
+
+    try:
+        subscription = broker.subscribe(test_run.id)
+    except TooManySubscribers:
+        response = jsonify({"msg": "Too many live subscribers"})
+        response.headers["Retry-After"] = \
+            str(current_app.config["LIVE_HEARTBEAT"])
+        return response, 503
+
+    # Checked once subscribed, so that a run stopping meanwhile is noticed
+    stats = test_run.live_stats()
+    if not TestRun.find_cached(test_run.id).is_active:
+        subscription.finish()
+
+    return Response(
+        live_events(broker, subscription, stats,
+                    current_app.config["LIVE_HEARTBEAT"]),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def sse_event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+def live_events(broker, subscription, stats, heartbeat):
+    """
+    Server-Sent Events of a subscription: the stats of the run when
+    connecting, then "samples" as they are committed, with how many were
+    dropped if the client did not keep up, and "stats" after each, until
+    an "end" event once the run is finished. A comment every heartbeat
+    seconds keeps idle connections open.
+    """
+    try:
+        yield sse_event("stats", stats)
+        while True:
+            update = subscription.get(heartbeat)
+            if update is None:
+                yield ": keep-alive\n\n"
+                continue
+            if update["samples"] or update["dropped"]:
+                yield sse_event("samples", {"samples": update["samples"],
+                                            "dropped": update["dropped"]})
+            if update["stats"] is not None:
+                yield sse_event("stats", update["stats"])
+            if update["finished"]:
+                yield sse_event("end", {})
+                return
+    finally:
+        broker.unsubscribe(subscription)
+
+
+@bp.route("/ingest", methods=["GET"])
+@jwt_required()
+def ingest_metrics():
+    queues = get_ingest_queues()
+    if not queues:
+        return jsonify({"msg": "Ingest queue disabled"}), 404
+
+    return jsonify(merge_metrics([queue.metrics() for queue in queues])), 200
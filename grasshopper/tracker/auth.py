@@ -105,6 +105,7 @@ def jwt():
         return redirect(url_for('auth.login'))
 
     jwt_token = create_access_token(identity=user.username,
+                                    additional_claims={'uid': user.id},
                                     expires_delta=timedelta(hours=2))
     g.jwt_token = jwt_token
     return render_template('auth/jwt.html')
@@ -1,13 +1,51 @@
+from datetime import date, datetime, timedelta
+
 from flask import (
-    Blueprint, render_template
+    Blueprint, g, render_template, request
 )
 from grasshopper.tracker.auth import login_required
+from grasshopper.tracker.model.testrun import SUMMARY_SORTS, TestRun
 
 bp = Blueprint('dashboard', __name__)
 
+RUNS_PER_PAGE = 50
+
+
+def parse_day(value):
+    """
+    Parse a YYYY-MM-DD form value into the midnight starting that day, or
+    None if it is missing or invalid.
+    """
+    try:
+        return datetime.combine(date.fromisoformat(value), datetime.min.time())
+    except (TypeError, ValueError):
+        return None
+
 
-@login_required
 @bp.route('/dashboard')
+@login_required
 def index():
-    # db = get_db()
-    return render_template('dashboard/main.html', test_runs=[])
+    args = request.args
+    sort = args.get('sort') if args.get('sort') in SUMMARY_SORTS else 'start'
+    descending = args.get('order', 'desc') != 'asc'
+    page = max(args.get('page', 1, type=int), 1)
+    breached = {'yes': True, 'no': False}.get(args.get('breached'))
+    until = parse_day(args.get('to'))
+
+    test_runs, has_next = TestRun.find_summaries(
+        g.user.id,
+        name=args.get('name', '').strip(),
+        since=parse_day(args.get('from')),
+        until=until + timedelta(days=1) if until is not None else None,
+        breached=breached,
+        sort=sort,
+        descending=descending,
+        page=page,
+        per_page=RUNS_PER_PAGE,
+    )
+    return render_template('dashboard/main.html',
+                           test_runs=test_runs,
+                           sort=sort,
+                           descending=descending,
+                           page=page,
+                           has_next=has_next)
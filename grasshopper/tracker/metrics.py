@@ -0,0 +1,368 @@
+from bisect import bisect_left
+from collections import Counter, defaultdict
+import functools
+import hmac
+import ipaddress
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+from flask import (
+    Blueprint, Response, current_app, g, has_request_context, jsonify,
+    request
+)
+
+from grasshopper.tracker.model.alerts import get_alert_engine
+from grasshopper.tracker.model.ingest import get_ingest_queues, merge_metrics
+from grasshopper.tracker.model.testrun import utcnow
+
+bp = Blueprint('metrics', __name__)
+
+# Seconds, as Prometheus' default buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Counts of observations per bucket, with their sum, as a Prometheus
+    histogram. Not thread safe, Metrics holds a lock around it.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def samples(self):
+        """
+        Yield the (le, cumulative count) of every bucket, +Inf last.
+        """
+        total = 0
+        for bound, count in zip([*self.buckets, '+Inf'], self.counts):
+            total += count
+            yield bound, total
+
+
+def normalize_query(sql):
+    """
+    Return the statement of a query without its layout, and with lists of
+    placeholders folded into one, so that each query is a single series.
+    """
+    sql = ' '.join(sql.split())
+    return re.sub(r'\?(?:\s*,\s*\?)+', '?, ...', sql)
+
+
+class Metrics:
+    """
+    Latency histograms of the requests per endpoint and of the queries
+    per statement, for the /metrics endpoint. Enabled by METRICS.
+
+    Queries are timed by the connections of the storage backend, created
+    with connection_factory: the time to run each statement, and commit,
+    not the time to fetch the rows of a query.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(Histogram)
+        self.request_queries = defaultdict(Histogram)
+        self.queries = defaultdict(Histogram)
+        self.connection_factory = functools.partial(TimedConnection,
+                                                    metrics=self)
+
+    def observe_request(self, endpoint, method, status, seconds,
+                        query_seconds):
+        with self.lock:
+            self.requests[endpoint, method, status].observe(seconds)
+            self.request_queries[endpoint, method].observe(query_seconds)
+
+    def observe_query(self, sql, seconds):
+        with self.lock:
+            self.queries[normalize_query(sql),].observe(seconds)
+        if has_request_context():
+            g.query_seconds = g.get('query_seconds', 0.0) + seconds
+
+    def exposition(self, values=()):
+        """
+        Return the metrics, and the (name, type, help, value) of other
+        values, in the Prometheus text format.
+        """
+        with self.lock:
+            histograms = [
+                ('grasshopper_request_duration_seconds',
+                 'Time to handle a request, per endpoint.',
+                 ('endpoint', 'method', 'status'), dict(self.requests)),
+                ('grasshopper_request_query_seconds',
+                 'Time spent in queries while handling a request.',
+                 ('endpoint', 'method'), dict(self.request_queries)),
+                ('grasshopper_query_duration_seconds',
+                 'Time to execute a statement, per statement.',
+                 ('query',), dict(self.queries)),
+            ]
+            lines = []
+            for name, help, label_names, series in histograms:
+                lines += [f'# HELP {name} {help}', f'# TYPE {name} histogram']
+                for key, histogram in sorted(series.items()):
+                    labels = ','.join(
+                        f'{label}="{escape_label(value)}"'
+                        for label, value in zip(label_names, map(str, key)))
+                    for bound, count in histogram.samples():
+                        lines.append(
+                            f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+                    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+        for name, type, help, value in values:
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} {type}',
+                      f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class TimedCursor(sqlite3.Cursor):
+
+    def execute(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            self.connection.metrics.observe_query(
+                sql, time.perf_counter() - start)
+
+    def executemany(self, sql, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            self.connection.metrics.observe_query(
+                sql, time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """
+    Connection reporting the time of every statement, and commit, to
+    metrics.
+    """
+
+    def __init__(self, *args, metrics, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = metrics
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+    def executescript(self, script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            self.metrics.observe_query('SCRIPT',
+                                       time.perf_counter() - start)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            self.metrics.observe_query('COMMIT', time.perf_counter() - start)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the threads handling requests every interval
+    seconds, and writes the stacks of the requests that took at least
+    slow seconds to directory, in the folded format of flame graph tools.
+    """
+
+    def __init__(self, directory, slow, interval):
+        self.directory = directory
+        self.slow = slow
+        self.interval = interval
+        self.active = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            self.active[threading.get_ident()] = Counter()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='request-profiler',
+                                               daemon=True)
+                self.thread.start()
+
+    def discard(self):
+        with self.lock:
+            return self.active.pop(threading.get_ident(), None)
+
+    def stop(self, endpoint, seconds):
+        stacks = self.discard()
+        if not stacks or seconds < self.slow:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = utcnow().strftime('%Y%m%dT%H%M%S%f')
+        path = os.path.join(
+            self.directory,
+            f'{stamp}-{endpoint}-{seconds * 1000:.0f}ms.folded')
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        return path
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, stacks in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[fold_stack(frame)] += 1
+
+
+def fold_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def get_metrics():
+    return current_app.extensions.get('grasshopper_metrics')
+
+
+def get_profiler():
+    return current_app.extensions.get('grasshopper_profiler')
+
+
+def start_request():
+    g.request_started = time.perf_counter()
+    if get_profiler() is not None:
+        get_profiler().start()
+
+
+def finish_request(response):
+    if 'request_started' not in g:
+        return response
+    seconds = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unmatched'
+    if get_metrics() is not None:
+        get_metrics().observe_request(endpoint, request.method,
+                                      response.status_code, seconds,
+                                      g.get('query_seconds', 0.0))
+    if get_profiler() is not None:
+        get_profiler().stop(endpoint, seconds)
+    return response
+
+
+def discard_profile(e=None):
+    # Requests failing with an exception skip after_request
+    if get_profiler() is not None:
+        get_profiler().discard()
+
+
+def metrics_allowed():
+    """
+    Whether the request may read the metrics: with the bearer token of
+    METRICS_TOKEN when set, and only from the loopback interface
+    otherwise.
+    """
+    token = current_app.config['METRICS_TOKEN']
+    if token is None:
+        try:
+            return ipaddress.ip_address(request.remote_addr).is_loopback
+        except ValueError:
+            return False
+    scheme, _, credentials = \
+        request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and \
+        hmac.compare_digest(credentials.encode(), token.encode())
+
+
+@bp.route('/metrics')
+def metrics():
+    registry = get_metrics()
+    if registry is None:
+        return jsonify({"msg": "Metrics disabled"}), 404
+    if not metrics_allowed():
+        return jsonify({"msg": "Not allowed to read the metrics"}), 403
+
+    values = []
+    queues = get_ingest_queues()
+    if queues:
+        ingest = merge_metrics([queue.metrics() for queue in queues])
+        values += [
+            ('grasshopper_ingest_queue_rows', 'gauge',
+             'Rows waiting in the ingest queues.', ingest['queue_depth']),
+            ('grasshopper_ingest_queue_capacity_rows', 'gauge',
+             'Rows the ingest queues can hold.', ingest['queue_capacity']),
+            ('grasshopper_ingest_commits_total', 'counter',
+             'Commits of the ingest queues.', ingest['commits']),
+            ('grasshopper_ingest_committed_rows_total', 'counter',
+             'Rows committed by the ingest queues.',
+             ingest['committed_rows']),
+            ('grasshopper_ingest_failed_rows_total', 'counter',
+             'Rows the ingest queues failed to commit.',
+             ingest['failed_rows']),
+            ('grasshopper_ingest_refused_rows_total', 'counter',
+             'Rows refused as the ingest queues were full.',
+             ingest['refused_rows']),
+            ('grasshopper_ingest_commit_seconds_max', 'gauge',
+             'Longest commit of the ingest queues.',
+             ingest['commit_latency']['max']),
+        ]
+    alerts = get_alert_engine()
+    if alerts is not None:
+        values += [
+            ('grasshopper_alerts_fired_total', 'counter',
+             'Alerts fired by the alert rules.', alerts.fired),
+            ('grasshopper_alerts_dropped_total', 'counter',
+             'Alerts dropped as too many were waiting for the sinks.',
+             alerts.dropped),
+        ]
+    return Response(registry.exposition(values),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    # Before the ingest writers open their connections
+    if app.config['METRICS']:
+        registry = Metrics()
+        app.extensions['grasshopper_metrics'] = registry
+        app.extensions['grasshopper_storage'].connection_factory = \
+            registry.connection_factory
+    if app.config['PROFILE_SLOW_REQUEST_MS'] is not None:
+        app.extensions['grasshopper_profiler'] = SamplingProfiler(
+            app.config['PROFILE_DIR']
+            or os.path.join(app.instance_path, 'profiles'),
+            app.config['PROFILE_SLOW_REQUEST_MS'] / 1000,
+            app.config['PROFILE_INTERVAL_MS'] / 1000,
+        )
+    if {'grasshopper_metrics', 'grasshopper_profiler'} & set(app.extensions):
+        app.before_request(start_request)
+        app.after_request(finish_request)
+        app.teardown_request(discard_profile)
@@ -0,0 +1,389 @@
+from collections import deque
+from datetime import datetime
+import json
+import logging
+import queue
+from threading import Lock, Thread
+from time import monotonic
+
+from flask import current_app
+import requests
+
+from .stats import above
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class Window:
+    """
+    Ring buffer of the (time, usage) of the samples of the last seconds of
+    a run, at most max_samples of them, with the sum of their usages.
+    """
+
+    def __init__(self, seconds, max_samples):
+        self.seconds = seconds
+        self.max_samples = max_samples
+        self.samples = deque()
+        self.sum = 0.0
+        self.start = None
+
+    def add(self, time, usage):
+        if self.start is None:
+            self.start = time
+        self.samples.append((time, usage))
+        self.sum += usage
+        while self.samples[0][0] < time - self.seconds or \
+                len(self.samples) > self.max_samples:
+            self.sum -= self.samples.popleft()[1]
+
+    @property
+    def full(self):
+        """
+        Whether the run is older than the window.
+        """
+        return self.samples[-1][0] - self.start >= self.seconds
+
+    @property
+    def mean(self):
+        return self.sum / len(self.samples)
+
+    @property
+    def oldest(self):
+        return self.samples[0]
+
+
+class SustainedAbove:
+    """
+    The usage stayed above the threshold of the run, or limit, for seconds
+    in a row. Its value is how long it did.
+    """
+    type = 'above'
+
+    def __init__(self, name, seconds, limit=None, abort=False):
+        self.name = name
+        self.seconds = seconds
+        self.limit = limit
+        self.abort = abort
+
+    def new_state(self, max_samples):
+        return {'since': None}
+
+    def check(self, state, time, usage, threshold):
+        if not above(usage, self.limit if self.limit is not None
+                     else threshold):
+            state['since'] = None
+            return None
+        if state['since'] is None:
+            state['since'] = time
+        elapsed = time - state['since']
+        return elapsed if elapsed >= self.seconds else None
+
+
+class MovingAverage:
+    """
+    The mean usage of the samples of the last seconds went above limit,
+    by default the threshold of the run, once the run is that old.
+    """
+    type = 'moving_average'
+
+    def __init__(self, name, seconds, limit=None, abort=False):
+        self.name = name
+        self.seconds = seconds
+        self.limit = limit
+        self.abort = abort
+
+    def new_state(self, max_samples):
+        return Window(self.seconds, max_samples)
+
+    def check(self, window, time, usage, threshold):
+        window.add(time, usage)
+        if not window.full:
+            return None
+        mean = window.mean
+        if not above(mean, self.limit if self.limit is not None
+                     else threshold):
+            return None
+        return mean
+
+
+class RateOfChange:
+    """
+    The usage rose by more than limit percentage points per second over
+    the last seconds, from the oldest sample in them to the latest one,
+    once the run is that old. The rise is spread over the whole window, so
+    that a blip between two close samples does not count as a steep rate.
+    """
+    type = 'rate'
+
+    def __init__(self, name, seconds, limit, abort=False):
+        if seconds <= 0:
+            raise ValueError(f'{name} needs a window of some seconds')
+        self.name = name
+        self.seconds = seconds
+        self.limit = limit
+        self.abort = abort
+
+    def new_state(self, max_samples):
+        return Window(self.seconds, max_samples)
+
+    def check(self, window, time, usage, threshold):
+        window.add(time, usage)
+        if not window.full:
+            return None
+        rate = (usage - window.oldest[1]) / self.seconds
+        return rate if rate > self.limit else None
+
+
+RULES = {rule.type: rule
+         for rule in (SustainedAbove, MovingAverage, RateOfChange)}
+
+
+def make_rule(config):
+    """
+    Return the rule described by a dict of ALERT_RULES: its type, name,
+    seconds, limit and whether it aborts the run. Raise a ValueError if it
+    is not a valid one.
+    """
+    try:
+        rule = RULES[config['type']]
+    except KeyError:
+        raise ValueError(f'Invalid alert rule type in {config}')
+    config = {key: value for key, value in config.items() if key != 'type'}
+    config.setdefault('name', rule.type)
+    try:
+        return rule(**config)
+    except TypeError as e:
+        raise ValueError(f'Invalid alert rule {config}: {e}')
+
+
+class WebhookSink:
+
+    def __init__(self, url, timeout=5.0):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def send(self, event):
+        self.session.post(self.url, json=event,
+                          timeout=self.timeout).raise_for_status()
+
+
+class FileSink:
+    """
+    Appends the events to a file, one JSON object per line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, event):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(event) + '\n')
+
+
+class QueueSink:
+    """
+    Hands the events to consumers in the same process, dropping the new
+    ones while maxsize are waiting.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.queue = queue.Queue(maxsize)
+
+    def send(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            pass
+
+
+SINKS = {'webhook': WebhookSink, 'file': FileSink, 'queue': QueueSink}
+
+
+def make_sink(config):
+    try:
+        sink = SINKS[config['type']]
+    except KeyError:
+        raise ValueError(f'Invalid alert sink type in {config}')
+    config = {key: value for key, value in config.items() if key != 'type'}
+    try:
+        return sink(**config)
+    except TypeError as e:
+        raise ValueError(f'Invalid alert sink {config}: {e}')
+
+
+class RunState:
+    """
+    State of the rules for one run, and the rules in breach.
+    """
+
+    def __init__(self, rules, max_samples):
+        self.states = [rule.new_state(max_samples) for rule in rules]
+        self.breached = [False] * len(rules)
+        self.last_time = None
+        self.abort = None
+        # Monotonic time the run last got samples
+        self.seen = monotonic()
+
+
+class AlertEngine:
+    """
+    Evaluates the rules against the samples of every running run as they
+    are stored, in constant time per sample and rule: each rule keeps a
+    small state per run, at most max_samples samples for the ones over a
+    window. A rule fires once when it goes into breach, and again only
+    after it recovered. The events are delivered to the sinks by a
+    background thread, so slow sinks never hold the ingest path up; while
+    max_events are waiting, new ones are dropped and counted.
+
+    As the time above threshold, rules only see samples newer than the
+    latest one of their run, and only the samples stored by this process.
+
+    The state of a run is dropped when it finishes, or once it got no
+    samples for run_ttl seconds, so that runs never stopped do not hold
+    theirs forever.
+    """
+
+    def __init__(self, rules, sinks, max_samples=10000, max_events=1000,
+                 run_ttl=3600):
+        self.rules = rules
+        self.sinks = sinks
+        self.max_samples = max_samples
+        self.run_ttl = run_ttl
+        self.runs = {}
+        self.next_eviction = monotonic() + run_ttl
+        self.lock = Lock()
+        self.events = queue.Queue(max_events)
+        self.fired = 0
+        self.dropped = 0
+        self.dispatcher = None
+
+    def evaluate(self, test_run, samples):
+        """
+        Feed (datetime, usage) samples of a run, oldest first, to the
+        rules.
+        """
+        events = []
+        now = monotonic()
+        with self.lock:
+            if now >= self.next_eviction:
+                self.evict(now)
+            run = self.runs.get(test_run.id)
+            if run is None:
+                run = self.runs[test_run.id] = RunState(self.rules,
+                                                        self.max_samples)
+            run.seen = now
+            for time, usage in samples:
+                if run.last_time is not None and time < run.last_time:
+                    continue
+                run.last_time = time
+                seconds = (time - EPOCH).total_seconds()
+                for i, rule in enumerate(self.rules):
+                    value = rule.check(run.states[i], seconds, usage,
+                                       test_run.threshold)
+                    if value is None:
+                        run.breached[i] = False
+                    elif not run.breached[i]:
+                        run.breached[i] = True
+                        event = self.event(test_run, rule, time, value)
+                        if rule.abort and run.abort is None:
+                            run.abort = event
+                        events.append(event)
+            self.fired += len(events)
+        for event in events:
+            self.publish(event)
+
+    def evict(self, now):
+        """
+        Drop the state of the runs idle for longer than run_ttl, checked
+        every tenth of it at most. Called with the lock held.
+        """
+        for test_run_id in [test_run_id
+                            for test_run_id, run in self.runs.items()
+                            if now - run.seen > self.run_ttl]:
+            del self.runs[test_run_id]
+        self.next_eviction = now + self.run_ttl / 10
+
+    @staticmethod
+    def event(test_run, rule, time, value):
+        return {
+            'test_run_id': test_run.id,
+            'test_run': test_run.name,
+            'rule': rule.name,
+            'type': rule.type,
+            'time': time.isoformat(),
+            'value': value,
+            'limit': rule.limit if rule.limit is not None
+            else test_run.threshold,
+            'abort': rule.abort,
+        }
+
+    def publish(self, event):
+        if not self.sinks:
+            return
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return
+        if self.dispatcher is None:
+            with self.lock:
+                if self.dispatcher is None:
+                    self.dispatcher = Thread(target=self.dispatch,
+                                             name='alert-dispatcher',
+                                             daemon=True)
+                    self.dispatcher.start()
+
+    def dispatch(self):
+        while True:
+            event = self.events.get()
+            for sink in self.sinks:
+                try:
+                    sink.send(event)
+                except Exception:
+                    logger.exception(f'Could not deliver alert {event} '
+                                     f'to {type(sink).__name__}')
+
+    def abort_event(self, test_run_id):
+        """
+        Return the event of the first rule that aborts the run it fired
+        for, or None.
+        """
+        run = self.runs.get(test_run_id)
+        return run.abort if run is not None else None
+
+    def finish(self, test_run_id):
+        with self.lock:
+            self.runs.pop(test_run_id, None)
+
+
+def get_alert_engine():
+    """
+    Return the app's alert engine, or None without ALERT_RULES.
+    """
+    return current_app.extensions.get('grasshopper_alerts')
+
+
+def get_alert_queue():
+    """
+    Return the queue of the queue sink, or None if there is none.
+    """
+    engine = get_alert_engine()
+    for sink in engine.sinks if engine is not None else ():
+        if isinstance(sink, QueueSink):
+            return sink.queue
+    return None
+
+
+def init_app(app):
+    if app.config['ALERT_RULES']:
+        app.extensions['grasshopper_alerts'] = AlertEngine(
+            [make_rule(rule) for rule in app.config['ALERT_RULES']],
+            [make_sink(sink) for sink in app.config['ALERT_SINKS']],
+            app.config['ALERT_WINDOW_SAMPLES'],
+            app.config['ALERT_QUEUE_SIZE'],
+            app.config['ALERT_RUN_TTL'],
+        )
@@ -0,0 +1,160 @@
+from datetime import datetime, timezone
+
+import numpy as np
+
+from .columnar import stream_compact_usage
+
+PERCENTILES = (50, 95, 99)
+
+
+def stream_usage(db, test_run_id, chunk_size=65536):
+    """
+    Yield the (times, usages) of a run, oldest first, as NumPy arrays of at
+    most chunk_size samples read straight from the cursor. Times are in
+    seconds since the epoch.
+    """
+    compacted = stream_compact_usage(db, test_run_id, chunk_size)
+    if compacted is not None:
+        yield from compacted
+        return
+
+    cursor = db.cursor()
+    cursor.row_factory = None
+    # Cast so the timestamps skip the datetime converter, NumPy parses them
+    # much faster
+    cursor.execute(
+        '''
+        SELECT CAST(time AS TEXT), usage FROM
+            cpu_usage
+        WHERE test_run_id = ?
+        ORDER BY time, id
+        ''', (test_run_id,))
+
+    while rows := cursor.fetchmany(chunk_size):
+        times, usages = zip(*rows)
+        microseconds = np.array(times, dtype='datetime64[us]')
+        yield (microseconds.astype(np.int64) / 1e6,
+               np.array(usages, dtype=np.float64))
+
+
+class UsageHistogram:
+    """
+    Fixed size histogram over a known usage range, to estimate percentiles
+    without keeping the samples. The error is at most one bin width.
+    """
+
+    def __init__(self, low, high, bins=10000):
+        if high <= low:
+            high = low + 1
+        self.edges = np.linspace(low, high, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def add(self, values):
+        self.counts += np.histogram(values, self.edges)[0]
+
+    def percentile(self, q):
+        cumulative = np.cumsum(self.counts)
+        target = q / 100 * cumulative[-1]
+        i = min(int(np.searchsorted(cumulative, target)),
+                len(self.counts) - 1)
+        before = cumulative[i - 1] if i else 0
+        fraction = (target - before) / self.counts[i] \
+            if self.counts[i] else 0
+        return float(self.edges[i] +
+                     fraction * (self.edges[i + 1] - self.edges[i]))
+
+
+def compute_stats(chunks, threshold, usage_min, usage_max, bins=10000):
+    """
+    Compute the stats of a run from (times, usages) chunks in one pass and
+    in memory bounded by the chunk size: time above threshold, usage mean
+    and percentiles, and the longest sustained spike above threshold.
+
+    As everywhere else, the interval between two samples is above threshold
+    when the earlier sample is, and holds the usage of the earlier sample
+    for the time weighted mean. usage_min and usage_max bound the
+    histogram used for the percentiles.
+    """
+    if usage_min is None:
+        return None
+
+    histogram = UsageHistogram(usage_min, usage_max, bins)
+    measurements = 0
+    usage_sum = 0.0
+    time_above_threshold = 0.0
+    usage_time_sum = sampled_time = 0.0
+    longest, longest_start = 0.0, None
+    # Spike still going on at the end of the previous chunk
+    spike, spike_start = 0.0, None
+    last = None
+
+    for times, usages in chunks:
+        histogram.add(usages)
+        measurements += len(usages)
+        usage_sum += float(usages.sum())
+
+        if last is not None:
+            times = np.concatenate(([last[0]], times))
+            usages = np.concatenate(([last[1]], usages))
+        last = times[-1], usages[-1]
+        if len(times) < 2:
+            continue
+
+        elapsed = np.diff(times)
+        usage_time_sum += float(np.dot(elapsed, usages[:-1]))
+        sampled_time += float(elapsed.sum())
+        if threshold is None:
+            continue
+
+        above = usages[:-1] > threshold
+        time_above_threshold += float(elapsed[above].sum())
+
+        steps = np.diff(np.concatenate(([0], above.astype(np.int8), [0])))
+        starts = np.flatnonzero(steps == 1)
+        ends = np.flatnonzero(steps == -1)
+        offsets = np.concatenate(([0.0], np.cumsum(elapsed)))
+        durations = offsets[ends] - offsets[starts]
+        start_times = times[starts]
+
+        if starts.size and starts[0] == 0 and spike_start is not None:
+            durations[0] += spike
+            start_times[0] = spike_start
+        elif spike > longest:
+            longest, longest_start = spike, spike_start
+        spike, spike_start = 0.0, None
+
+        if ends.size and ends[-1] == len(above):
+            spike, spike_start = float(durations[-1]), start_times[-1]
+            durations, start_times = durations[:-1], start_times[:-1]
+
+        if durations.size:
+            i = int(np.argmax(durations))
+            if durations[i] > longest:
+                longest, longest_start = float(durations[i]), start_times[i]
+
+    if spike > longest:
+        longest, longest_start = spike, spike_start
+
+    return {
+        'measurements': measurements,
+        'threshold': threshold,
+        'time_above_threshold': time_above_threshold,
+        'longest_spike': {
+            'duration': longest,
+            'start_time': from_epoch(longest_start),
+        },
+        'usage': dict({
+            'min': usage_min,
+            'max': usage_max,
+            'mean': usage_sum / measurements,
+            'time_weighted_mean': usage_time_sum / sampled_time
+            if sampled_time else usage_sum / measurements,
+        }, **{f'p{q}': histogram.percentile(q) for q in PERCENTILES}),
+    }
+
+
+def from_epoch(seconds):
+    if seconds is None:
+        return None
+    return datetime.fromtimestamp(float(seconds), timezone.utc) \
+        .replace(tzinfo=None)
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+from flask import current_app
+
+
+class TTLCache:
+    """
+    Thread safe mapping that evicts the least recently used entry once it
+    holds maxsize of them, and forgets entries older than ttl seconds.
+    """
+
+    def __init__(self, maxsize, ttl, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > self.clock():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def get_cache(name):
+    """
+    Return the app wide cache called name, sized by the {NAME}_CACHE_SIZE
+    and {NAME}_CACHE_TTL settings.
+    """
+    caches = current_app.extensions.setdefault('grasshopper_caches', {})
+    if name not in caches:
+        prefix = name.upper()
+        cache = TTLCache(current_app.config[f'{prefix}_CACHE_SIZE'],
+                         current_app.config[f'{prefix}_CACHE_TTL'])
+        caches.setdefault(name, cache)
+    return caches[name]
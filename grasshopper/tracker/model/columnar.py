@@ -0,0 +1,370 @@
+from threading import Lock, Thread
+import logging
+import queue
+import zlib
+
+import click
+from flask import current_app
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Missing process metrics are stored as this value, they are never negative
+MISSING = -1
+
+
+def parse_times(values):
+    """
+    Parse ISO timestamps into int64 microseconds since the epoch.
+    """
+    return np.array(values, dtype='datetime64[us]').astype(np.int64)
+
+
+def to_datetimes(micros):
+    return micros.astype('datetime64[us]').tolist()
+
+
+def compress(values, dtype):
+    return zlib.compress(np.ascontiguousarray(values, dtype).tobytes())
+
+
+def decompress(blob, dtype):
+    return np.frombuffer(zlib.decompress(blob), dtype)
+
+
+class ColumnReader:
+    """
+    Inflates a compressed column a few values at a time.
+    """
+
+    def __init__(self, blob, dtype):
+        self.dtype = np.dtype(dtype)
+        self.stream = zlib.decompressobj()
+        self.tail = blob
+        self.pending = b''
+
+    def read(self, count):
+        size = count * self.dtype.itemsize
+        while len(self.pending) < size and self.tail:
+            self.pending += self.stream.decompress(self.tail,
+                                                   size - len(self.pending))
+            self.tail = self.stream.unconsumed_tail
+        if len(self.pending) < size:
+            self.pending += self.stream.flush()
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return np.frombuffer(data, self.dtype)
+
+
+class Columns:
+    """
+    Samples of a run as one array per column, ordered by time: int64
+    microseconds since the epoch, float64 usages, an int64 array per
+    process metric with MISSING for the samples without it, and the per
+    core usages of every sample, concatenated, along with their count.
+
+    Stored in cpu_usage_compact with the times as deltas and the usages as
+    float32, each column compressed with zlib.
+    """
+
+    def __init__(self, times, usages, metrics, per_cpu_counts,
+                 per_cpu_values, last_id=None):
+        self.times = times
+        self.usages = usages
+        self.metrics = metrics
+        self.per_cpu_counts = per_cpu_counts
+        self.per_cpu_values = per_cpu_values
+        # Id of the last raw sample folded into the columns
+        self.last_id = last_id
+
+    def __len__(self):
+        return len(self.times)
+
+    @classmethod
+    def from_rows(cls, rows, metric_names):
+        """
+        Build the columns of (time, usage, *metrics, per_cpu) rows, with
+        per_cpu as stored in cpu_usage.
+        """
+        columns = list(zip(*rows))
+        blobs = columns[-1]
+        return cls(
+            parse_times(columns[0]),
+            np.array(columns[1], dtype=np.float64),
+            {name: np.array([MISSING if value is None else value
+                             for value in values], dtype=np.int64)
+             for name, values in zip(metric_names, columns[2:-1])},
+            np.array([len(blob) // 4 if blob else 0 for blob in blobs],
+                     dtype=np.int32),
+            np.frombuffer(b''.join(blob for blob in blobs if blob), '<f4'),
+        )
+
+    @classmethod
+    def concatenate(cls, parts):
+        """
+        Merge columns into one, sorted by time. Samples with the same
+        time keep their order.
+        """
+        merged = cls(
+            np.concatenate([part.times for part in parts]),
+            np.concatenate([part.usages for part in parts]),
+            {name: np.concatenate([part.metrics[name] for part in parts])
+             for name in parts[0].metrics},
+            np.concatenate([part.per_cpu_counts for part in parts]),
+            np.concatenate([part.per_cpu_values for part in parts]),
+        )
+        if np.all(merged.times[1:] >= merged.times[:-1]):
+            return merged
+
+        order = np.argsort(merged.times, kind='stable')
+        per_cpu_values = merged.per_cpu_values
+        if per_cpu_values.size:
+            offsets = merged.per_cpu_offsets()
+            per_cpu_values = np.concatenate(
+                [per_cpu_values[offsets[i]:offsets[i + 1]] for i in order])
+        return cls(
+            merged.times[order],
+            merged.usages[order],
+            {name: values[order] for name, values in merged.metrics.items()},
+            merged.per_cpu_counts[order],
+            per_cpu_values,
+        )
+
+    def per_cpu_offsets(self):
+        return np.concatenate(([0], np.cumsum(self.per_cpu_counts)))
+
+    def per_cpu(self):
+        """
+        Return the per core usages of every sample, None when missing.
+        """
+        offsets = self.per_cpu_offsets()
+        return [self.per_cpu_values[start:end].tolist() if end > start
+                else None for start, end in zip(offsets, offsets[1:])]
+
+    def between(self, start=None, end=None):
+        """
+        Return the index range of the samples from start to end, both
+        optional naive UTC datetimes.
+        """
+        low, high = 0, len(self)
+        if start is not None:
+            low = np.searchsorted(self.times, parse_times(start), 'left')
+        if end is not None:
+            high = np.searchsorted(self.times, parse_times(end), 'left')
+        return int(low), int(high)
+
+    def store(self, db, test_run_id):
+        deltas = np.diff(self.times, prepend=self.times[0])
+        db.execute(
+            '''
+            INSERT OR REPLACE INTO
+                cpu_usage_compact (test_run_id, samples, last_id,
+                                   first_time, last_time, time, usage,
+                                   rss, threads, io_read, io_write,
+                                   per_cpu_counts, per_cpu)
+            VALUES (:test_run_id, :samples, :last_id, :first_time,
+                    :last_time, :time, :usage, :rss, :threads, :io_read,
+                    :io_write, :per_cpu_counts, :per_cpu)
+            ''',
+            dict({
+                'test_run_id': test_run_id,
+                'samples': len(self),
+                'last_id': self.last_id,
+                'first_time': to_datetimes(self.times[0])
+                .isoformat(sep=' '),
+                'last_time': to_datetimes(self.times[-1])
+                .isoformat(sep=' '),
+                'time': compress(deltas, '<i8'),
+                'usage': compress(self.usages, '<f4'),
+                'per_cpu_counts': compress(self.per_cpu_counts, '<i4')
+                if self.per_cpu_values.size else None,
+                'per_cpu': compress(self.per_cpu_values, '<f4')
+                if self.per_cpu_values.size else None,
+            }, **{name: compress(values, '<i8')
+                  if np.any(values != MISSING) else None
+                  for name, values in self.metrics.items()}),
+        )
+
+    @classmethod
+    def load(cls, db, test_run_id, metric_names):
+        """
+        Return the compacted samples of a run, or None if it has none.
+        """
+        row = load_compacted_row(db, test_run_id)
+        if row is None:
+            return None
+
+        samples = row['samples']
+        first = parse_times(row['first_time'].isoformat())
+        return cls(
+            first + np.cumsum(decompress(row['time'], '<i8')),
+            decompress(row['usage'], '<f4').astype(np.float64),
+            {name: decompress(row[name], '<i8') if row[name]
+             else np.full(samples, MISSING, dtype=np.int64)
+             for name in metric_names},
+            decompress(row['per_cpu_counts'], '<i4')
+            if row['per_cpu_counts'] else np.zeros(samples, np.int32),
+            decompress(row['per_cpu'], '<f4') if row['per_cpu']
+            else np.zeros(0, np.float32),
+            row['last_id'],
+        )
+
+
+def load_compacted_row(db, test_run_id):
+    return db.execute(
+        'SELECT * FROM cpu_usage_compact WHERE test_run_id = ?',
+        (test_run_id,),
+    ).fetchone()
+
+
+def iter_columns(row, metric_names=(), per_cpu=False, chunk_size=65536):
+    """
+    Yield the samples of a cpu_usage_compact row as Columns of at most
+    chunk_size samples, inflating the blobs as it goes. Only the given
+    metrics, and the per core usages if asked, are read.
+    """
+    samples = row['samples']
+    times = ColumnReader(row['time'], '<i8')
+    usages = ColumnReader(row['usage'], '<f4')
+    metrics = {name: ColumnReader(row[name], '<i8')
+               for name in metric_names if row[name]}
+    counts = values = None
+    if per_cpu and row['per_cpu']:
+        counts = ColumnReader(row['per_cpu_counts'], '<i4')
+        values = ColumnReader(row['per_cpu'], '<f4')
+
+    last = parse_times(row['first_time'].isoformat())
+    for offset in range(0, samples, chunk_size):
+        count = min(chunk_size, samples - offset)
+        chunk_times = last + np.cumsum(times.read(count))
+        last = chunk_times[-1]
+        chunk_counts = counts.read(count) if counts is not None \
+            else np.zeros(count, np.int32)
+        yield Columns(
+            chunk_times,
+            usages.read(count).astype(np.float64),
+            {name: metrics[name].read(count) if name in metrics
+             else np.full(count, MISSING, dtype=np.int64)
+             for name in metric_names},
+            chunk_counts,
+            values.read(int(chunk_counts.sum())) if values is not None
+            else np.zeros(0, np.float32),
+        )
+
+
+def stream_compact_usage(db, test_run_id, chunk_size):
+    """
+    Yield the (times, usages) of a compacted run like stream_usage does,
+    inflating the columns a chunk at a time, or return None if the run
+    is not compacted.
+    """
+    row = load_compacted_row(db, test_run_id)
+    if row is None:
+        return None
+    return ((columns.times / 1e6, columns.usages)
+            for columns in iter_columns(row, chunk_size=chunk_size))
+
+
+def float32_list(values):
+    """
+    Float32 values as a list of the floats they were made from, rather
+    than of their exact value.
+    """
+    return np.asarray(values, np.float32).astype(str).astype(float).tolist()
+
+
+def bucket_usage(times, usages, resolution):
+    """
+    Group samples into buckets of resolution seconds, yielding the start
+    in seconds since the epoch, count, min, max and sum of each.
+    """
+    if not len(times):
+        return
+    buckets = times // 1_000_000 // resolution * resolution
+    starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+    counts = np.diff(np.append(starts, len(buckets)))
+    for values in zip(buckets[starts].tolist(), counts.tolist(),
+                      np.minimum.reduceat(usages, starts).tolist(),
+                      np.maximum.reduceat(usages, starts).tolist(),
+                      np.add.reduceat(usages, starts).tolist()):
+        yield values
+
+
+@click.command('compact-runs')
+def compact_runs_command():
+    # Register command to compact the finished runs recorded before
+    # compaction existed, or that got samples after being finished
+    from .storage import get_storage
+    from .testrun import TestRun
+
+    storage = get_storage()
+    for shard in range(storage.shards):
+        runs = storage.shard(shard).execute(
+            'SELECT DISTINCT test_run_id FROM cpu_usage'
+        ).fetchall()
+        for run in runs:
+            test_run = TestRun.find_by_id(run['test_run_id'])
+            if test_run is None or test_run.is_active:
+                continue
+            compacted = test_run.compact()
+            click.echo(f'Compacted {compacted} samples of testrun '
+                       f'{test_run.id}')
+    click.echo('Every finished run is compacted.')
+
+
+class Compactor:
+    """
+    Compacts the runs that were stopped, one at a time, in a background
+    thread, so that stopping a run does not wait for it. While max_runs
+    are waiting, the others are left for compact-runs and counted.
+    """
+
+    def __init__(self, app, max_runs=1000):
+        self.app = app
+        self.runs = queue.Queue(max_runs)
+        self.lock = Lock()
+        self.worker = None
+        self.skipped = 0
+
+    def submit(self, test_run):
+        try:
+            self.runs.put_nowait(test_run)
+        except queue.Full:
+            logger.warning(f'Compaction queue full, testrun {test_run.id} '
+                           'is left for compact-runs')
+            with self.lock:
+                self.skipped += 1
+            return
+        if self.worker is None:
+            with self.lock:
+                if self.worker is None:
+                    self.worker = Thread(target=self.run, name='compactor',
+                                         daemon=True)
+                    self.worker.start()
+
+    def join(self):
+        """
+        Wait until every run submitted so far is compacted.
+        """
+        self.runs.join()
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                test_run = self.runs.get()
+                try:
+                    test_run.compact()
+                except Exception:
+                    logger.exception(
+                        f'Could not compact testrun {test_run.id}')
+                finally:
+                    self.runs.task_done()
+
+
+def get_compactor():
+    return current_app.extensions['grasshopper_compactor']
+
+
+def init_app(app):
+    app.cli.add_command(compact_runs_command)
+    app.extensions['grasshopper_compactor'] = Compactor(
+        app, app.config['COMPACT_QUEUE_SIZE'])
@@ -1,32 +1,96 @@
+from contextlib import contextmanager
 from datetime import datetime
-from flask import g, current_app
+from flask import current_app
 import click
+import os
 import sqlite3
 
+from . import storage
+from .storage import get_storage
+
+MIGRATIONS_PATH = 'model/schemas/migrations'
+
 
 def get_db():
-    if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+    """
+    Return the main database connection of the app context, holding the
+    users, the runs and the stats of the finished ones.
+    """
+    return get_storage().main()
+
+
+def get_shard_db(test_run_id):
+    """
+    Return the connection to the database holding the samples, rollups,
+    compacted samples and stats of a run.
+    """
+    backend = get_storage()
+    return backend.shard(backend.shard_of(test_run_id))
+
 
-    return g.db
+@contextmanager
+def transaction(db):
+    """
+    Run a block in a write transaction taken upfront, so that rows read
+    in it cannot be changed by other writers before it commits.
+    """
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield db
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
 
 
 def close_db(e=None):
-    db = g.pop('db', None)
+    get_storage().teardown()
 
-    if db is not None:
-        db.close()
+
+def list_migrations():
+    """
+    Return the (version, filename) of every migration, in order.
+    """
+    path = os.path.join(current_app.root_path, MIGRATIONS_PATH)
+    return sorted((int(filename.split('_', 1)[0]), filename)
+                  for filename in os.listdir(path)
+                  if filename.endswith('.sql'))
+
+
+def migrate_db():
+    """
+    Apply the migrations newer than the schema version of each database
+    file, each one in its own transaction. Return the applied ones.
+    Shards get the same schema as the main database.
+    """
+    applied = []
+    for db in get_storage().connections():
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        for number, filename in list_migrations():
+            if number <= version:
+                continue
+            with current_app.open_resource(
+                    f'{MIGRATIONS_PATH}/{filename}') as f:
+                script = f.read().decode('utf8')
+            db.executescript(f'BEGIN;\n{script}\n'
+                             f'PRAGMA user_version = {number};\nCOMMIT;')
+            if filename not in applied:
+                applied.append(filename)
+    return applied
 
 
 def init_db():
-    db = get_db()
+    for db in get_storage().connections():
+        tables = db.execute(
+            "SELECT name FROM sqlite_master "
+            "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        ).fetchall()
+        for table in tables:
+            db.execute(f'DROP TABLE "{table["name"]}"')
+        db.execute('PRAGMA user_version = 0')
+        db.commit()
 
-    with current_app.open_resource('model/schemas/tracker.sql') as f:
-        db.executescript(f.read().decode('utf8'))
+    migrate_db()
 
 
 @click.command('init-db')
@@ -36,11 +100,22 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+@click.command('migrate-db')
+def migrate_db_command():
+    # Register command to upgrade an existing database in place
+    applied = migrate_db()
+    for filename in applied:
+        click.echo(f'Applied {filename}')
+    click.echo('The database is up to date.')
+
+
 sqlite3.register_converter(
     "timestamp", lambda v: datetime.fromisoformat(v.decode())
 )
 
 
 def init_app(app):
+    storage.init_app(app)
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
@@ -0,0 +1,23 @@
+from array import array
+import sys
+
+
+def pack_floats(values):
+    """
+    Pack a sequence of floats into a little-endian float32 blob.
+    """
+    packed = array('f', values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_floats(blob):
+    """
+    Inverse of pack_floats, returns an array('f').
+    """
+    values = array('f')
+    values.frombytes(blob)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
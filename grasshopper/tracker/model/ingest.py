@@ -0,0 +1,288 @@
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from threading import Condition, Thread
+import atexit
+import logging
+import time
+
+from flask import current_app
+
+from .storage import get_storage
+from .testrun import TestRunStopped, store_samples
+
+logger = logging.getLogger(__name__)
+
+Entry = namedtuple('Entry', ['test_run', 'samples', 'future'])
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+class IngestQueue:
+    """
+    Queue of samples waiting to be stored, drained by a single writer
+    thread that commits them in groups: whatever arrived within
+    commit_interval seconds of the oldest pending entry, or commit_rows
+    samples, whichever comes first. Many small requests then share one
+    transaction instead of paying for a commit each.
+
+    Each submission gets a Future resolved once its samples are
+    committed. Submissions beyond max_rows pending samples are refused
+    with IngestQueueFull, so the callers can back off.
+
+    There is a queue per storage shard, each committing to its own shard.
+
+    Runs being stopped are refused with TestRunStopped for stopped_ttl
+    seconds, long enough for the requests holding a copy of them from
+    before to be done, so that none of their samples is committed after
+    the run ends.
+    """
+
+    def __init__(self, app, shard, max_rows, commit_rows, commit_interval,
+                 stopped_ttl=60):
+        self.app = app
+        self.shard = shard
+        self.max_rows = max_rows
+        self.commit_rows = commit_rows
+        self.commit_interval = commit_interval
+        self.stopped_ttl = stopped_ttl
+        self.entries = deque()
+        self.pending_rows = 0
+        self.condition = Condition()
+        self.writer = None
+        self.closed = False
+        # Deadline until which the samples of each run stopped are refused
+        self.stopped = {}
+
+        self.commits = 0
+        self.committed_rows = 0
+        self.failed_rows = 0
+        self.refused_rows = 0
+        self.commit_seconds_total = 0.0
+        self.commit_seconds_max = 0.0
+        self.last_commit_seconds = None
+
+    def submit(self, test_run, samples):
+        """
+        Queue samples of a run for storage and return a Future resolved
+        with their count once committed. Raise IngestQueueFull if the
+        queue has no room left for them, TestRunStopped if the run is
+        being stopped.
+        """
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise IngestQueueFull('Ingest queue is closed')
+            if test_run is not None and test_run.id in self.stopped:
+                raise TestRunStopped(f'Testrun {test_run.id} is stopped')
+            if self.pending_rows + len(samples) > self.max_rows:
+                self.refused_rows += len(samples)
+                raise IngestQueueFull(
+                    f'{self.pending_rows} samples pending')
+            self.start_writer()
+            self.entries.append(Entry(test_run, samples, future))
+            self.pending_rows += len(samples)
+            self.condition.notify()
+        return future
+
+    def flush(self, timeout=None):
+        """
+        Wait until every sample submitted so far has been committed.
+        """
+        with self.condition:
+            if self.writer is None:
+                return
+        self.submit(None, []).result(timeout)
+
+    def stop_run(self, test_run_id, timeout=None):
+        """
+        Refuse the samples of a run from now on and wait until the ones
+        submitted before are committed, so that the run can end with all
+        of them. Raise as flush does, the run taking samples again.
+        """
+        now = time.monotonic()
+        with self.condition:
+            self.stopped = {id: deadline
+                            for id, deadline in self.stopped.items()
+                            if deadline > now}
+            self.stopped[test_run_id] = now + self.stopped_ttl
+        try:
+            self.flush(timeout)
+        except Exception:
+            with self.condition:
+                self.stopped.pop(test_run_id, None)
+            raise
+
+    def close(self, timeout=None):
+        """
+        Commit the pending samples and stop the writer thread.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+            writer = self.writer
+        if writer is not None:
+            writer.join(timeout)
+
+    def start_writer(self):
+        if self.writer is None:
+            self.writer = Thread(target=self.run,
+                                 name=f'ingest-writer-{self.shard}',
+                                 daemon=True)
+            self.writer.start()
+            atexit.register(self.close)
+
+    def run(self):
+        with self.app.app_context():
+            while group := self.next_group():
+                self.commit(group)
+
+    def next_group(self):
+        """
+        Block until a group of entries is due and return it, or return
+        None once the queue is closed and empty.
+        """
+        with self.condition:
+            while not self.entries:
+                if self.closed:
+                    return None
+                self.condition.wait()
+
+            deadline = time.monotonic() + self.commit_interval
+            while not self.closed and self.pending_rows < self.commit_rows \
+                    and self.entries[-1].test_run is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            group = []
+            rows = 0
+            while self.entries and rows < self.commit_rows:
+                entry = self.entries.popleft()
+                group.append(entry)
+                rows += len(entry.samples)
+            return group
+
+    def commit(self, group):
+        runs = {}
+        for entry in group:
+            if entry.test_run is not None:
+                runs.setdefault(entry.test_run.id, (entry.test_run, []))[1] \
+                    .extend(entry.samples)
+
+        start = time.perf_counter()
+        errors = {}
+        try:
+            updates = store_samples(get_storage().shard(self.shard),
+                                    runs.values())
+        except Exception:
+            # Samples that were not committed must not be published
+            updates = []
+            # Commit the runs one by one so that a bad run does not make
+            # the others lose their samples
+            for test_run, samples in runs.values():
+                try:
+                    test_run.record_cpu_usage_batch(samples)
+                except TestRunStopped as e:
+                    errors[test_run.id] = e
+                except Exception as e:
+                    logger.exception(f'Could not store {len(samples)} '
+                                     f'samples of testrun {test_run.id}')
+                    errors[test_run.id] = e
+        elapsed = time.perf_counter() - start
+        for test_run, update in updates:
+            test_run.publish(update)
+
+        rows = sum(len(entry.samples) for entry in group)
+        failed = sum(len(samples) for id, (_, samples) in runs.items()
+                     if id in errors)
+        with self.condition:
+            self.pending_rows -= rows
+            self.commits += 1
+            self.committed_rows += rows - failed
+            self.failed_rows += failed
+            self.commit_seconds_total += elapsed
+            self.commit_seconds_max = max(self.commit_seconds_max, elapsed)
+            self.last_commit_seconds = elapsed
+
+        for entry in group:
+            error = errors.get(getattr(entry.test_run, 'id', None))
+            if error is not None:
+                entry.future.set_exception(error)
+            else:
+                entry.future.set_result(len(entry.samples))
+
+    def metrics(self):
+        with self.condition:
+            return {
+                'queue_depth': self.pending_rows,
+                'queue_capacity': self.max_rows,
+                'commits': self.commits,
+                'committed_rows': self.committed_rows,
+                'failed_rows': self.failed_rows,
+                'refused_rows': self.refused_rows,
+                'commit_latency': {
+                    'last': self.last_commit_seconds,
+                    'max': self.commit_seconds_max,
+                    'mean': self.commit_seconds_total / self.commits
+                    if self.commits else None,
+                },
+            }
+
+
+def get_ingest_queue(test_run_id):
+    """
+    Return the ingest queue of the shard of a run, or None if
+    INGEST_QUEUE_ROWS disables them.
+    """
+    queues = get_ingest_queues()
+    if not queues:
+        return None
+    return queues[get_storage().shard_of(test_run_id)]
+
+
+def get_ingest_queues():
+    return current_app.extensions.get('grasshopper_ingest', [])
+
+
+def merge_metrics(metrics):
+    """
+    Combine the metrics of the queues of every shard into one report, with
+    the ones of each shard under shards when there are several.
+    """
+    commits = sum(shard['commits'] for shard in metrics)
+    latencies = [shard['commit_latency'] for shard in metrics]
+    merged = {
+        name: sum(shard[name] for shard in metrics)
+        for name in ('queue_depth', 'queue_capacity', 'commits',
+                     'committed_rows', 'failed_rows', 'refused_rows')
+    }
+    merged['commit_latency'] = {
+        'last': max((latency['last'] for latency in latencies
+                     if latency['last'] is not None), default=None),
+        'max': max(latency['max'] for latency in latencies),
+        'mean': sum(latency['mean'] * shard['commits']
+                    for latency, shard in zip(latencies, metrics)
+                    if shard['commits']) / commits if commits else None,
+    }
+    if len(metrics) > 1:
+        merged['shards'] = metrics
+    return merged
+
+
+def init_app(app):
+    if app.config['INGEST_QUEUE_ROWS'] > 0:
+        storage = app.extensions['grasshopper_storage']
+        app.extensions['grasshopper_ingest'] = [
+            IngestQueue(
+                app,
+                shard,
+                app.config['INGEST_QUEUE_ROWS'],
+                app.config['INGEST_COMMIT_ROWS'],
+                app.config['INGEST_COMMIT_INTERVAL_MS'] / 1000,
+                app.config['TESTRUN_CACHE_TTL'],
+            )
+            for shard in range(storage.shards)
+        ]
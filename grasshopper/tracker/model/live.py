@@ -0,0 +1,138 @@
+from collections import deque
+from threading import Condition, Lock
+import time
+
+from flask import current_app
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+class Subscription:
+    """
+    Mailbox of one live subscriber of a run. Publishing never blocks:
+    once more than max_samples samples wait to be read, the oldest are
+    dropped and counted, and only the latest aggregates are kept, so a
+    slow consumer sees a coalesced view of the run rather than holding
+    the ingest path up.
+    """
+
+    def __init__(self, test_run_id, max_samples):
+        self.test_run_id = test_run_id
+        self.samples = deque(maxlen=max_samples)
+        self.stats = None
+        self.dropped = 0
+        self.finished = False
+        self.condition = Condition()
+
+    def push(self, samples, stats):
+        with self.condition:
+            overflow = len(self.samples) + len(samples) - self.samples.maxlen
+            if overflow > 0:
+                self.dropped += overflow
+            self.samples.extend(samples)
+            self.stats = stats
+            self.condition.notify()
+
+    def finish(self):
+        with self.condition:
+            self.finished = True
+            self.condition.notify()
+
+    def get(self, timeout):
+        """
+        Wait up to timeout seconds for news and return them as a
+        {samples, stats, dropped, finished} dict, or None if there are
+        none. Finished is only reported once everything else was read.
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while not (self.samples or self.stats or self.finished):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+            update = {
+                'samples': list(self.samples),
+                'stats': self.stats,
+                'dropped': self.dropped,
+                'finished': self.finished,
+            }
+            self.samples.clear()
+            self.stats = None
+            self.dropped = 0
+            return update
+
+
+class LiveBroker:
+    """
+    In process publish/subscribe of the samples of running runs, fed by
+    the ingest path once they are committed, so that live views never
+    read the database. Subscribers only see the samples stored by the
+    process they are connected to.
+    """
+
+    def __init__(self, max_subscribers, max_samples):
+        self.max_subscribers = max_subscribers
+        self.max_samples = max_samples
+        self.subscriptions = {}
+        self.lock = Lock()
+        self.published = 0
+
+    def subscribe(self, test_run_id):
+        """
+        Return a new Subscription to the run. Raise TooManySubscribers if
+        max_subscribers are already connected.
+        """
+        subscription = Subscription(test_run_id, self.max_samples)
+        with self.lock:
+            if self.subscribers() >= self.max_subscribers:
+                raise TooManySubscribers(
+                    f'{self.max_subscribers} live subscribers connected')
+            self.subscriptions.setdefault(test_run_id, set()) \
+                .add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.test_run_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.subscriptions[subscription.test_run_id]
+
+    def subscribers(self, test_run_id=None):
+        if test_run_id is None:
+            return sum(map(len, self.subscriptions.values()))
+        return len(self.subscriptions.get(test_run_id, ()))
+
+    def publish(self, test_run_id, samples, stats):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(test_run_id, ()))
+            self.published += len(samples)
+        for subscription in subscriptions:
+            subscription.push(samples, stats)
+
+    def finish(self, test_run_id):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(test_run_id, ()))
+        for subscription in subscriptions:
+            subscription.finish()
+
+
+def get_live_broker():
+    """
+    Return the app's live broker, or None if LIVE_MAX_SUBSCRIBERS disables
+    it.
+    """
+    return current_app.extensions.get('grasshopper_live')
+
+
+def init_app(app):
+    if app.config['LIVE_MAX_SUBSCRIBERS'] > 0:
+        app.extensions['grasshopper_live'] = LiveBroker(
+            app.config['LIVE_MAX_SUBSCRIBERS'],
+            app.config['LIVE_BUFFER_SAMPLES'],
+        )
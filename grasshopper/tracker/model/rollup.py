@@ -0,0 +1,230 @@
+from datetime import datetime, timedelta
+import math
+import re
+
+import click
+from flask import current_app
+
+from .columnar import Columns, bucket_usage
+from .db import get_db, get_shard_db
+
+# Bucket sizes of the rollup tiers, in seconds
+ROLLUP_RESOLUTIONS = (10, 60, 600)
+
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+EPOCH = datetime(1970, 1, 1)
+
+
+def parse_resolution(value):
+    """
+    Parse a resolution such as 10s, 1m or 2h into seconds, or None for
+    raw samples. Raise a ValueError if it is not one.
+    """
+    if value == 'raw':
+        return None
+    match = re.fullmatch(r'(\d+)([smhd]?)', value)
+    if match is None or int(match[1]) == 0:
+        raise ValueError(f'Invalid resolution {value!r}')
+    return int(match[1]) * UNITS[match[2] or 's']
+
+
+def format_resolution(seconds):
+    if seconds is None:
+        return 'raw'
+    for unit in ('d', 'h', 'm'):
+        if seconds % UNITS[unit] == 0:
+            return f'{seconds // UNITS[unit]}{unit}'
+    return f'{seconds}s'
+
+
+def epoch_seconds(time):
+    return (time - EPOCH) // timedelta(seconds=1)
+
+
+def bucket_start(time, resolution):
+    seconds = epoch_seconds(time)
+    return EPOCH + timedelta(seconds=seconds - seconds % resolution)
+
+
+def source_tier(resolution):
+    """
+    Return the coarsest rollup tier whose buckets add up to buckets of
+    resolution seconds, or None if only raw samples can give them.
+    """
+    if resolution is None:
+        return None
+    return max((tier for tier in ROLLUP_RESOLUTIONS
+                if resolution % tier == 0), default=None)
+
+
+def pick_resolution(span, samples, max_points):
+    """
+    Pick the finest resolution that shows samples spread over span seconds
+    in at most max_points points, raw samples included.
+    """
+    if samples <= max_points:
+        return None
+    for tier in ROLLUP_RESOLUTIONS:
+        if span / tier <= max_points:
+            return tier
+    coarsest = ROLLUP_RESOLUTIONS[-1]
+    return math.ceil(span / max_points / coarsest) * coarsest
+
+
+def update_rollups(db, test_run_id, samples):
+    """
+    Add (time, usage) samples of a run to the buckets of every tier.
+    """
+    buckets = {}
+    for time, usage in samples:
+        seconds = epoch_seconds(time)
+        for resolution in ROLLUP_RESOLUTIONS:
+            key = (resolution, seconds - seconds % resolution)
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [1, usage, usage, usage]
+            else:
+                bucket[0] += 1
+                bucket[1] = min(bucket[1], usage)
+                bucket[2] = max(bucket[2], usage)
+                bucket[3] += usage
+
+    db.executemany(
+        '''
+        INSERT INTO
+            usage_rollup (test_run_id, resolution, bucket,
+                          count, usage_min, usage_max, usage_sum)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (test_run_id, resolution, bucket) DO UPDATE SET
+            count = count + excluded.count,
+            usage_min = MIN(usage_min, excluded.usage_min),
+            usage_max = MAX(usage_max, excluded.usage_max),
+            usage_sum = usage_sum + excluded.usage_sum
+        ''',
+        [(test_run_id, resolution,
+          (EPOCH + timedelta(seconds=start)).isoformat(sep=' '), *bucket)
+         for (resolution, start), bucket in buckets.items()],
+    )
+
+
+def fetch_buckets(db, test_run_id, resolution, start=None, end=None):
+    """
+    Yield the usage of a run in buckets of resolution seconds, from start
+    to end (naive UTC datetimes, both optional), built from the coarsest
+    tier that fits or from the raw or compacted samples.
+    """
+    tier = source_tier(resolution)
+    if start is not None:
+        start = bucket_start(start, resolution)
+    compacted = Columns.load(db, test_run_id, ()) if tier is None else None
+    if compacted is not None:
+        first, last = compacted.between(start, end)
+        rows = bucket_usage(compacted.times[first:last],
+                            compacted.usages[first:last], resolution)
+    else:
+        rows = query_buckets(db, test_run_id, resolution, tier, start, end)
+
+    for seconds, count, low, high, total in rows:
+        yield {
+            'time': (EPOCH + timedelta(seconds=seconds)).isoformat(),
+            'count': count,
+            'min': low,
+            'max': high,
+            'mean': total / count,
+        }
+
+
+def query_buckets(db, test_run_id, resolution, tier, start, end):
+    if tier is None:
+        table, time, count, low, high, total = \
+            'cpu_usage', 'time', 'COUNT(*)', 'MIN(usage)', 'MAX(usage)', \
+            'SUM(usage)'
+    else:
+        table, time, count, low, high, total = \
+            'usage_rollup', 'bucket', 'SUM(count)', 'MIN(usage_min)', \
+            'MAX(usage_max)', 'SUM(usage_sum)'
+
+    conditions = ['test_run_id = :test_run_id']
+    if tier is not None:
+        conditions.append('resolution = :tier')
+    if start is not None:
+        conditions.append(f'{time} >= :start')
+        start = start.isoformat(sep=' ')
+    if end is not None:
+        conditions.append(f'{time} < :end')
+        end = end.isoformat(sep=' ')
+
+    return db.execute(
+        f'''
+        SELECT
+            CAST(strftime('%s', {time}) AS INTEGER)
+                / :resolution * :resolution AS start,
+            {count}, {low}, {high}, {total}
+        FROM {table}
+        WHERE {' AND '.join(conditions)}
+        GROUP BY 1
+        ORDER BY 1
+        ''',
+        {'test_run_id': test_run_id, 'tier': tier, 'resolution': resolution,
+         'start': start, 'end': end},
+    )
+
+
+def prune_raw_samples(before):
+    """
+    Delete the raw samples older than before of finished runs, one run at
+    a time, and the compacted ones of runs that ended before. Their stats
+    and rollups are kept. Return how many went.
+    """
+    cutoff = before.isoformat(sep=' ')
+    runs = get_db().execute(
+        '''
+        SELECT id FROM test_run
+        WHERE end_time IS NOT NULL AND start_time < ?
+        ''',
+        (cutoff,),
+    ).fetchall()
+
+    deleted = 0
+    for run in runs:
+        db = get_shard_db(run['id'])
+        deleted += db.execute(
+            'DELETE FROM cpu_usage WHERE test_run_id = ? AND time < ?',
+            (run['id'], cutoff),
+        ).rowcount
+        # Compacted runs go as a whole, once all their samples are old
+        compacted = db.execute(
+            '''
+            SELECT samples FROM cpu_usage_compact
+            WHERE test_run_id = ? AND last_time < ?
+            ''',
+            (run['id'], cutoff),
+        ).fetchone()
+        if compacted is not None:
+            db.execute('DELETE FROM cpu_usage_compact WHERE test_run_id = ?',
+                       (run['id'],))
+            deleted += compacted['samples']
+        db.commit()
+    return deleted
+
+
+@click.command('prune-samples')
+@click.option('--days', type=float, default=None,
+              help='Keep the raw samples of the last days only. '
+                   'Defaults to the RAW_RETENTION_DAYS setting.')
+def prune_samples_command(days):
+    # Register command to apply the raw sample retention policy
+    from .testrun import utcnow
+
+    if days is None:
+        days = current_app.config['RAW_RETENTION_DAYS']
+    if days is None:
+        raise click.UsageError('No --days given nor RAW_RETENTION_DAYS set.')
+
+    before = utcnow() - timedelta(days=days)
+    deleted = prune_raw_samples(before)
+    click.echo(f'Deleted {deleted} raw samples older than {before}.')
+
+
+def init_app(app):
+    app.cli.add_command(prune_samples_command)
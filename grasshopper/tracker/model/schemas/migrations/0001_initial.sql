@@ -1,15 +1,14 @@
-DROP TABLE IF EXISTS users;
-DROP TABLE IF EXISTS test_run;
-DROP TABLE IF EXISTS cpu_usage;
+-- IF NOT EXISTS so that databases created before migrations existed
+-- are adopted as version 1.
 
-CREATE TABLE user (
+CREATE TABLE IF NOT EXISTS user (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     username VARCHAR(255) NOT NULL UNIQUE,
     email VARCHAR(255) NOT NULL UNIQUE,
     password VARCHAR(255) NOT NULL
 );
 
-CREATE TABLE test_run (
+CREATE TABLE IF NOT EXISTS test_run (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id INTEGER NOT NULL,
 
@@ -22,7 +21,7 @@ CREATE TABLE test_run (
     FOREIGN KEY (user_id) REFERENCES users(id)
 );
 
-CREATE TABLE cpu_usage (
+CREATE TABLE IF NOT EXISTS cpu_usage (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     test_run_id INTEGER NOT NULL,
     time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
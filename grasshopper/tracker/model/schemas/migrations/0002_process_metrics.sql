@@ -0,0 +1,4 @@
+ALTER TABLE cpu_usage ADD COLUMN rss INTEGER;
+ALTER TABLE cpu_usage ADD COLUMN threads INTEGER;
+ALTER TABLE cpu_usage ADD COLUMN io_read INTEGER;
+ALTER TABLE cpu_usage ADD COLUMN io_write INTEGER;
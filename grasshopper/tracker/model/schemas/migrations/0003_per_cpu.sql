@@ -0,0 +1 @@
+ALTER TABLE cpu_usage ADD COLUMN per_cpu BLOB;
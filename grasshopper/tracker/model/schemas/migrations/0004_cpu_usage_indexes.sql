@@ -0,0 +1,6 @@
+-- Per run lookups must not scan the samples of every other run: one index
+-- for the time ordered series and a covering one for MAX(usage).
+CREATE INDEX cpu_usage_test_run_time ON cpu_usage (test_run_id, time);
+CREATE INDEX cpu_usage_test_run_usage ON cpu_usage (test_run_id, usage);
+
+CREATE INDEX test_run_user ON test_run (user_id);
@@ -0,0 +1,26 @@
+-- Rolling aggregates of each run, updated in the same transaction as the
+-- samples they summarise. Runs recorded before this migration get their
+-- row rebuilt from cpu_usage the first time their stats are read.
+CREATE TABLE test_run_stats (
+    test_run_id INTEGER PRIMARY KEY,
+
+    samples INTEGER NOT NULL DEFAULT 0,
+    usage_sum FLOAT NOT NULL DEFAULT 0,
+    usage_sum_sq FLOAT NOT NULL DEFAULT 0,
+    usage_min FLOAT,
+    usage_max FLOAT,
+    first_time TIMESTAMP,
+    last_time TIMESTAMP,
+    last_usage FLOAT,
+    time_above_threshold FLOAT NOT NULL DEFAULT 0,
+
+    per_cpu_samples INTEGER NOT NULL DEFAULT 0,
+    max_core INTEGER,
+    max_core_usage FLOAT,
+    core_imbalance_sum FLOAT NOT NULL DEFAULT 0,
+    last_per_cpu_time TIMESTAMP,
+    last_core_usage FLOAT,
+    time_any_core_above_threshold FLOAT NOT NULL DEFAULT 0,
+
+    FOREIGN KEY (test_run_id) REFERENCES test_run(id)
+);
@@ -0,0 +1,27 @@
+-- Usage of each run summarised in fixed time buckets of 10 seconds, 1 minute
+-- and 10 minutes, updated in the same transaction as the samples. Buckets
+-- start at multiples of their resolution since the epoch.
+CREATE TABLE usage_rollup (
+    test_run_id INTEGER NOT NULL,
+    resolution INTEGER NOT NULL,
+    bucket TIMESTAMP NOT NULL,
+
+    count INTEGER NOT NULL,
+    usage_min FLOAT NOT NULL,
+    usage_max FLOAT NOT NULL,
+    usage_sum FLOAT NOT NULL,
+
+    PRIMARY KEY (test_run_id, resolution, bucket),
+    FOREIGN KEY (test_run_id) REFERENCES test_run(id)
+) WITHOUT ROWID;
+
+INSERT INTO usage_rollup
+SELECT test_run_id,
+       tier.resolution,
+       datetime(CAST(strftime('%s', time) AS INTEGER)
+                / tier.resolution * tier.resolution, 'unixepoch'),
+       COUNT(*), MIN(usage), MAX(usage), SUM(usage)
+FROM cpu_usage,
+     (SELECT 10 AS resolution UNION ALL SELECT 60 UNION ALL SELECT 600)
+         AS tier
+GROUP BY 1, 2, 3;
@@ -0,0 +1,23 @@
+-- Samples of finished runs, moved out of cpu_usage into one row per run
+-- with a compressed blob per column: the times as int64 microsecond deltas,
+-- the usages as float32, the process metrics as int64 (NULL when no sample
+-- has them) and the per core usages as float32 along with their count.
+-- Raw samples up to last_id are in the row, whether deleted yet or not.
+CREATE TABLE cpu_usage_compact (
+    test_run_id INTEGER PRIMARY KEY,
+    samples INTEGER NOT NULL,
+    last_id INTEGER NOT NULL,
+    first_time TIMESTAMP NOT NULL,
+    last_time TIMESTAMP NOT NULL,
+
+    time BLOB NOT NULL,
+    usage BLOB NOT NULL,
+    rss BLOB,
+    threads BLOB,
+    io_read BLOB,
+    io_write BLOB,
+    per_cpu_counts BLOB,
+    per_cpu BLOB,
+
+    FOREIGN KEY (test_run_id) REFERENCES test_run(id)
+);
@@ -0,0 +1,6 @@
+-- The dashboard pages through the runs of a user by start time or by name,
+-- in either order, straight from these indexes. They supersede the index
+-- on user_id alone.
+CREATE INDEX test_run_user_start ON test_run (user_id, start_time);
+CREATE INDEX test_run_user_name ON test_run (user_id, name);
+DROP INDEX test_run_user;
@@ -0,0 +1,6 @@
+-- Usage of each run weighted by the time every sample holds until the next
+-- one, as samples are no longer evenly spaced when grasshopper only reports
+-- changes. Runs recorded before this migration keep reporting their mean,
+-- their samples being evenly spaced.
+ALTER TABLE test_run_stats ADD COLUMN usage_time_sum FLOAT NOT NULL DEFAULT 0;
+ALTER TABLE test_run_stats ADD COLUMN sampled_time FLOAT NOT NULL DEFAULT 0;
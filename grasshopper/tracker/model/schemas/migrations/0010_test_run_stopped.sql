@@ -0,0 +1,8 @@
+-- Runs that were stopped, in the shard of each run, so that samples taken
+-- by a tracker process still holding the run as active in its cache are
+-- refused by the transaction that would have stored them.
+CREATE TABLE test_run_stopped (
+    test_run_id INTEGER PRIMARY KEY,
+
+    FOREIGN KEY (test_run_id) REFERENCES test_run(id)
+);
@@ -0,0 +1,137 @@
+from dataclasses import dataclass, fields
+from datetime import datetime
+import math
+
+
+def above(usage, threshold):
+    return threshold is not None and usage > threshold
+
+
+@dataclass
+class RunningStats:
+    """
+    Aggregates of a run's samples that can be updated one sample at a time,
+    so that reading the stats of a run never has to touch its samples.
+
+    As in the original time series walk, the time between two consecutive
+    samples is above threshold when the earlier one is. Samples older than
+    the latest one seen are counted but not used for time above threshold.
+    The same holds for the time weighted mean, which unlike the mean does
+    not depend on how evenly the samples are spaced.
+    """
+    test_run_id: int
+    samples: int = 0
+    usage_sum: float = 0.0
+    usage_sum_sq: float = 0.0
+    usage_min: float = None
+    usage_max: float = None
+    first_time: datetime = None
+    last_time: datetime = None
+    last_usage: float = None
+    time_above_threshold: float = 0.0
+    usage_time_sum: float = 0.0
+    sampled_time: float = 0.0
+    per_cpu_samples: int = 0
+    max_core: int = None
+    max_core_usage: float = None
+    core_imbalance_sum: float = 0.0
+    last_per_cpu_time: datetime = None
+    last_core_usage: float = None
+    time_any_core_above_threshold: float = 0.0
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(**{field.name: row[field.name] for field in fields(cls)})
+
+    def as_row(self):
+        row = {field.name: getattr(self, field.name) for field in fields(self)}
+        return {name: value.isoformat(sep=' ')
+                if isinstance(value, datetime) else value
+                for name, value in row.items()}
+
+    def add(self, time, usage, per_cpu, threshold):
+        self.samples += 1
+        self.usage_sum += usage
+        self.usage_sum_sq += usage * usage
+        self.usage_min = usage if self.usage_min is None \
+            else min(self.usage_min, usage)
+        self.usage_max = usage if self.usage_max is None \
+            else max(self.usage_max, usage)
+        if self.first_time is None or time < self.first_time:
+            self.first_time = time
+
+        if self.last_time is None or time >= self.last_time:
+            if self.last_time is not None:
+                elapsed = (time - self.last_time).total_seconds()
+                self.usage_time_sum += self.last_usage * elapsed
+                self.sampled_time += elapsed
+                if above(self.last_usage, threshold):
+                    self.time_above_threshold += elapsed
+            self.last_time = time
+            self.last_usage = usage
+
+        if per_cpu:
+            self.add_per_cpu(time, per_cpu, threshold)
+
+    def add_per_cpu(self, time, per_cpu, threshold):
+        hottest = max(range(len(per_cpu)), key=per_cpu.__getitem__)
+        hottest_usage = per_cpu[hottest]
+
+        self.per_cpu_samples += 1
+        if self.max_core_usage is None or hottest_usage > self.max_core_usage:
+            self.max_core, self.max_core_usage = hottest, hottest_usage
+        self.core_imbalance_sum += hottest_usage - sum(per_cpu) / len(per_cpu)
+
+        if self.last_per_cpu_time is None or time >= self.last_per_cpu_time:
+            if self.last_per_cpu_time is not None and \
+                    above(self.last_core_usage, threshold):
+                self.time_any_core_above_threshold += \
+                    (time - self.last_per_cpu_time).total_seconds()
+            self.last_per_cpu_time = time
+            self.last_core_usage = hottest_usage
+
+    @property
+    def usage_mean(self):
+        if not self.samples:
+            return None
+        return self.usage_sum / self.samples
+
+    @property
+    def usage_time_weighted_mean(self):
+        # Runs of a single sample, and the ones recorded before it was
+        # kept, evenly spaced
+        if not self.sampled_time:
+            return self.usage_mean
+        return self.usage_time_sum / self.sampled_time
+
+    @property
+    def usage_stddev(self):
+        if not self.samples:
+            return None
+        variance = self.usage_sum_sq / self.samples - self.usage_mean ** 2
+        return math.sqrt(max(0.0, variance))
+
+    def summary(self):
+        return {
+            'measurements': self.samples,
+            'time_above_threshold': self.time_above_threshold,
+            'usage': {
+                'min': self.usage_min,
+                'max': self.usage_max,
+                'mean': self.usage_mean,
+                'time_weighted_mean': self.usage_time_weighted_mean,
+                'stddev': self.usage_stddev,
+            },
+            'per_cpu': self.per_cpu_summary(),
+        }
+
+    def per_cpu_summary(self):
+        if not self.per_cpu_samples:
+            return None
+        return {
+            'max_core': self.max_core,
+            'max_core_usage': self.max_core_usage,
+            'imbalance': self.core_imbalance_sum / self.per_cpu_samples,
+            'time_any_core_above_threshold':
+                self.time_any_core_above_threshold,
+        }
@@ -0,0 +1,147 @@
+from queue import Empty, Full, LifoQueue
+import os
+import sqlite3
+
+from flask import current_app, g
+
+
+class SQLiteStorage:
+    """
+    Everything in the single DATABASE file.
+
+    Storage backends are layouts of SQLite files, handing out sqlite3
+    connections: the main one, for the users, the runs and the stats of
+    finished runs, and the one of the shard holding the samples, rollups,
+    compacted samples and rolling stats of a run. Models get them through
+    get_db and get_shard_db, for the current app context, and query them
+    with SQLite's SQL.
+    """
+
+    # Replaced by the metrics with one timing the queries
+    connection_factory = sqlite3.Connection
+
+    def __init__(self, config):
+        self.config = config
+        self.path = config['DATABASE']
+
+    @property
+    def shards(self):
+        return 1
+
+    def shard_of(self, test_run_id):
+        return 0
+
+    def paths(self):
+        """
+        Return the path of every database file, the main one first.
+        """
+        return [self.path]
+
+    def connect(self, path, **kwargs):
+        db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES,
+                             factory=self.connection_factory, **kwargs)
+        db.row_factory = sqlite3.Row
+        configure_connection(db, self.config)
+        return db
+
+    def main(self):
+        if 'db' not in g:
+            g.db = self.connect(self.path)
+        return g.db
+
+    def shard(self, index):
+        return self.main()
+
+    def connections(self):
+        """
+        Return a connection to every database file of the app context, the
+        main one first, for maintenance such as migrations.
+        """
+        return [self.main()]
+
+    def teardown(self):
+        db = g.pop('db', None)
+        if db is not None:
+            db.close()
+
+
+class ShardedSQLiteStorage(SQLiteStorage):
+    """
+    Users and runs in the DATABASE file, and the samples and stats of
+    each run in one of STORAGE_SHARDS files next to it, picked by run id.
+    Each shard has its own write lock, so the samples of runs in
+    different shards are committed in parallel, by an ingest writer per
+    shard.
+
+    Shard connections are pooled, up to SHARD_POOL_SIZE idle ones per
+    shard, as the writers and request threads keep borrowing them.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        root, extension = os.path.splitext(self.path)
+        self.shard_paths = [f'{root}.shard{index}{extension}'
+                            for index in range(config['STORAGE_SHARDS'])]
+        self.pools = [LifoQueue(config['SHARD_POOL_SIZE'])
+                      for _ in self.shard_paths]
+
+    @property
+    def shards(self):
+        return len(self.shard_paths)
+
+    def shard_of(self, test_run_id):
+        return int(test_run_id) % self.shards
+
+    def paths(self):
+        return [self.path, *self.shard_paths]
+
+    def shard(self, index):
+        borrowed = g.setdefault('shard_dbs', {})
+        if index not in borrowed:
+            try:
+                borrowed[index] = self.pools[index].get_nowait()
+            except Empty:
+                # Pooled connections move between threads
+                borrowed[index] = self.connect(self.shard_paths[index],
+                                               check_same_thread=False)
+        return borrowed[index]
+
+    def connections(self):
+        return [self.main(), *map(self.shard, range(self.shards))]
+
+    def teardown(self):
+        super().teardown()
+        for index, db in g.pop('shard_dbs', {}).items():
+            if db.in_transaction:
+                db.rollback()
+            try:
+                self.pools[index].put_nowait(db)
+            except Full:
+                db.close()
+
+
+def configure_connection(db, config):
+    # WAL lets readers work alongside the ingest writers and, with
+    # synchronous=NORMAL, only syncs on checkpoints instead of on
+    # every commit.
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    db.execute(f'PRAGMA cache_size = -{int(config["DATABASE_CACHE_KB"])}')
+
+
+STORAGE_BACKENDS = {
+    'sqlite': SQLiteStorage,
+    'sharded-sqlite': ShardedSQLiteStorage,
+}
+
+
+def get_storage():
+    return current_app.extensions['grasshopper_storage']
+
+
+def init_app(app):
+    backend = app.config['STORAGE']
+    # Or a class taking the config, laying out SQLite files like the above
+    if isinstance(backend, str):
+        backend = STORAGE_BACKENDS[backend]
+    app.extensions['grasshopper_storage'] = backend(app.config)
@@ -1,19 +1,141 @@
-from dataclasses import dataclass
-from datetime import datetime
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from dataclasses import dataclass, replace
+from datetime import datetime, timedelta, timezone
+from itertools import islice
 from sqlite3 import IntegrityError
 from uuid import uuid4
+import json
+import logging
+import re
 
-from .db import get_db
+import numpy as np
+
+from .alerts import get_alert_engine
+from .analysis import compute_stats, stream_usage
+from .cache import get_cache
+from .columnar import (
+    MISSING, Columns, float32_list, iter_columns, load_compacted_row,
+    to_datetimes
+)
+from .db import get_db, get_shard_db, transaction
+from .encoding import pack_floats, unpack_floats
+from .live import get_live_broker
+from .rollup import fetch_buckets, pick_resolution, update_rollups
+from .stats import RunningStats
+
+
+logger = logging.getLogger(__name__)
+
+# Optional per sample metrics of the measured process tree
+PROCESS_METRICS = ('rss', 'threads', 'io_read', 'io_write')
+
+# Orderings of TestRun.find_summaries
+SUMMARY_SORTS = {
+    'start': 't.start_time',
+    'name': 't.name',
+    'duration': 'duration',
+    'max': 's.usage_max',
+    'mean': 'usage_mean',
+    'above': 's.time_above_threshold',
+}
 
 
 class TestRunAlreadyExistsError(Exception):
     pass
 
+
+class TestRunStopped(Exception):
+    pass
+
 def calculate_duration(start_time, end_time):
     """
     Take two timestamps and return the duration in seconds
     """
-    return (end_time - start_time).seconds / 1000
+    return (end_time - start_time).total_seconds()
+
+
+def utcnow():
+    """
+    Current time in the naive UTC used by sqlite's CURRENT_TIMESTAMP
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def parse_timestamp(value):
+    """
+    Normalise a client supplied timestamp, either an ISO 8601 string or
+    seconds since the epoch, into the naive UTC format used by sqlite.
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid timestamp {value!r}")
+    if isinstance(value, (int, float)):
+        timestamp = datetime.fromtimestamp(value, tz=timezone.utc)
+    else:
+        timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp.isoformat(sep=' ')
+
+
+def encode_cursor(key):
+    """
+    Opaque, URL safe form of a sample key from TestRun.iter_samples.
+    """
+    return urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        key = json.loads(urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    valid = isinstance(key, list) and (
+        len(key) == 3 and key[0] == 'raw' and isinstance(key[1], str)
+        and isinstance(key[2], int)
+        or len(key) == 2 and key[0] == 'compacted'
+        and isinstance(key[1], int))
+    if not valid:
+        raise ValueError('Invalid cursor')
+    return key
+
+
+def store_samples(shard, runs):
+    """
+    Store the samples of (test_run, samples) pairs, of runs of the given
+    shard, and update the stats of the runs, in one transaction of the
+    shard. Return the (test_run, update) to publish once committed.
+
+    The stats of a run live in its shard next to its samples, so that the
+    writers of different shards never wait on each other, and are copied
+    to the main database when the run finishes.
+    """
+    with transaction(shard):
+        timed = [(test_run, test_run.add_samples(samples))
+                 for test_run, samples in runs]
+        return [(test_run, test_run.update_stats(rows))
+                for test_run, rows in timed]
+
+
+def shard_summary(summary):
+    """
+    Return the stats of a find_summaries row, from the shard of its run.
+    """
+    row = get_shard_db(summary['id']).execute(
+        'SELECT * FROM test_run_stats WHERE test_run_id = ?',
+        (summary['id'],),
+    ).fetchone()
+    if row is None:
+        return {}
+    stats = RunningStats.from_row(row)
+    return {'samples': stats.samples,
+            'usage_max': stats.usage_max,
+            'usage_mean': stats.usage_mean,
+            'time_above_threshold': stats.time_above_threshold,
+            'breached': stats.usage_max is not None
+            and stats.usage_max > summary['threshold']}
+
 
 @dataclass
 class TestRun:
@@ -45,9 +167,31 @@ class TestRun:
                        end_time=testrun['end_time'])
 
     @staticmethod
-    def create(user_id, name, description, threshold):
+    def find_cached(testrun_id):
+        """
+        Like find_by_id, but served from the app wide testrun cache so that
+        the ingestion of samples does not have to query the run each time.
+        The returned run is a copy, free to be changed by the caller.
+        """
+        try:
+            testrun_id = int(testrun_id)
+        except (TypeError, ValueError):
+            return None
+
+        cache = get_cache('testrun')
+        test_run = cache.get(testrun_id)
+        if test_run is None:
+            test_run = TestRun.find_by_id(testrun_id)
+            if test_run is None:
+                return None
+            cache.set(testrun_id, test_run)
+        return replace(test_run)
+
+    @staticmethod
+    def create(user_id, name, description, threshold, start_time=None):
         """
-        Create a new testrun.
+        Create a new testrun, started now unless start_time, as given by
+        parse_timestamp, says otherwise.
         Raise an error if the testrun already exists
         """
         try:
@@ -55,17 +199,86 @@ class TestRun:
             db.execute(
                 '''
                 INSERT INTO
-                    test_run (user_id, name, description, threshold)
-                VALUES (?, ?, ?, ?);
+                    test_run (user_id, name, description, threshold,
+                              start_time)
+                VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP));
                 ''',
-                (user_id, name, description, threshold),
+                (user_id, name, description, threshold, start_time),
             ).fetchone()
             id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
-            start_time = db.execute('SELECT start_time FROM test_run WHERE id = ?', (id,)).fetchone()[0]
+            db.execute('INSERT INTO test_run_stats (test_run_id) VALUES (?)',
+                       (id,))
             db.commit()
         except IntegrityError as e:
             raise TestRunAlreadyExistsError(e)
-        return {'id': id, 'start_time': start_time}
+        # New runs are about to receive samples, cache them upfront
+        test_run = TestRun.find_by_id(id)
+        get_cache('testrun').set(id, test_run)
+        return {'id': id, 'start_time': test_run.start_time}
+
+    @staticmethod
+    def find_summaries(user_id, name=None, since=None, until=None,
+                       breached=None, sort='start', descending=True,
+                       page=1, per_page=50):
+        """
+        Return a page of the runs of a user, with their stats, and whether
+        there are more. Runs can be filtered by a name substring, a start
+        time range (naive UTC datetimes) and whether they went above their
+        threshold, and sorted by any of SUMMARY_SORTS. Everything is done
+        by one query over the runs and their test_run_stats rows, so that
+        listing does not depend on the number or length of the runs.
+
+        The main database only gets the stats of a run from its shard when
+        it finishes, so active runs of a sharded storage are filtered and
+        sorted by the stats they started with, and shown with the ones of
+        their shard.
+        """
+        conditions = ['t.user_id = :user_id']
+        if name:
+            conditions.append(r"t.name LIKE :name ESCAPE '\'")
+            name = '%' + re.sub(r'([\\%_])', r'\\\1', name) + '%'
+        if since is not None:
+            conditions.append('t.start_time >= :since')
+        if until is not None:
+            conditions.append('t.start_time < :until')
+        if breached is not None:
+            conditions.append(
+                f"{'' if breached else 'NOT '}"
+                'COALESCE(s.usage_max > t.threshold, 0)')
+        order = 'DESC' if descending else 'ASC'
+
+        rows = get_db().execute(
+            f'''
+            SELECT t.id, t.name, t.description, t.threshold,
+                   t.start_time, t.end_time,
+                   (julianday(COALESCE(t.end_time, :now))
+                    - julianday(t.start_time)) * 86400 AS duration,
+                   s.samples, s.usage_max,
+                   s.usage_sum / NULLIF(s.samples, 0) AS usage_mean,
+                   s.time_above_threshold,
+                   COALESCE(s.usage_max > t.threshold, 0) AS breached
+            FROM test_run t
+            LEFT JOIN test_run_stats s ON s.test_run_id = t.id
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {SUMMARY_SORTS[sort]} {order}, t.id {order}
+            LIMIT :limit OFFSET :offset
+            ''',
+            {'user_id': user_id,
+             'name': name,
+             'since': since and since.isoformat(sep=' '),
+             'until': until and until.isoformat(sep=' '),
+             'now': utcnow().isoformat(sep=' '),
+             'limit': per_page + 1,
+             'offset': (page - 1) * per_page},
+        ).fetchall()
+        summaries = [dict(row, active=row['end_time'] is None,
+                          breached=bool(row['breached']))
+                     for row in rows[:per_page]]
+        for summary in summaries:
+            if summary['active'] and get_shard_db(summary['id']) \
+                    is not get_db():
+                summary.update(shard_summary(summary))
+        return summaries, len(rows) > per_page
 
     @property
     def is_active(self):
@@ -84,45 +297,282 @@ class TestRun:
     @property
     def duration(self):
         if self.end_time is None:
-            ended_at = datetime.now()
+            ended_at = utcnow()
         else:
             ended_at = self.ended_at
-        return calculate_duration(self.started_at, self.ended_at)
+        return calculate_duration(self.started_at, ended_at)
+
+    def finish(self, compact=True, end_time=None):
+        """
+        End the run, now unless given the datetime it ended at, and unless
+        told otherwise, compact its samples. The run takes no samples from
+        then on, and its stats are copied from its shard to the main
+        database, for find_summaries.
+        """
+        shard = get_shard_db(self.id)
+        with transaction(shard):
+            shard.execute(
+                'INSERT OR IGNORE INTO test_run_stopped (test_run_id) '
+                'VALUES (?)', (self.id,))
+            stats = self.fetch_stats()
 
-    def finish(self):
         db = get_db()
-        self.end_time = datetime.now().isoformat()
+        self.end_time = end_time or utcnow()
         db.execute(
             "UPDATE test_run SET end_time = ? WHERE id = ?",
-            (self.end_time, self.id),
+            (self.end_time.isoformat(sep=' '), self.id),
         )
+        if shard is not db:
+            self.store_stats(stats, db)
         db.commit()
+        get_cache('testrun').invalidate(self.id)
+        broker = get_live_broker()
+        if broker is not None:
+            broker.finish(self.id)
+        if get_alert_engine() is not None:
+            get_alert_engine().finish(self.id)
+        if compact:
+            self.compact()
 
-    def record_cpu_usage(self, cpu_usage):
-        db = get_db()
-        db.execute(
+    def compact(self, chunk_size=65536):
+        """
+        Move the raw samples of the run into its cpu_usage_compact row,
+        merged with the ones compacted before, if any, and return how many
+        were moved. Readers switch to the row as soon as it is written,
+        the raw rows are then deleted a chunk at a time so that the
+        ingestion of other runs is not held up meanwhile. Of overlapping
+        compactions of the run, only the first to write the row does.
+        """
+        db = get_shard_db(self.id)
+        previous = self.load_compacted()
+        after = previous.last_id if previous is not None else 0
+        last_id = db.execute(
+            'SELECT MAX(id) FROM cpu_usage WHERE test_run_id = ?', (self.id,)
+        ).fetchone()[0]
+        if last_id is None:
+            return 0
+
+        cursor = db.cursor()
+        cursor.row_factory = None
+        cursor.execute(
+            f'''
+            SELECT CAST(time AS TEXT), usage, {', '.join(PROCESS_METRICS)},
+                   per_cpu
+            FROM cpu_usage
+            WHERE test_run_id = ? AND id > ? AND id <= ?
+            ORDER BY time, id
+            ''', (self.id, after, last_id))
+        parts = []
+        while rows := cursor.fetchmany(chunk_size):
+            parts.append(Columns.from_rows(rows, PROCESS_METRICS))
+        compacted = sum(len(part) for part in parts)
+
+        if parts:
+            if previous is not None:
+                parts.insert(0, previous)
+            columns = Columns.concatenate(parts)
+            columns.last_id = last_id
+            with transaction(db):
+                # A compaction running alongside, as a repeated stop, may
+                # have replaced the row and deleted some of the samples
+                # read here meanwhile. Its row is the complete one.
+                current = db.execute(
+                    'SELECT last_id FROM cpu_usage_compact '
+                    'WHERE test_run_id = ?', (self.id,)).fetchone()
+                if (current['last_id'] if current is not None else 0) \
+                        != after:
+                    return 0
+                columns.store(db, self.id)
+
+        while db.execute(
+                '''
+                DELETE FROM cpu_usage WHERE id IN (
+                    SELECT id FROM cpu_usage
+                    WHERE test_run_id = ? AND id <= ?
+                    LIMIT ?)
+                ''', (self.id, last_id, chunk_size)).rowcount:
+            db.commit()
+        db.commit()
+        return compacted
+
+    def load_compacted(self):
+        return Columns.load(get_shard_db(self.id), self.id, PROCESS_METRICS)
+
+    def record_cpu_usage(self, cpu_usage, timestamp=None):
+        self.record_cpu_usage_batch([{'usage': cpu_usage,
+                                      'timestamp': timestamp}])
+
+    def record_cpu_usage_batch(self, samples):
+        """
+        Store a list of samples, and update the run's stats with them, in
+        a single transaction. Each sample is a dict with a usage, an
+        optional timestamp, the optional PROCESS_METRICS and an optional
+        per_cpu list of per core usages. Samples without a timestamp get
+        the current time.
+        """
+        [(_, update)] = store_samples(get_shard_db(self.id),
+                                      [(self, samples)])
+        self.publish(update)
+        return len(samples)
+
+    def add_samples(self, samples):
+        """
+        Write samples of the run to its shard, for store_samples, in the
+        transaction open on it. Return them as (datetime, row) pairs, oldest
+        first, for update_stats. Raise TestRunStopped if the run was
+        stopped, which tracker processes caching the run as active for
+        TESTRUN_CACHE_TTL seconds only learn here.
+        """
+        now = utcnow().isoformat(sep=' ')
+        rows = [self.usage_row(sample, now) for sample in samples]
+
+        db = get_shard_db(self.id)
+        if db.execute('SELECT 1 FROM test_run_stopped WHERE test_run_id = ?',
+                      (self.id,)).fetchone() is not None:
+            raise TestRunStopped(f'Testrun {self.id} is stopped')
+        # Runs without stats get them rebuilt from the samples stored so
+        # far, that is before these are
+        self.fetch_stats()
+        db.executemany(
             '''
             INSERT INTO
-                cpu_usage (test_run_id, usage)
-            VALUES (?, ?)
+                cpu_usage (test_run_id, usage, time,
+                           rss, threads, io_read, io_write, per_cpu)
+            VALUES (:test_run_id, :usage, :timestamp,
+                    :rss, :threads, :io_read, :io_write, :per_cpu)
             ''',
-            (self.id, cpu_usage),
+            rows,
+        )
+
+        timed = sorted(((datetime.fromisoformat(row['timestamp']), row)
+                        for row in rows), key=lambda pair: pair[0])
+        update_rollups(db, self.id,
+                       [(time, row['usage']) for time, row in timed])
+        return timed
+
+    def update_stats(self, timed):
+        """
+        Add samples written by add_samples to the stats of the run, in the
+        same transaction of its shard. Return the update of the live
+        subscribers and of the alert rules of the run, to publish once
+        committed.
+        """
+        # Per core usages go through float32 as when read back, so
+        # rebuilding the stats from the samples gives the same result.
+        for time, row in timed:
+            row['per_cpu'] = unpack_floats(row['per_cpu']) \
+                if row['per_cpu'] else None
+        stats = self.fetch_stats()
+        for time, row in timed:
+            stats.add(time, row['usage'], row['per_cpu'], self.threshold)
+        self.store_stats(stats)
+        return self.live_update(timed, stats), self.alert_update(timed)
+
+    def live_update(self, timed, stats):
+        broker = get_live_broker()
+        if broker is None or not broker.subscribers(self.id):
+            return None
+        samples = [dict({'time': time.isoformat(), 'usage': row['usage']},
+                        **{name: row[name] for name in PROCESS_METRICS},
+                        per_cpu=row['per_cpu'] and
+                        float32_list(row['per_cpu']))
+                   for time, row in timed]
+        return samples, self.live_stats(stats)
+
+    def alert_update(self, timed):
+        if get_alert_engine() is None:
+            return None
+        return [(time, row['usage']) for time, row in timed]
+
+    def live_stats(self, stats=None):
+        """
+        Aggregates sent to the live subscribers: the summary of the stats
+        and the latest sample.
+        """
+        stats = stats or self.fetch_stats()
+        return dict(stats.summary(),
+                    last_time=stats.last_time and stats.last_time.isoformat(),
+                    last_usage=stats.last_usage)
+
+    def publish(self, update):
+        """
+        Hand an update from add_samples over to the live subscribers and
+        the alert rules.
+        """
+        live, alerts = update
+        if live is not None:
+            get_live_broker().publish(self.id, *live)
+        if alerts is not None:
+            get_alert_engine().evaluate(self, alerts)
+
+    def usage_row(self, sample, now):
+        row = dict.fromkeys(PROCESS_METRICS)
+        row.update(sample, test_run_id=self.id)
+        if row.get('timestamp') is None:
+            row['timestamp'] = now
+        per_cpu = sample.get('per_cpu')
+        # Binary uploads carry them packed already
+        if per_cpu and not isinstance(per_cpu, (bytes, memoryview)):
+            per_cpu = pack_floats(per_cpu)
+        row['per_cpu'] = per_cpu or None
+        return row
+
+    def fetch_stats(self):
+        """
+        Return the run's RunningStats, from its shard, rebuilding them from
+        its samples for runs recorded before they were kept there.
+        """
+        db = get_shard_db(self.id)
+        row = db.execute(
+            'SELECT * FROM test_run_stats WHERE test_run_id = ?', (self.id,)
+        ).fetchone()
+        if row is not None:
+            return RunningStats.from_row(row)
+
+        stats = RunningStats(self.id)
+        for entry in self.fetch_current_cpu_usage():
+            stats.add(entry.timestamp, entry.usage, entry.per_cpu,
+                      self.threshold)
+
+        in_transaction = db.in_transaction
+        self.store_stats(stats)
+        if not in_transaction:
+            db.commit()
+        return stats
+
+    def store_stats(self, stats, db=None):
+        """
+        Write the stats of the run to its shard, or to db.
+        """
+        db = db or get_shard_db(self.id)
+        row = stats.as_row()
+        db.execute(
+            f'''
+            INSERT OR REPLACE INTO
+                test_run_stats ({', '.join(row)})
+            VALUES ({', '.join(f':{name}' for name in row)})
+            ''',
+            row,
         )
-        db.commit()
 
     def has_passed_threshold(self):
-        db = get_db()
-        cpu_usage = db.execute(
-            '''
-            SELECT MAX(usage) as max_usage FROM
-                cpu_usage
-            WHERE test_run_id = ?
-            GROUP BY test_run_id
-            ''', (self.id,)).fetchone()['max_usage']
-        return cpu_usage > self.threshold
+        cpu_usage = self.fetch_stats().usage_max
+        return cpu_usage is not None and cpu_usage > self.threshold
 
     def fetch_current_cpu_usage(self):
-        db = get_db()
+        compacted = self.load_compacted()
+        if compacted is not None:
+            return [CPUUsage(id=None,
+                             testrun_id=self.id,
+                             usage=usage,
+                             timestamp=timestamp,
+                             per_cpu=per_cpu)
+                    for timestamp, usage, per_cpu in zip(
+                        to_datetimes(compacted.times),
+                        compacted.usages.tolist(),
+                        compacted.per_cpu())]
+
+        db = get_shard_db(self.id)
         usage_time_series = []
 
         for entry in db.execute(
@@ -130,29 +580,158 @@ class TestRun:
                 SELECT * FROM
                     cpu_usage
                 WHERE test_run_id = ?
-                ORDER BY time DESC
+                ORDER BY time, id
                 ''', (self.id,)).fetchall():
-            usage_time_series.append(CPUUsage(id=entry['id'],
-                                              testrun_id=entry['test_run_id'],
-                                              usage=entry['usage'],
-                                              timestamp=entry['time']))
+            per_cpu = entry['per_cpu']
+            usage_time_series.append(CPUUsage(
+                id=entry['id'],
+                testrun_id=entry['test_run_id'],
+                usage=entry['usage'],
+                timestamp=entry['time'],
+                per_cpu=unpack_floats(per_cpu) if per_cpu else None))
         return usage_time_series
 
+    def iter_samples(self, start=None, end=None, after=None,
+                     chunk_size=10000):
+        """
+        Return an iterator over the raw samples of the run from start to
+        end, both optional, oldest first, as (key, sample) pairs where the
+        key, once encoded with encode_cursor, can be passed as after to
+        resume past that sample. Samples are read lazily, from the
+        database cursor or a chunk of compacted columns at a time, so that
+        going through a run takes the same memory whatever its length.
+        Raise a ValueError if after is not a valid cursor.
+        """
+        key = decode_cursor(after) if after is not None else None
+        row = load_compacted_row(get_shard_db(self.id), self.id)
+        if row is not None:
+            skip = 0
+            if key is not None and key[0] == 'compacted':
+                skip = key[1] + 1
+            elif key is not None:
+                # Cursor from before the run was compacted
+                after = datetime.fromisoformat(key[1]) \
+                    + timedelta(microseconds=1)
+                start = max(start, after) if start is not None else after
+            return self.iter_compacted_samples(row, start, end, skip,
+                                               chunk_size)
+        if key is not None and key[0] != 'raw':
+            raise ValueError('Invalid cursor')
+        return self.iter_raw_samples(start, end, key)
+
+    def iter_raw_samples(self, start, end, key):
+        conditions = ['test_run_id = :test_run_id']
+        if start is not None:
+            conditions.append('time >= :start')
+        if end is not None:
+            conditions.append('time < :end')
+        if key is not None:
+            conditions.append('(time, id) > (:after_time, :after_id)')
+
+        cursor = get_shard_db(self.id).cursor()
+        cursor.row_factory = None
+        cursor.execute(
+            f'''
+            SELECT id, CAST(time AS TEXT), usage,
+                   {', '.join(PROCESS_METRICS)}, per_cpu
+            FROM cpu_usage
+            WHERE {' AND '.join(conditions)}
+            ORDER BY time, id
+            ''',
+            {'test_run_id': self.id,
+             'start': start and start.isoformat(sep=' '),
+             'end': end and end.isoformat(sep=' '),
+             'after_time': key and key[1],
+             'after_id': key and key[2]},
+        )
+        while rows := cursor.fetchmany(1000):
+            # Per core usages of the whole batch decoded at once
+            per_cpu = iter(float32_list(np.frombuffer(
+                b''.join(row[-1] for row in rows if row[-1]), '<f4')))
+            for id, time, usage, *metrics, blob in rows:
+                sample = {'time': time.replace(' ', 'T'), 'usage': usage}
+                sample.update(zip(PROCESS_METRICS, metrics))
+                sample['per_cpu'] = list(islice(per_cpu, len(blob) // 4)) \
+                    if blob else None
+                yield ('raw', time, id), sample
+
+    def iter_compacted_samples(self, row, start, end, skip, chunk_size):
+        index = 0
+        for columns in iter_columns(row, PROCESS_METRICS, True, chunk_size):
+            low, high = columns.between(start, end)
+            low = min(max(low, skip - index), high)
+            offsets = columns.per_cpu_offsets()[low:high + 1].tolist()
+            per_cpu = float32_list(
+                columns.per_cpu_values[offsets[0]:offsets[-1]])
+            metrics = [[None if value == MISSING else value
+                        for value in columns.metrics[name][low:high]
+                        .tolist()]
+                       for name in PROCESS_METRICS]
+            for i, (time, usage, *values) in enumerate(zip(
+                    to_datetimes(columns.times[low:high]),
+                    float32_list(columns.usages[low:high]), *metrics)):
+                sample = {'time': time.isoformat(), 'usage': usage}
+                sample.update(zip(PROCESS_METRICS, values))
+                first, last = offsets[i] - offsets[0], \
+                    offsets[i + 1] - offsets[0]
+                sample['per_cpu'] = per_cpu[first:last] \
+                    if last > first else None
+                yield ('compacted', index + low + i), sample
+            if high < len(columns):
+                return
+            index += len(columns)
+
+    def fetch_samples(self, limit, start=None, end=None, after=None):
+        """
+        Return a page of at most limit raw samples of the run, see
+        iter_samples, and the cursor of the next page, None if last.
+        """
+        page = list(islice(self.iter_samples(start, end, after), limit + 1))
+        next_page = encode_cursor(page[limit - 1][0]) \
+            if len(page) > limit else None
+        return [sample for _, sample in page[:limit]], next_page
+
+    def fetch_usage(self, resolution, start=None, end=None):
+        """
+        Return the usage of the run between start and end, both optional,
+        in buckets of resolution seconds with their count, min, max and
+        mean, read from the cheapest rollup tier that has them.
+        """
+        return list(fetch_buckets(get_shard_db(self.id), self.id,
+                                  resolution, start, end))
+
+    def auto_resolution(self, start=None, end=None, max_points=2000):
+        """
+        Finest resolution, None for raw samples, that gives at most about
+        max_points points between start and end.
+        """
+        stats = self.fetch_stats()
+        if not stats.samples:
+            return None
+        start = max(start or stats.first_time, stats.first_time)
+        end = min(end or stats.last_time, stats.last_time)
+        span = (end - start).total_seconds()
+        run_span = (stats.last_time - stats.first_time).total_seconds()
+        samples = stats.samples * span / run_span if run_span \
+            else stats.samples
+        return pick_resolution(span, samples, max_points)
+
     def get_test_execution_stats(self):
-        time_series = self.fetch_current_cpu_usage()
-        total_time = 0
-        if not time_series:
-            raise ValueError("No CPU usage data found")
-
-        for periods in zip(time_series, time_series[1:]):
-            period_duration = calculate_duration(periods[0].timestamp, periods[1].timestamp)
-            if periods[0].usage > self.threshold:
-                total_time += period_duration
-        return {
-            'measurements': len(time_series),
-            'time_above_threshold': total_time,
-            'total_time': self.duration,
-        }
+        return dict(self.fetch_stats().summary(), total_time=self.duration)
+
+    def recompute_stats(self, threshold=None, chunk_size=65536):
+        """
+        Compute the stats of the run from its raw samples, optionally for a
+        different threshold, streaming them in chunks so that memory use
+        does not depend on the length of the run. Return None if the run
+        has no samples.
+        """
+        if threshold is None:
+            threshold = self.threshold
+        stats = self.fetch_stats()
+        return compute_stats(
+            stream_usage(get_shard_db(self.id), self.id, chunk_size),
+            threshold, stats.usage_min, stats.usage_max)
 
 
 @dataclass
@@ -161,3 +740,4 @@ class CPUUsage:
     testrun_id: int
     timestamp: str
     usage: float
+    per_cpu: list = None
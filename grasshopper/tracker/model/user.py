@@ -3,6 +3,7 @@ from werkzeug.security import check_password_hash, generate_password_hash
 from uuid import uuid4
 from sqlite3 import IntegrityError
 
+from grasshopper.tracker.model.cache import get_cache
 from grasshopper.tracker.model.db import get_db
 
 
@@ -20,6 +21,11 @@ class User:
     @staticmethod
     def find_by_id(user_id):
         """ Retrieve a user by id """
+        cache = get_cache('user')
+        user = cache.get(('id', user_id))
+        if user is not None:
+            return user
+
         db = get_db()
 
         user = db.execute(
@@ -27,14 +33,16 @@ class User:
         ).fetchone()
         if user is None:
             return None
-        return User(id=user['id'],
-                    username=user['username'],
-                    password=user['password'],
-                    email=user['email'])
+        return User.cached(user)
 
     @staticmethod
     def find_by_username(username):
         """ Retrieve a user by username """
+        cache = get_cache('user')
+        user = cache.get(('username', username))
+        if user is not None:
+            return user
+
         db = get_db()
 
         user = db.execute(
@@ -42,10 +50,31 @@ class User:
         ).fetchone()
         if user is None:
             return None
-        return User(id=user['id'],
-                    username=user['username'],
-                    password=user['password'],
-                    email=user['email'])
+        return User.cached(user)
+
+    @staticmethod
+    def cached(row):
+        """
+        Build a user from its row and cache it under both of its
+        identities. Misses are not cached, so new users show up at once.
+        """
+        user = User(id=row['id'],
+                    username=row['username'],
+                    password=row['password'],
+                    email=row['email'])
+        cache = get_cache('user')
+        cache.set(('id', user.id), user)
+        cache.set(('username', user.username), user)
+        return user
+
+    @staticmethod
+    def invalidate(user_id=None, username=None):
+        """
+        Forget the cached copies of a user. To be called whenever a user
+        row is written.
+        """
+        get_cache('user').invalidate(('id', user_id),
+                                     ('username', username))
 
     @staticmethod
     def create(username, email, password):
@@ -67,6 +96,7 @@ class User:
             db.commit()
         except IntegrityError as e:
             raise UserAlreadyExistsError(e)
+        User.invalidate(username=username)
 
     def check_password(self, password):
         return check_password_hash(self.password, password)
@@ -0,0 +1,156 @@
+import asyncio
+from collections import deque
+import json as jsonlib
+import ssl
+from urllib.parse import urlsplit
+
+
+class Response:
+    """
+    The subset of requests.Response used by the tracker clients.
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return jsonlib.loads(self.content)
+
+
+class AsyncHTTPTransport:
+    """
+    Minimal HTTP/1.1 client over asyncio streams. Keeps up to pool_size
+    keep-alive connections to a single server and sends default headers
+    with every request.
+    """
+
+    def __init__(self, base_url, headers=None, pool_size=10, timeout=5.0):
+        url = urlsplit(base_url)
+        if url.scheme not in ('http', 'https'):
+            raise ValueError(f'Unsupported scheme {url.scheme!r}')
+
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.ssl = ssl.create_default_context() \
+            if url.scheme == 'https' else None
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        self.headers = {'Host': url.netloc, 'Connection': 'keep-alive'}
+        self.headers.update(headers or {})
+
+        self.idle = deque()
+        self.slots = asyncio.Semaphore(pool_size)
+
+    async def request(self, method, path, json=None, data=None,
+                      headers=None, timeout=None):
+        async with self.slots:
+            return await asyncio.wait_for(
+                self.send(method, path, json, data, headers),
+                timeout=self.timeout if timeout is None else timeout
+            )
+
+    async def get(self, path, **kwargs):
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request('POST', path, **kwargs)
+
+    async def head(self, path, **kwargs):
+        return await self.request('HEAD', path, **kwargs)
+
+    async def send(self, method, path, json, data=None, extra_headers=None):
+        body = data or b''
+        headers = dict(self.headers)
+        if json is not None:
+            body = jsonlib.dumps(json).encode()
+            headers['Content-Type'] = 'application/json'
+        headers.update(extra_headers or {})
+        headers['Content-Length'] = str(len(body))
+
+        head = f'{method} {self.prefix}{path} HTTP/1.1\r\n'
+        head += ''.join(f'{k}: {v}\r\n' for k, v in headers.items())
+        payload = head.encode('latin-1') + b'\r\n' + body
+
+        while True:
+            reused = bool(self.idle)
+            reader, writer = self.idle.pop() if reused \
+                else await self.connect()
+            try:
+                writer.write(payload)
+                await writer.drain()
+                response, keep_alive = await self.read_response(reader,
+                                                                method)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                # The server may close an idle keep-alive connection at
+                # any time; retry those once on a fresh connection.
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+
+            if keep_alive:
+                self.idle.append((reader, writer))
+            else:
+                writer.close()
+            return response
+
+    async def connect(self):
+        return await asyncio.open_connection(self.host, self.port,
+                                             ssl=self.ssl)
+
+    async def read_response(self, reader, method):
+        while True:
+            status_line = await reader.readuntil(b'\r\n')
+            version, status, _ = status_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readuntil(b'\r\n')
+                if line == b'\r\n':
+                    break
+                name, value = line.decode('latin-1').split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            if not 100 <= int(status) < 200:
+                break
+
+        status = int(status)
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' and \
+            (version == 'HTTP/1.1' or connection == 'keep-alive')
+
+        if method == 'HEAD' or status in (204, 304):
+            content = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = await self.read_chunked(reader)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content = await reader.read()
+            keep_alive = False
+
+        return Response(status, headers, content), keep_alive
+
+    async def read_chunked(self, reader):
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            if size == 0:
+                # Skip the trailers up to the final empty line
+                while await reader.readuntil(b'\r\n') != b'\r\n':
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    async def close(self):
+        while self.idle:
+            _, writer = self.idle.pop()
+            writer.close()
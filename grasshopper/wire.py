@@ -0,0 +1,165 @@
+"""
+Compact encoding of sample batches, sent to the tracker with the
+CONTENT_TYPE content type instead of JSON, optionally gzipped.
+
+A batch is a HEADER followed by columns of count values each, all
+little-endian:
+
+    uint32   milliseconds since the base timestamp
+    float32  usage
+    int64    rss, threads, io_read and io_write, MISSING when unknown,
+             only with the METRICS flag
+    float32  cores usages per sample, only with the PER_CPU flag
+
+The per core usages of a sample are stored by the tracker as they come.
+"""
+from array import array
+import gzip
+import math
+import struct
+import sys
+import zlib
+
+CONTENT_TYPE = 'application/vnd.grasshopper.samples'
+MAGIC = b'GHB1'
+# magic, flags, number of cores, base timestamp, number of samples
+HEADER = struct.Struct('<4sHHdI')
+METRICS = 1
+PER_CPU = 2
+MISSING = -1
+PROCESS_METRICS = ('rss', 'threads', 'io_read', 'io_write')
+MAX_DELTA_MS = 2 ** 32 - 1
+
+
+class WireFormatError(ValueError):
+    pass
+
+
+class BatchTooLarge(WireFormatError):
+    pass
+
+
+def pack(typecode, values):
+    packed = array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def encode_batch(samples, compress=False):
+    """
+    Encode (sample, timestamp) pairs, timestamps in seconds since the
+    epoch. Return None if they do not fit the format, when their per core
+    usages are not all of the same length or they span more than 49 days,
+    to send them as JSON instead.
+    """
+    if not samples:
+        return None
+    cores = {len(sample.per_cpu or ()) for sample, _ in samples}
+    if len(cores) > 1:
+        return None
+    cores = cores.pop()
+    base = min(timestamp for _, timestamp in samples)
+    deltas = [round((timestamp - base) * 1000) for _, timestamp in samples]
+    if max(deltas) > MAX_DELTA_MS:
+        return None
+
+    flags = PER_CPU if cores else 0
+    if any(getattr(sample, metric) is not None
+           for sample, _ in samples for metric in PROCESS_METRICS):
+        flags |= METRICS
+    parts = [HEADER.pack(MAGIC, flags, cores, base, len(samples)),
+             pack('I', deltas),
+             pack('f', [sample.usage for sample, _ in samples])]
+    if flags & METRICS:
+        parts += [pack('q', [MISSING if getattr(sample, metric) is None
+                             else getattr(sample, metric)
+                             for sample, _ in samples])
+                  for metric in PROCESS_METRICS]
+    if flags & PER_CPU:
+        parts.append(pack('f', [usage for sample, _ in samples
+                                for usage in sample.per_cpu]))
+    body = b''.join(parts)
+    return gzip.compress(body, compresslevel=1) if compress else body
+
+
+def batch_size(header):
+    """
+    Return the size in bytes of the batch starting with header.
+    """
+    _, flags, cores, _, count = HEADER.unpack_from(header)
+    size = HEADER.size + count * 8
+    if flags & METRICS:
+        size += count * 8 * len(PROCESS_METRICS)
+    if flags & PER_CPU:
+        size += count * cores * 4
+    return size
+
+
+def decompress(body, max_samples):
+    """
+    Inflate a gzipped batch, refusing to inflate more than a batch of
+    max_samples can hold.
+    """
+    inflater = zlib.decompressobj(wbits=31)
+    try:
+        header = inflater.decompress(body, HEADER.size)
+        check_header(header, max_samples)
+        expected = batch_size(header)
+        rest = inflater.decompress(inflater.unconsumed_tail,
+                                   expected - HEADER.size + 1)
+    except zlib.error:
+        raise WireFormatError('Invalid gzip body')
+    return header + rest
+
+
+def check_header(body, max_samples=None):
+    if len(body) < HEADER.size:
+        raise WireFormatError('Truncated batch')
+    magic, flags, cores, base, count = HEADER.unpack_from(body)
+    if magic != MAGIC:
+        raise WireFormatError('Not a sample batch')
+    if not math.isfinite(base) or (flags & PER_CPU and not cores):
+        raise WireFormatError('Invalid batch header')
+    if max_samples is not None and count > max_samples:
+        raise BatchTooLarge(f'{count} samples in batch')
+
+
+def column(view, typecode, count, offset):
+    """
+    Return the count values of typecode at offset of a memoryview, as a
+    view of it on little-endian machines, and the offset after them.
+    """
+    end = offset + array(typecode).itemsize * count
+    values = view[offset:end]
+    if sys.byteorder == 'big':
+        values = array(typecode, values.tobytes())
+        values.byteswap()
+        return values, end
+    return values.cast(typecode), end
+
+
+def decode_batch(body, max_samples=None):
+    """
+    Return the columns of a batch: its base timestamp, the deltas, usages,
+    process metrics by name (None without the METRICS flag) and the per
+    core usages of every sample one after the other (None without the
+    PER_CPU flag), without copying them on little-endian machines.
+    """
+    check_header(body, max_samples)
+    _, flags, cores, base, count = HEADER.unpack_from(body)
+    if len(body) != batch_size(body):
+        raise WireFormatError('Batch size does not match its header')
+
+    view = memoryview(body)
+    deltas, offset = column(view, 'I', count, HEADER.size)
+    usages, offset = column(view, 'f', count, offset)
+    metrics = None
+    if flags & METRICS:
+        metrics = {}
+        for metric in PROCESS_METRICS:
+            metrics[metric], offset = column(view, 'q', count, offset)
+    per_cpu = None
+    if flags & PER_CPU:
+        per_cpu, offset = column(view, 'f', count * cores, offset)
+    return base, deltas, usages, metrics, per_cpu
@@ -0,0 +1,62 @@
+import pytest
+
+from grasshopper.bench.common import serve
+from grasshopper.tracker import create_app
+from grasshopper.tracker.model.db import init_db
+from grasshopper.tracker.model.user import User
+
+
+@pytest.fixture
+def config():
+    """
+    Settings of the app, overridden by the tests that need some.
+    """
+    return {}
+
+
+@pytest.fixture(params=['sqlite', 'sharded-sqlite'])
+def app(request, tmp_path, config):
+    """
+    Tracker app on a fresh database, with its app context pushed, once
+    per storage backend.
+    """
+    app = create_app(dict({
+        'TESTING': True,
+        'SERVER_NAME': None,
+        'JWT_SECRET_KEY': 'a secret long enough for HMAC with SHA-256',
+        'DATABASE': str(tmp_path / 'tracker.sqlite'),
+        'STORAGE': request.param,
+        'STORAGE_SHARDS': 2,
+    }, **config))
+    with app.app_context():
+        init_db()
+        yield app
+        for queue in app.extensions.get('grasshopper_ingest', []):
+            queue.close()
+
+
+@pytest.fixture
+def user(app):
+    User.create('tester', 'tester@localhost', 'secret')
+    return User.find_by_username('tester')
+
+
+@pytest.fixture
+def client(app, user):
+    return app.test_client()
+
+
+@pytest.fixture
+def headers(client):
+    token = client.post('/v1/api/auth', json={
+        'username': 'tester', 'password': 'secret'}).json['token']
+    return {'Authorization': f'Bearer {token}'}
+
+
+@pytest.fixture
+def tracker(app, headers):
+    """
+    URL of the app served over HTTP, and a token to talk to it.
+    """
+    with serve(app) as url:
+        yield url, headers['Authorization'].split()[1]
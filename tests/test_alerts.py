@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from grasshopper.tracker.model import alerts
+
+
+def test_idle_runs_are_evicted(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(alerts, 'monotonic', lambda: now[0])
+    engine = alerts.AlertEngine(
+        [alerts.make_rule({'type': 'above', 'seconds': 0, 'abort': True})],
+        [], run_ttl=60)
+    idle = SimpleNamespace(id=1, name='idle', threshold=50.0)
+    busy = SimpleNamespace(id=2, name='busy', threshold=50.0)
+    start = datetime(2024, 1, 1)
+
+    engine.evaluate(idle, [(start, 90.0)])
+    assert engine.abort_event(idle.id)['rule'] == 'above'
+    for second in range(1, 120, 10):
+        now[0] += 10
+        engine.evaluate(busy, [(start + timedelta(seconds=second), 10.0)])
+
+    assert set(engine.runs) == {busy.id}
+    assert engine.abort_event(idle.id) is None
+
+
+def test_rate_of_change_ignores_blips():
+    rule = alerts.make_rule({'type': 'rate', 'seconds': 30, 'limit': 2})
+    window = rule.new_state(10000)
+    # Before the run is as old as the window, and a blip 50 ms later
+    assert rule.check(window, 0.0, 10.0, 50.0) is None
+    assert rule.check(window, 0.05, 90.0, 50.0) is None
+    for second in range(1, 40):
+        assert rule.check(window, float(second), 10.0, 50.0) is None
+    assert rule.check(window, 40.0, 10.0, 50.0) is None
+    assert rule.check(window, 40.05, 60.0, 50.0) is None
+
+    # A rise of 3 points per second over the whole window
+    for second in range(41, 72):
+        rate = rule.check(window, float(second), 10.0 + 3 * (second - 40),
+                          50.0)
+    assert rate == pytest.approx(3.0)
+
+
+def test_rate_of_change_needs_a_window():
+    with pytest.raises(ValueError):
+        alerts.make_rule({'type': 'rate', 'seconds': 0, 'limit': 2})
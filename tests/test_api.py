@@ -0,0 +1,91 @@
+import pytest
+
+from grasshopper.tracker.model import testrun
+from grasshopper.tracker.model.cache import get_cache
+from grasshopper.tracker.model.ingest import get_ingest_queue
+
+
+def create_run(client, headers):
+    response = client.post('/v1/api/testrun', headers=headers, json={
+        'name': 'run', 'description': '', 'threshold': 50})
+    assert response.status_code == 201, response.json
+    return response.json['id']
+
+
+def test_stop_with_the_ingest_queue_closed(client, headers):
+    testrun_id = create_run(client, headers)
+    response = client.post(f'/v1/api/testrun/{testrun_id}/usage',
+                           headers=headers, json={'usage': 10.0})
+    assert response.status_code in (201, 202)
+    get_ingest_queue(testrun_id).close()
+
+    response = client.post(f'/v1/api/testrun/{testrun_id}/stop',
+                           headers=headers)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert testrun.TestRun.find_by_id(testrun_id).is_active
+
+
+def test_stop_flushes_the_pending_samples(client, headers):
+    testrun_id = create_run(client, headers)
+    response = client.post(f'/v1/api/testrun/{testrun_id}/usage/batch',
+                           headers=headers,
+                           json=[{'usage': 10.0}, {'usage': 20.0}])
+    assert response.status_code in (201, 202)
+
+    response = client.post(f'/v1/api/testrun/{testrun_id}/stop',
+                           headers=headers)
+    assert response.status_code == 200
+    assert testrun.TestRun.find_by_id(testrun_id).fetch_stats().samples == 2
+
+
+def test_samples_of_a_run_stopped_by_another_process(client, headers):
+    testrun_id = create_run(client, headers)
+    stale = testrun.TestRun.find_by_id(testrun_id)
+    response = client.post(f'/v1/api/testrun/{testrun_id}/stop',
+                           headers=headers)
+    assert response.status_code == 200
+    # Still cached as active, as by another tracker process
+    get_cache('testrun').set(stale.id, stale)
+    get_ingest_queue(testrun_id).stopped.clear()
+
+    response = client.post(f'/v1/api/testrun/{testrun_id}/usage',
+                           headers=headers, query_string={'durable': 'true'},
+                           json={'usage': 10.0})
+    assert response.status_code == 409
+    assert testrun.TestRun.find_by_id(testrun_id).fetch_stats().samples == 0
+
+
+class TestDurableUploads:
+
+    @pytest.fixture
+    def config(self):
+        return {'INGEST_DURABLE': True, 'INGEST_COMMIT_TIMEOUT': 0}
+
+    def test_commit_timeout(self, client, headers):
+        testrun_id = create_run(client, headers)
+        response = client.post(f'/v1/api/testrun/{testrun_id}/usage',
+                               headers=headers, json={'usage': 10.0})
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+        assert response.json['msg']
+
+        response = client.post(f'/v1/api/testrun/{testrun_id}/usage/batch',
+                               headers=headers, json=[{'usage': 10.0}])
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+
+
+def test_store_failure(client, headers, monkeypatch):
+    def fail(self, samples):
+        raise RuntimeError('disk on fire')
+
+    monkeypatch.setattr(testrun.TestRun, 'add_samples', fail)
+    testrun_id = create_run(client, headers)
+    for path, body in (('usage', {'usage': 10.0}),
+                       ('usage/batch', [{'usage': 10.0}])):
+        response = client.post(
+            f'/v1/api/testrun/{testrun_id}/{path}?durable=true',
+            headers=headers, json=body)
+        assert response.status_code == 500
+        assert response.json == {'msg': 'Could not store the samples'}
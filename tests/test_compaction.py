@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+
+from grasshopper.tracker.model import testrun
+from grasshopper.tracker.model.columnar import Compactor
+from grasshopper.tracker.model.db import get_shard_db
+
+
+def raw_samples(test_run):
+    return get_shard_db(test_run.id).execute(
+        'SELECT COUNT(*) FROM cpu_usage WHERE test_run_id = ?',
+        (test_run.id,)).fetchone()[0]
+
+
+def samples(start, count, offset=0):
+    return [{'usage': float(offset + index),
+             'timestamp': (start + timedelta(seconds=offset + index))
+             .isoformat(sep=' '),
+             'rss': 1000 + index,
+             'per_cpu': [float(index), 100.0 - index]}
+            for index in range(count)]
+
+
+def new_run(user):
+    return testrun.TestRun.find_by_id(
+        testrun.TestRun.create(user.id, 'run', '', 50.0)['id'])
+
+
+def test_compacted_samples_read_back(app, user):
+    test_run = new_run(user)
+    start = datetime(2024, 1, 1)
+    test_run.record_cpu_usage_batch(samples(start, 50))
+    before, _ = test_run.fetch_samples(100)
+
+    test_run.finish()
+
+    assert raw_samples(test_run) == 0
+    after, next_page = test_run.fetch_samples(100)
+    assert next_page is None
+    assert [sample['time'] for sample in after] == \
+        [sample['time'] for sample in before]
+    assert [sample['usage'] for sample in after] == \
+        [sample['usage'] for sample in before]
+    assert [sample['rss'] for sample in after] == \
+        [sample['rss'] for sample in before]
+    assert after[3]['per_cpu'] == [3.0, 97.0]
+    recomputed = test_run.recompute_stats()
+    assert recomputed['measurements'] == test_run.fetch_stats().samples
+
+
+def test_late_samples_are_merged(app, user):
+    test_run = new_run(user)
+    start = datetime(2024, 1, 1)
+    test_run.record_cpu_usage_batch(samples(start, 20))
+    assert test_run.compact() == 20
+    test_run.record_cpu_usage_batch(samples(start, 10, offset=20))
+    assert test_run.compact() == 10
+
+    page, _ = test_run.fetch_samples(100)
+    assert [sample['usage'] for sample in page] == \
+        [float(index) for index in range(30)]
+    assert test_run.compact() == 0
+
+
+def test_overlapping_compaction_keeps_the_complete_row(app, user):
+    test_run = new_run(user)
+    start = datetime(2024, 1, 1)
+    test_run.record_cpu_usage_batch(samples(start, 20))
+    assert test_run.compact() == 20
+    test_run.record_cpu_usage_batch(samples(start, 5, offset=20))
+
+    # A compaction that read the row before the other one replaced it
+    stale = testrun.TestRun.find_by_id(test_run.id)
+    stale.load_compacted = lambda: None
+    assert stale.compact() == 0
+
+    assert len(test_run.load_compacted()) == 20
+    assert raw_samples(test_run) == 5
+    assert test_run.compact() == 5
+    page, _ = test_run.fetch_samples(100)
+    assert len(page) == 25
+
+
+def test_compactor_keeps_going_after_a_failure(app, user, caplog):
+    broken, test_run = new_run(user), new_run(user)
+    test_run.record_cpu_usage_batch(samples(datetime(2024, 1, 1), 10))
+    broken.compact = None
+    compactor = Compactor(app)
+
+    compactor.submit(broken)
+    compactor.submit(test_run)
+    compactor.join()
+
+    assert f'Could not compact testrun {broken.id}' in caplog.text
+    assert raw_samples(test_run) == 0
+    assert compactor.worker.daemon
+
+
+def test_compactor_queue_is_bounded(app, user):
+    test_run = new_run(user)
+    compactor = Compactor(app, max_runs=1)
+    # Busy with another run
+    compactor.worker = object()
+
+    compactor.submit(test_run)
+    compactor.submit(test_run)
+
+    assert compactor.runs.qsize() == 1
+    assert compactor.skipped == 1
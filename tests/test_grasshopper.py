@@ -0,0 +1,69 @@
+import asyncio
+import subprocess
+import sys
+
+import pytest
+
+from grasshopper.grasshopper import ABORTED_EXIT_STATUS, Runner, exit_status
+
+
+def grasshopper(tracker, *args):
+    url, jwt = tracker
+    return subprocess.run(
+        [sys.executable, '-m', 'grasshopper.grasshopper', '--jwt', jwt,
+         '--server', url, '--poll-interval', '0.1', *args],
+        capture_output=True, text=True, timeout=60)
+
+
+def test_exit_status():
+    assert exit_status(None) == 0
+    assert exit_status(0) == 0
+    assert exit_status(3) == 3
+    assert exit_status(-15) == 143
+
+
+def test_exit_status_of_the_command(tracker):
+    result = grasshopper(tracker, '--', sys.executable, '-c',
+                         'import sys; sys.exit(3)')
+    assert result.returncode == 3, result.stderr
+    assert 'Testrun stats' in result.stdout
+
+
+def test_exit_status_of_the_worst_command(tracker):
+    result = grasshopper(tracker, '--cmd', 'true', '--cmd', 'false',
+                         '--cmd', 'sh -c "exit 4"')
+    assert result.returncode == 4, result.stderr
+    assert result.stdout.count('testrun stats') == 3
+
+
+class TestAbortOnAlert:
+
+    @pytest.fixture
+    def config(self):
+        return {'ALERT_RULES': [{'type': 'above', 'seconds': 0, 'limit': -1,
+                                 'abort': True}]}
+
+    def test_abort_exit_status(self, tracker):
+        result = grasshopper(tracker, '--abort-on-alert', '--', 'sleep', '30')
+        assert result.returncode == ABORTED_EXIT_STATUS, result.stderr
+        assert 'aborting the command' in result.stdout
+
+    def test_no_abort_without_the_flag(self, tracker):
+        result = grasshopper(tracker, '--', 'sleep', '0.5')
+        assert result.returncode == 0, result.stderr
+
+
+def test_unbuffered_uploads_are_bounded():
+    class SlowTracker:
+        async def record_usage(self, sample, timestamp=None):
+            await asyncio.sleep(0.1)
+
+    async def upload():
+        runner = Runner(SlowTracker(), max_uploads=3)
+        for _ in range(10):
+            runner.upload_usage(None, 0.0)
+        in_flight = len(runner.uploads)
+        await asyncio.wait(runner.uploads)
+        return in_flight, runner.dropped
+
+    assert asyncio.run(upload()) == (3, 7)
@@ -0,0 +1,132 @@
+from concurrent.futures import Future
+
+import pytest
+
+from grasshopper.tracker.model import testrun
+from grasshopper.tracker.model.db import get_db, get_shard_db
+from grasshopper.tracker.model import ingest
+from grasshopper.tracker.model.ingest import (
+    Entry, IngestQueueFull, get_ingest_queue
+)
+
+
+def create_runs(user, count):
+    ids = [testrun.TestRun.create(user.id, f'run {index}', '', 50.0)['id']
+           for index in range(count)]
+    return [testrun.TestRun.find_by_id(id) for id in ids]
+
+
+def stored_samples(test_run):
+    return get_shard_db(test_run.id).execute(
+        'SELECT COUNT(*) FROM cpu_usage WHERE test_run_id = ?',
+        (test_run.id,)).fetchone()[0]
+
+
+def test_group_commit(app, user):
+    good, other = create_runs(user, 2)
+    queue = get_ingest_queue(good.id)
+    futures = [queue.submit(good, [{'usage': 10.0}, {'usage': 90.0}]),
+               queue.submit(good, [{'usage': 30.0}])]
+    queue.flush(5)
+
+    assert [future.result() for future in futures] == [2, 1]
+    assert stored_samples(good) == 3
+    stats = good.fetch_stats()
+    assert stats.samples == 3
+    assert stats.usage_max == 90.0
+    assert other.fetch_stats().samples == 0
+
+
+def test_failed_run_does_not_count_samples_twice(app, user):
+    # Two runs of the same shard, so that they share a group
+    runs = create_runs(user, 3)
+    good, bad = runs[0], runs[2]
+    queue = get_ingest_queue(good.id)
+    assert get_ingest_queue(bad.id) is queue
+
+    group = [Entry(good, [{'usage': 10.0}], Future()),
+             Entry(bad, [{'usage': None}], Future())]
+    queue.commit(group)
+
+    assert group[0].future.result() == 1
+    with pytest.raises(Exception):
+        group[1].future.result()
+    assert stored_samples(good) == 1
+    assert good.fetch_stats().samples == 1
+    assert stored_samples(bad) == 0
+    assert bad.fetch_stats().samples == 0
+    assert queue.metrics()['failed_rows'] == 1
+
+
+def test_record_batch_failure_leaves_stats_alone(app, user):
+    test_run, = create_runs(user, 1)
+    test_run.record_cpu_usage_batch([{'usage': 20.0}])
+    with pytest.raises(Exception):
+        test_run.record_cpu_usage_batch([{'usage': 40.0}, {'usage': None}])
+
+    assert stored_samples(test_run) == 1
+    stats = test_run.fetch_stats()
+    assert stats.samples == 1
+    assert stats.usage_max == 20.0
+
+
+def test_summaries_of_active_and_finished_runs(app, user):
+    active, finished = create_runs(user, 2)
+    active.record_cpu_usage_batch([{'usage': 20.0}, {'usage': 60.0}])
+    finished.record_cpu_usage_batch([{'usage': 40.0}])
+    finished.finish(compact=False)
+
+    summaries, more = testrun.TestRun.find_summaries(user.id, sort='start')
+    by_id = {summary['id']: summary for summary in summaries}
+    assert by_id[active.id]['samples'] == 2
+    assert by_id[active.id]['usage_max'] == 60.0
+    assert by_id[active.id]['breached']
+    assert by_id[finished.id]['samples'] == 1
+    assert not by_id[finished.id]['breached']
+    assert not more
+    # Stopped runs are filtered on the stats copied from their shard
+    assert get_db().execute(
+        'SELECT samples FROM test_run_stats WHERE test_run_id = ?',
+        (finished.id,)).fetchone()[0] == 1
+
+
+def test_stopped_run_takes_no_more_samples(app, user):
+    test_run, other = create_runs(user, 2)
+    queue = get_ingest_queue(test_run.id)
+    future = queue.submit(test_run, [{'usage': 10.0}])
+
+    queue.stop_run(test_run.id, 5)
+
+    assert future.result(0) == 1
+    # A request that found the run active before it was stopped
+    with pytest.raises(ingest.TestRunStopped):
+        queue.submit(test_run, [{'usage': 20.0}])
+    get_ingest_queue(other.id).submit(other, [{'usage': 20.0}]).result(5)
+    assert stored_samples(test_run) == 1
+
+
+def test_run_not_stopped_takes_samples_again(app, user):
+    test_run, = create_runs(user, 1)
+    queue = get_ingest_queue(test_run.id)
+    queue.submit(test_run, [{'usage': 10.0}])
+    queue.close()
+
+    with pytest.raises(IngestQueueFull):
+        queue.stop_run(test_run.id, 5)
+    assert test_run.id not in queue.stopped
+
+
+def test_run_stopped_by_another_process(app, user):
+    test_run, = create_runs(user, 1)
+    test_run.record_cpu_usage_batch([{'usage': 10.0}])
+    # As cached by a process that has not seen the run stop
+    stale = testrun.TestRun.find_by_id(test_run.id)
+    test_run.finish(compact=False)
+
+    with pytest.raises(testrun.TestRunStopped):
+        stale.record_cpu_usage_batch([{'usage': 20.0}])
+    future = get_ingest_queue(stale.id).submit(stale, [{'usage': 20.0}])
+    with pytest.raises(testrun.TestRunStopped):
+        future.result(5)
+    assert stored_samples(test_run) == 1
+    assert test_run.fetch_stats().samples == 1
@@ -0,0 +1,90 @@
+import re
+
+import pytest
+
+from grasshopper.tracker.metrics import Histogram
+
+TOKEN = 'metrics token'
+
+
+@pytest.fixture
+def config():
+    return {'METRICS': True, 'METRICS_TOKEN': TOKEN}
+
+
+def create_run(client, headers):
+    return client.post('/v1/api/testrun', headers=headers, json={
+        'name': 'run', 'description': '', 'threshold': 50}).json['id']
+
+
+def scrape(client, token=TOKEN):
+    return client.get('/metrics',
+                      headers={'Authorization': f'Bearer {token}'})
+
+
+def series(exposition, name, **labels):
+    """
+    Return the value of the sample of a series with the given labels.
+    """
+    for line in exposition.splitlines():
+        match = re.fullmatch(rf'{name}\{{(.*)\}} (\S+)', line)
+        if match and all(f'{label}="{value}"' in match[1].split(',')
+                         for label, value in labels.items()):
+            return float(match[2])
+    return None
+
+
+def test_requires_the_token(client):
+    assert client.get('/metrics').status_code == 403
+    assert scrape(client, 'wrong').status_code == 403
+    assert scrape(client).status_code == 200
+
+
+@pytest.mark.parametrize('config', [{'METRICS': True}])
+def test_only_local_without_a_token(client):
+    assert client.get('/metrics').status_code == 200
+    response = client.get('/metrics',
+                          environ_base={'REMOTE_ADDR': '192.0.2.1'})
+    assert response.status_code == 403
+
+
+def test_exposition_format(client, headers):
+    testrun_id = create_run(client, headers)
+    client.get(f'/v1/api/testrun/{testrun_id}', headers=headers)
+
+    response = scrape(client)
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert text.endswith('\n')
+    name = 'grasshopper_request_duration_seconds'
+    assert f'# TYPE {name} histogram' in text
+    labels = dict(endpoint='v1.testrun_get', method='GET', status='200')
+    counts = [series(text, f'{name}_bucket', le=bound, **labels)
+              for bound in ['0.001', '0.1', '10.0', '+Inf']]
+    assert counts == sorted(counts)
+    assert counts[-1] == series(text, f'{name}_count', **labels) == 1
+    for line in text.splitlines():
+        assert line.startswith('#') or \
+            re.fullmatch(r'[a-z_]+(\{.*\})? \S+', line), line
+
+
+def test_query_time_of_a_request_is_counted(client, headers):
+    testrun_id = create_run(client, headers)
+    client.get(f'/v1/api/testrun/{testrun_id}', headers=headers)
+
+    text = scrape(client).get_data(as_text=True)
+    name = 'grasshopper_request_query_seconds'
+    labels = dict(endpoint='v1.testrun_get', method='GET')
+    assert series(text, f'{name}_count', **labels) == 1
+    assert series(text, f'{name}_sum', **labels) > 0
+    assert series(text, 'grasshopper_query_duration_seconds_count',
+                  query='SELECT * FROM test_run WHERE id = ?') >= 1
+
+
+def test_histogram_buckets():
+    histogram = Histogram(buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    assert list(histogram.samples()) == [(0.1, 2), (1.0, 3), ('+Inf', 4)]
+    assert histogram.count == 4
+    assert histogram.sum == pytest.approx(2.65)
@@ -0,0 +1,85 @@
+from grasshopper.sampler import ChangeFilter, Sample
+
+
+def offer_all(change_filter, samples):
+    """
+    Offer (timestamp, sample) pairs and return the (timestamp, sample) of
+    the ones reported.
+    """
+    reported = []
+    for timestamp, sample in samples:
+        sample = change_filter.offer(sample, timestamp)
+        if sample is not None:
+            reported.append((timestamp, sample))
+    return reported
+
+
+def test_reports_changes_beyond_tolerance():
+    change_filter = ChangeFilter(tolerance=5.0, heartbeat=60.0)
+    usages = [10.0, 12.0, 15.0, 15.1, 9.0, 4.0]
+
+    reported = offer_all(change_filter, [
+        (index * 0.05, Sample(usage)) for index, usage in enumerate(usages)])
+
+    # 15.0 is within tolerance of 10.0, 15.1 is not, and then 9.0 is not
+    # within tolerance of 15.1 while 4.0 is within tolerance of 9.0
+    assert [sample.usage for _, sample in reported] == [10.0, 15.1, 9.0]
+
+
+def test_reports_threshold_crossings():
+    change_filter = ChangeFilter(tolerance=50.0, threshold=50.0,
+                                 heartbeat=60.0)
+    reported = offer_all(change_filter, [
+        (0.0, Sample(48.0)),
+        (0.05, Sample(52.0)),
+        (0.1, Sample(53.0)),
+        (0.15, Sample(49.0, per_cpu=[49.0, 49.0])),
+        # The hottest core crossing counts as well
+        (0.2, Sample(40.0, per_cpu=[45.0, 35.0])),
+        (0.25, Sample(41.0, per_cpu=[70.0, 12.0])),
+        (0.3, Sample(42.0, per_cpu=[71.0, 13.0])),
+    ])
+
+    assert [timestamp for timestamp, _ in reported] == \
+        [0.0, 0.05, 0.15, 0.25]
+
+
+def test_heartbeat():
+    change_filter = ChangeFilter(tolerance=5.0, heartbeat=1.0)
+    reported = offer_all(change_filter, [
+        (index * 0.25, Sample(10.0)) for index in range(9)])
+
+    assert [timestamp for timestamp, _ in reported] == [0.0, 1.0, 2.0]
+
+
+def test_io_of_left_out_samples_is_carried_over():
+    change_filter = ChangeFilter(tolerance=5.0, heartbeat=60.0)
+    reported = offer_all(change_filter, [
+        (0.0, Sample(10.0, io_read=100, io_write=10)),
+        (0.05, Sample(10.0, io_read=200, io_write=20)),
+        (0.1, Sample(11.0, io_read=300, io_write=None)),
+        (0.15, Sample(30.0, io_read=400, io_write=40)),
+    ])
+
+    assert [(sample.io_read, sample.io_write)
+            for _, sample in reported] == [(100, 10), (900, 40)]
+
+
+def test_flush_reports_the_last_sample_left_out():
+    change_filter = ChangeFilter(tolerance=5.0, heartbeat=60.0)
+    offer_all(change_filter, [(0.0, Sample(10.0)),
+                              (0.05, Sample(11.0, io_read=5)),
+                              (0.1, Sample(12.0, io_read=7))])
+
+    sample, timestamp = change_filter.flush()
+    assert (sample.usage, sample.io_read, timestamp) == (12.0, 12, 0.1)
+    assert change_filter.flush() is None
+    # Later samples are compared with the flushed one
+    assert change_filter.offer(Sample(16.0), 0.15) is None
+
+
+def test_flush_without_samples_left_out():
+    change_filter = ChangeFilter()
+    assert change_filter.flush() is None
+    change_filter.offer(Sample(10.0), 0.0)
+    assert change_filter.flush() is None
@@ -0,0 +1,118 @@
+import pytest
+
+from grasshopper.grasshopper import TrackerClient, upload
+from grasshopper.sampler import Sample
+from grasshopper.spool import RECORD, Spool, SpoolError, read_spool
+from grasshopper.tracker.model.db import get_db
+
+START = 1704067200.0
+
+
+def spool_run(path, count):
+    spool = Spool(str(path), create=True)
+    spool.begin('spooled', 'offline run', 50.0, START)
+    spool.extend([(Sample(float(index), rss=1000 + index,
+                          per_cpu=[float(index), 1.0]), START + index)
+                  for index in range(count)])
+    return spool
+
+
+def test_crash_keeps_complete_records(tmp_path):
+    path = tmp_path / 'run.spool'
+    spool = spool_run(path, 5)
+    # A sample record cut short by a crash while writing it
+    spool.file.write(RECORD.pack(b'S', 100) + b'partial')
+    spool.file.flush()
+
+    contents = read_spool(str(path))
+    assert contents.run['name'] == 'spooled'
+    assert contents.test_run_id is None
+    assert contents.end_time is None
+    assert not contents.uploaded
+    assert [sample.usage for _, sample, _ in contents.samples] == \
+        [0.0, 1.0, 2.0, 3.0, 4.0]
+    _, sample, timestamp = contents.samples[3]
+    assert sample == Sample(3.0, 1003, None, None, None, [3.0, 1.0])
+    assert timestamp == START + 3
+
+
+def test_not_a_spool(tmp_path):
+    path = tmp_path / 'notes.txt'
+    path.write_bytes(b'not a spool at all')
+    with pytest.raises(SpoolError):
+        Spool(str(path))
+    assert path.read_bytes() == b'not a spool at all'
+
+
+def test_replay_takes_and_puts_back(tmp_path):
+    spool = spool_run(tmp_path / 'run.spool', 5)
+    assert len(spool) == 5
+    batch = spool.take(3)
+    spool.put_back(batch)
+    assert spool.take(3) == batch
+    assert [sample.usage for sample, _ in spool.take(3)] == [3.0, 4.0]
+    assert len(spool) == 0
+    spool.close()
+
+    assert read_spool(spool.path).samples == []
+
+
+class FailingClient(TrackerClient):
+    """
+    Loses the connection after uploading fail_after batches.
+    """
+
+    def __init__(self, *args, fail_after, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail_after = fail_after
+
+    def record_usage_batch(self, samples):
+        if not self.fail_after:
+            raise ConnectionError('Tracker went away')
+        self.fail_after -= 1
+        return super().record_usage_batch(samples)
+
+
+def test_interrupted_upload_resumes(tracker, tmp_path):
+    url, jwt = tracker
+    path = str(tmp_path / 'run.spool')
+    spool_run(path, 25).close()
+
+    client = FailingClient(jwt, url, fail_after=2)
+    with pytest.raises(ConnectionError):
+        upload(client, path, max_batch=10)
+    client.close()
+    contents = read_spool(path)
+    assert contents.test_run_id is not None
+    assert len(contents.samples) == 5
+
+    client = TrackerClient(jwt, url)
+    stats = upload(client, path, max_batch=10)
+    assert stats['measurements'] == 25
+    assert upload(client, path) is None
+    client.close()
+
+
+def test_upload_resumes_after_a_crash(tracker, tmp_path):
+    url, jwt = tracker
+    path = str(tmp_path / 'run.spool')
+    spool = spool_run(path, 25)
+    spool.file.write(RECORD.pack(b'S', 100) + b'partial')
+    spool.file.flush()
+
+    client = FailingClient(jwt, url, fail_after=2)
+    with pytest.raises(ConnectionError):
+        upload(client, path, max_batch=10)
+    client.close()
+    contents = read_spool(path)
+    assert contents.test_run_id is not None
+    assert len(contents.samples) == 5
+
+    client = TrackerClient(jwt, url)
+    stats = upload(client, path, max_batch=10)
+    assert stats['measurements'] == 25
+    assert read_spool(path).uploaded
+    assert upload(client, path) is None
+    client.close()
+    assert get_db().execute('SELECT COUNT(*) FROM test_run').fetchone()[0] \
+        == 1
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from grasshopper.tracker.model import db, testrun
+from grasshopper.tracker.model.analysis import compute_stats
+from grasshopper.tracker.model.stats import RunningStats
+from grasshopper.tracker.model.user import User
+
+START = datetime(2024, 1, 1)
+# Seconds since the start and usage, unevenly spaced as with adaptive
+# sampling: long steady stretches and bursts of changes
+SAMPLES = [(0.0, 10.0), (5.0, 12.0), (5.05, 80.0), (5.1, 85.0),
+           (5.15, 20.0), (20.0, 25.0), (20.5, 90.0), (45.0, 30.0),
+           (45.25, 30.0)]
+
+
+def running_stats(samples, threshold):
+    stats = RunningStats(1)
+    for seconds, usage in samples:
+        stats.add(START + timedelta(seconds=seconds), usage, None, threshold)
+    return stats
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 4, len(SAMPLES)])
+def test_time_weighted_means_agree(chunk_size):
+    stats = running_stats(SAMPLES, 50.0)
+    times, usages = (np.array(column) for column in zip(*SAMPLES))
+    chunks = [(times[index:index + chunk_size],
+               usages[index:index + chunk_size])
+              for index in range(0, len(SAMPLES), chunk_size)]
+
+    computed = compute_stats(chunks, 50.0, stats.usage_min, stats.usage_max)
+
+    assert stats.usage_time_weighted_mean == \
+        pytest.approx(computed['usage']['time_weighted_mean'])
+    assert stats.usage_mean == pytest.approx(computed['usage']['mean'])
+    assert stats.time_above_threshold == \
+        pytest.approx(computed['time_above_threshold'])
+    # Each usage held until the next sample
+    assert stats.usage_time_weighted_mean == pytest.approx(
+        (10 * 5 + 12 * 0.05 + 80 * 0.05 + 85 * 0.05 + 20 * 14.85
+         + 25 * 0.5 + 90 * 24.5 + 30 * 0.25) / 45.25)
+
+
+def test_time_weighted_means_of_a_run_agree(app, user):
+    test_run = testrun.TestRun.find_by_id(
+        testrun.TestRun.create(user.id, 'run', '', 50.0)['id'])
+    test_run.record_cpu_usage_batch([
+        {'usage': usage,
+         'timestamp': (START + timedelta(seconds=seconds)).isoformat()}
+        for seconds, usage in SAMPLES])
+
+    recomputed = test_run.recompute_stats()
+    assert test_run.fetch_stats().usage_time_weighted_mean == \
+        pytest.approx(recomputed['usage']['time_weighted_mean'])
+
+
+def test_single_sample_falls_back_to_the_mean():
+    stats = running_stats(SAMPLES[:1], 50.0)
+    assert stats.usage_time_weighted_mean == stats.usage_mean == 10.0
+
+
+def test_migration_0009_keeps_the_mean_of_older_runs(app, monkeypatch):
+    migrations = db.list_migrations()
+    monkeypatch.setattr(db, 'list_migrations', lambda: [
+        migration for migration in migrations if migration[0] < 9])
+    db.init_db()
+    User.create('tester', 'tester@localhost', 'secret')
+    user = User.find_by_username('tester')
+    test_run = testrun.TestRun.find_by_id(
+        testrun.TestRun.create(user.id, 'run', '', 50.0)['id'])
+    shard = db.get_shard_db(test_run.id)
+    shard.execute(
+        'INSERT OR REPLACE INTO test_run_stats '
+        '(test_run_id, samples, usage_sum, usage_min, usage_max) '
+        'VALUES (?, 2, 100.0, 40.0, 60.0)', (test_run.id,))
+    shard.commit()
+    monkeypatch.undo()
+
+    assert db.migrate_db()[0] == '0009_time_weighted_usage.sql'
+
+    stats = test_run.fetch_stats()
+    assert (stats.usage_time_sum, stats.sampled_time) == (0.0, 0.0)
+    assert stats.usage_time_weighted_mean == stats.usage_mean == 50.0
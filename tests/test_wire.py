@@ -0,0 +1,84 @@
+import pytest
+
+from grasshopper import wire
+from grasshopper.sampler import Sample
+from grasshopper.tracker.model import testrun
+
+BASE = 1704067200.0
+
+
+def decode(body):
+    base, deltas, usages, metrics, per_cpu = wire.decode_batch(body)
+    return (base, list(deltas), list(usages),
+            metrics and {name: list(values)
+                         for name, values in metrics.items()},
+            per_cpu and list(per_cpu))
+
+
+def test_round_trip():
+    samples = [(Sample(12.5), BASE), (Sample(99.0), BASE + 0.25),
+               (Sample(0.0), BASE + 3600)]
+    assert decode(wire.encode_batch(samples)) == \
+        (BASE, [0, 250, 3600000], [12.5, 99.0, 0.0], None, None)
+
+
+def test_round_trip_with_metrics_and_cores():
+    samples = [(Sample(10.0, rss=2 ** 40, threads=8, io_read=None,
+                       io_write=7, per_cpu=[1.0, 2.0]), BASE),
+               (Sample(20.0, threads=9, per_cpu=[3.0, 4.0]), BASE + 1)]
+    base, deltas, usages, metrics, per_cpu = \
+        decode(wire.encode_batch(samples))
+    assert (base, deltas, usages) == (BASE, [0, 1000], [10.0, 20.0])
+    assert metrics == {'rss': [2 ** 40, wire.MISSING],
+                       'threads': [8, 9],
+                       'io_read': [wire.MISSING, wire.MISSING],
+                       'io_write': [7, wire.MISSING]}
+    assert per_cpu == [1.0, 2.0, 3.0, 4.0]
+
+
+def test_compressed_round_trip():
+    samples = [(Sample(float(index % 7)), BASE + index * 0.5)
+               for index in range(1000)]
+    body = wire.encode_batch(samples)
+    compressed = wire.encode_batch(samples, compress=True)
+    assert len(compressed) < len(body)
+    assert wire.decompress(compressed, 1000) == body
+    with pytest.raises(wire.BatchTooLarge):
+        wire.decompress(compressed, 999)
+
+
+def test_samples_that_do_not_fit():
+    assert wire.encode_batch([]) is None
+    assert wire.encode_batch([(Sample(1.0, per_cpu=[1.0]), BASE),
+                              (Sample(1.0, per_cpu=[1.0, 2.0]), BASE)]) \
+        is None
+    assert wire.encode_batch([(Sample(1.0), BASE),
+                              (Sample(1.0), BASE + 50 * 86400)]) is None
+
+
+def test_truncated_batch():
+    body = wire.encode_batch([(Sample(1.0), BASE)])
+    with pytest.raises(wire.WireFormatError):
+        wire.decode_batch(body[:-1])
+    with pytest.raises(wire.WireFormatError):
+        wire.decode_batch(b'GHB2' + body[4:])
+
+
+def test_upload_binary_batch(client, headers):
+    testrun_id = client.post('/v1/api/testrun', headers=headers, json={
+        'name': 'run', 'description': '', 'threshold': 50}).json['id']
+    samples = [(Sample(float(index), rss=index, per_cpu=[float(index)]),
+                BASE + index) for index in range(10)]
+    response = client.post(
+        f'/v1/api/testrun/{testrun_id}/usage/batch?durable=true',
+        headers=dict(headers, **{'Content-Type': wire.CONTENT_TYPE,
+                                 'Content-Encoding': 'gzip'}),
+        data=wire.encode_batch(samples, compress=True))
+    assert response.status_code == 201, response.json
+    assert response.json['accepted'] == 10
+
+    stored, _ = testrun.TestRun.find_by_id(testrun_id).fetch_samples(100)
+    assert [sample['usage'] for sample in stored] == \
+        [float(index) for index in range(10)]
+    assert [sample['rss'] for sample in stored] == list(range(10))
+    assert stored[4]['per_cpu'] == [4.0]